@@ -0,0 +1,235 @@
+"""Fitting prompts into the model's context window."""
+from typing import Callable, Dict, List, Optional, Type, Union
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+from short_term_memory import trim_messages
+from token_counter import estimate_tokens
+
+
+TokenCounter = Callable[[BaseMessage], int]
+
+# Context sizes of known models; others fall back to DEFAULT_CONTEXT_WINDOW
+MODEL_CONTEXT_WINDOWS = {
+    "glm-4.5": 128000,
+    "glm-4.6": 200000,
+    "glm-4.6v": 128000,
+    "glm-4.7": 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# glm_terminal.py and glm_web.py feed command output back as an AIMessage
+TOOL_RESULT_PREFIX = "Command executed:"
+
+
+def count_message_tokens(message: BaseMessage) -> int:
+    """Estimate the tokens of one message's content."""
+    return estimate_tokens(message.content if isinstance(message.content, str) else str(message.content))
+
+
+def is_tool_result(message: BaseMessage) -> bool:
+    """Check whether a message carries command/tool output."""
+    if isinstance(message, ToolMessage):
+        return True
+    return isinstance(message, AIMessage) and str(message.content).startswith(TOOL_RESULT_PREFIX)
+
+
+def _leading_system(messages: List[BaseMessage]) -> int:
+    """Return how many system messages open the prompt."""
+    start = 0
+    while start < len(messages) and isinstance(messages[start], SystemMessage):
+        start += 1
+    return start
+
+
+class TruncationPolicy:
+    """Decides which messages of an over-long prompt are sent.
+
+    Policies return a new list and never modify the one passed in. Leading
+    system messages and the latest user message are always kept.
+    """
+
+    name = "base"
+
+    def truncate(self, messages: List[BaseMessage], budget: int, count: TokenCounter) -> List[BaseMessage]:
+        """Return messages whose total tokens fit the budget.
+
+        Args:
+            messages: Prompt to fit (not modified)
+            budget: Maximum total tokens
+            count: Token counter for one message
+
+        Returns:
+            Messages to send
+        """
+        raise NotImplementedError
+
+
+class SlidingWindow(TruncationPolicy):
+    """Drops the oldest whole turns until the prompt fits."""
+
+    name = "sliding_window"
+
+    def truncate(self, messages: List[BaseMessage], budget: int, count: TokenCounter) -> List[BaseMessage]:
+        fixed = sum(count(message) for message in messages[:_leading_system(messages)])
+        kept = list(messages)
+        trim_messages(kept, max_tokens=max(0, budget - fixed), count=count)
+        return kept
+
+
+class KeepToolResults(TruncationPolicy):
+    """Keeps only the last k tool results, then slides the window if needed.
+
+    Search and command output is the bulkiest part of a transcript and goes
+    stale quickly, so older results are always reduced to the command line
+    that produced them.
+    """
+
+    name = "keep_tool_results"
+
+    def __init__(self, keep: int = 2):
+        """Initialize the policy.
+
+        Args:
+            keep: Number of most recent tool results kept in full
+        """
+        self.keep = keep
+        self._stubs: Dict[int, tuple] = {}
+
+    def truncate(self, messages: List[BaseMessage], budget: int, count: TokenCounter) -> List[BaseMessage]:
+        results = [i for i, message in enumerate(messages) if is_tool_result(message)]
+        stale = set(results[:-self.keep] if self.keep else results)
+        reduced = [self._stub(message) if i in stale else message for i, message in enumerate(messages)]
+        return SlidingWindow().truncate(reduced, budget, count)
+
+    def _stub(self, message: BaseMessage) -> BaseMessage:
+        """Return the message with its output omitted (the same object per message)."""
+        cached = self._stubs.get(id(message))
+        if cached and cached[0] is message:
+            return cached[1]
+        command = str(message.content).split("\n", 1)[0]
+        stub = message.model_copy(update={"content": f"{command}\n[Result omitted]"})
+        self._stubs[id(message)] = (message, stub)
+        if len(self._stubs) > 1024:
+            self._stubs.pop(next(iter(self._stubs)))
+        return stub
+
+
+class SummarizeOldest(TruncationPolicy):
+    """Replaces the turns that do not fit with a short digest in the system prompt.
+
+    The default digest is extractive (the opening words of each dropped user
+    turn), so no model call is needed; pass a summarizer to use another one.
+    """
+
+    name = "summarize_oldest"
+
+    def __init__(
+        self,
+        summary_tokens: int = 200,
+        summarizer: Optional[Callable[[List[BaseMessage]], str]] = None,
+        snippet_chars: int = 60,
+    ):
+        """Initialize the policy.
+
+        Args:
+            summary_tokens: Tokens reserved for the digest
+            summarizer: Callable turning dropped messages into a digest
+            snippet_chars: Characters kept from each dropped user turn
+        """
+        self.summary_tokens = summary_tokens
+        self.summarizer = summarizer
+        self.snippet_chars = snippet_chars
+
+    def truncate(self, messages: List[BaseMessage], budget: int, count: TokenCounter) -> List[BaseMessage]:
+        start = _leading_system(messages)
+        if sum(count(message) for message in messages) <= budget:
+            return list(messages)
+        kept = SlidingWindow().truncate(messages, max(0, budget - self.summary_tokens), count)
+        dropped = messages[start:len(messages) - (len(kept) - start)]
+        summary = self._summarize(dropped) if dropped else ""
+        if not summary:
+            return kept
+        if start:
+            system = kept[0]
+            kept[0] = SystemMessage(content=f"{system.content}\n\n{summary}")
+        else:
+            kept.insert(0, SystemMessage(content=summary))
+        return kept
+
+    def _summarize(self, dropped: List[BaseMessage]) -> str:
+        if self.summarizer:
+            return self.summarizer(dropped)
+        header = f"Earlier in this conversation ({len(dropped)} messages omitted):"
+        tokens = estimate_tokens(header) + 1  # plus the separator from the system prompt
+        snippets = []
+        for message in reversed(dropped):
+            if not isinstance(message, HumanMessage):
+                continue
+            snippet = " ".join(str(message.content).split())[:self.snippet_chars]
+            tokens += estimate_tokens(snippet) + 1
+            if tokens > self.summary_tokens:
+                break
+            snippets.append(snippet)
+        return f"{header} " + " | ".join(reversed(snippets)) if snippets else header
+
+
+POLICIES: Dict[str, Type[TruncationPolicy]] = {
+    policy.name: policy for policy in (SlidingWindow, KeepToolResults, SummarizeOldest)
+}
+
+
+def create_policy(name: Optional[str] = None, **options) -> TruncationPolicy:
+    """Create a truncation policy by name.
+
+    Args:
+        name: Policy name (see POLICIES, defaults to "sliding_window")
+        **options: Keyword arguments for the policy constructor
+
+    Returns:
+        Truncation policy instance
+    """
+    name = (name or SlidingWindow.name).lower()
+    if name not in POLICIES:
+        raise ValueError(f"Unknown truncation policy: {name} (choose from {', '.join(POLICIES)})")
+    return POLICIES[name](**options)
+
+
+class ContextWindow:
+    """Token budget of one model: context size minus room for the response."""
+
+    def __init__(
+        self,
+        max_tokens: int = DEFAULT_CONTEXT_WINDOW,
+        reserve_tokens: int = 4096,
+        policy: Union[str, TruncationPolicy, None] = None,
+    ):
+        """Initialize the window.
+
+        Args:
+            max_tokens: Model context size in tokens
+            reserve_tokens: Tokens kept free for the response
+            policy: Truncation policy name or instance (defaults to "sliding_window")
+        """
+        self.max_tokens = max_tokens
+        self.reserve_tokens = reserve_tokens
+        self.policy = policy if isinstance(policy, TruncationPolicy) else create_policy(policy)
+
+    @classmethod
+    def for_model(cls, model: str, **options) -> "ContextWindow":
+        """Create a window sized for a known model."""
+        return cls(MODEL_CONTEXT_WINDOWS.get(model.lower(), DEFAULT_CONTEXT_WINDOW), **options)
+
+    @property
+    def budget(self) -> int:
+        """Maximum prompt tokens."""
+        return max(0, self.max_tokens - self.reserve_tokens)
+
+    def fit(self, messages: List[BaseMessage], count: Optional[TokenCounter] = None) -> List[BaseMessage]:
+        """Return the messages to send so the prompt fits the budget.
+
+        Args:
+            messages: Prompt to fit (not modified)
+            count: Token counter for one message (defaults to count_message_tokens)
+        """
+        return self.policy.truncate(messages, self.budget, count or count_message_tokens)
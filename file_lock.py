@@ -0,0 +1,123 @@
+"""Advisory inter-process file locks and atomic file writes for the memory directory."""
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+
+class FileLock:
+    """Re-entrant exclusive lock backed by flock() on a lock file.
+
+    The same instance can be shared by threads; nested acquisitions from the
+    owning thread only take the OS lock once. On platforms without fcntl the
+    lock still serializes threads of this process.
+    """
+
+    def __init__(self, path: Path, timeout: Optional[float] = 10.0):
+        """Initialize the lock.
+
+        Args:
+            path: Lock file to create and flock
+            timeout: Seconds to wait for the lock (None waits forever)
+        """
+        self.path = Path(path)
+        self.timeout = timeout
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> None:
+        """Block until the lock is held by this thread."""
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._fd = self._lock_file()
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self) -> None:
+        """Release one level of ownership."""
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            if fcntl:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    def _lock_file(self) -> int:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not fcntl:
+            return fd
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise TimeoutError(f"Timed out waiting for lock {self.path}")
+                time.sleep(0.005)
+
+
+def write_temp_json(path: Path, data: Any, fsync: bool = False, **dump_options: Any) -> str:
+    """Write data as JSON to a new temp file next to path.
+
+    The temp file is removed again if writing fails.
+
+    Args:
+        path: File the temp file will later replace
+        data: JSON-serializable data
+        fsync: Flush the temp file to disk before returning
+        **dump_options: Extra json.dump arguments (indent, separators, ...)
+
+    Returns:
+        Name of the temp file
+    """
+    path = Path(path)
+    fd, tmp_file = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_options)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return tmp_file
+
+
+def atomic_write_json(path: Path, data: Any, fsync: bool = False, **dump_options: Any) -> None:
+    """Replace path with data as JSON, so readers see the old or the new file.
+
+    Args:
+        path: File to write
+        data: JSON-serializable data
+        fsync: Flush the new file to disk before it replaces path
+        **dump_options: Extra json.dump arguments (indent, separators, ...)
+    """
+    tmp_file = write_temp_json(path, data, fsync=fsync, **dump_options)
+    try:
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
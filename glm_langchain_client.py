@@ -1,10 +1,19 @@
 """LangChain-compatible GLM client for ZhipuAI."""
+import asyncio
 import os
+import time
+import weakref
 from pathlib import Path
-from typing import Any, List, Optional
-from langchain_community.chat_models import ChatZhipuAI
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
+from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, BaseMessage
 from memory_manager import MemoryManager
+from prompt_composer import PromptComposer
+from context_window import ContextWindow, KeepToolResults, TruncationPolicy, create_policy
+from http_transport import PooledChatZhipuAI
+from model_chain import ModelChain
+from model_router import ModelRouter
+from response_cache import ResponseCache
 
 
 class GLMClient:
@@ -22,6 +31,84 @@ class GLMClient:
                     config[key.strip()] = value.strip()
         return config
     
+    def _create_chat(self, model: str) -> BaseChatModel:
+        """Build the chat model for a model name (called once per name by the router)."""
+        return PooledChatZhipuAI(
+            model=model,
+            api_key=self._api_key,
+            temperature=self.temperature,
+            streaming=self.streaming,
+        )
+    
+    @property
+    def model(self) -> str:
+        """Name of the active model."""
+        return self.router.active
+    
+    @property
+    def chat(self) -> BaseChatModel:
+        """Chat model of the active model."""
+        return self.router.get()
+    
+    @chat.setter
+    def chat(self, chat: BaseChatModel) -> None:
+        self.router.set(self.router.active, chat)
+    
+    def use_model(self, model: str) -> None:
+        """Send subsequent calls to another model.
+        
+        The model becomes the primary of the model chain, so calls still
+        fail over to the rest of the chain while it is unavailable. Its chat
+        instance is created on first use and kept, and it shares the pooled
+        HTTP transport, memory, skills and cache of this client, so
+        switching back and forth costs nothing.
+        """
+        self.chain.prefer(model)
+        self.router.use(model)
+    
+    @property
+    def context_window(self) -> ContextWindow:
+        """Context window of the active model."""
+        return self._window(self.model)
+    
+    def _window(self, model: str) -> ContextWindow:
+        """Return the context window of a model, created on first use."""
+        window = self._context_windows.get(model)
+        if window is None:
+            options = {"reserve_tokens": self._reserve_tokens, "policy": self._truncation}
+            if self._window_size:
+                window = ContextWindow(self._window_size, **options)
+            else:
+                window = ContextWindow.for_model(model, **options)
+            self._context_windows[model] = window
+        return window
+    
+    @staticmethod
+    def memory_options_from_config(config: Dict[str, str], backend: Optional[str] = None) -> Dict[str, Any]:
+        """Build MemoryManager keyword arguments from config.properties values.
+        
+        Args:
+            config: Parsed config (see _load_config)
+            backend: Backend overriding memory.backend
+            
+        Returns:
+            Keyword arguments for MemoryManager
+        """
+        backend = backend or config.get("memory.backend", "json")
+        storage_options = {}
+        if backend == "json":
+            storage_options["concurrency"] = config.get("memory.concurrency", "lock")
+        return {
+            "backend": backend,
+            "storage_options": storage_options,
+            # Write memory off the interactive path (memory.write_delay=0 writes synchronously)
+            "write_delay": float(config.get("memory.write_delay", "0.2")) or None,
+            "summary_token_budget": int(config.get("memory.summary_token_budget", "800")),
+            # Bound the persisted context (memory.context_max_keys=0 keeps every key)
+            "context_max_keys": int(config.get("memory.context_max_keys", "0")) or None,
+            "context_eviction": config.get("memory.context_eviction", "lru"),
+        }
+    
     def __init__(
         self,
         api_key: Optional[str] = None,
@@ -31,6 +118,12 @@ class GLMClient:
         skills_dir: Optional[str] = None,
         memory_dir: Optional[str] = None,
         enable_memory: bool = True,
+        memory_backend: Optional[str] = None,
+        context_window: Optional[int] = None,
+        truncation: Union[str, TruncationPolicy, None] = None,
+        response_cache: Union[bool, ResponseCache, None] = None,
+        model_chain: Optional[List[str]] = None,
+        health_path: Optional[str] = None,
     ):
         """Initialize GLM client.
         
@@ -42,6 +135,18 @@ class GLMClient:
             skills_dir: Path to skills directory (auto-loads all SKILL.md files)
             memory_dir: Directory for long-term memory (defaults to .memories/)
             enable_memory: Enable long-term memory (default: True)
+            memory_backend: Memory storage backend, "json" or "sqlite" (defaults to config.properties)
+            context_window: Model context size in tokens (defaults to config.properties,
+                then the known size of the model)
+            truncation: How prompts over the context window are cut: "sliding_window",
+                "keep_tool_results", "summarize_oldest" or a TruncationPolicy
+                (defaults to config.properties)
+            response_cache: Cache identical requests on disk: True, False or a
+                ResponseCache (defaults to config.properties cache.enabled)
+            model_chain: Fallback models tried after the primary model (defaults to
+                config.properties glm.model_chain, then glm.fallback_model)
+            health_path: File model health is persisted to (defaults to
+                config.properties glm.health_path)
         """
         if api_key:
             os.environ["ZHIPUAI_API_KEY"] = api_key
@@ -50,20 +155,83 @@ class GLMClient:
         model = model or config.get("glm.model", "glm-4.7")
         temperature = temperature if temperature is not None else float(config.get("glm.temperature", "0.5"))
         streaming = streaming if streaming is not None else config.get("glm.streaming", "false").lower() == "true"
+        memory_backend = memory_backend or config.get("memory.backend", "json")
         
-        self.chat = ChatZhipuAI(
-            model=model,
-            temperature=temperature,
-            streaming=streaming,
+        # Relevance-retrieved memory injection (memory.retrieval=false injects everything)
+        self.memory_retrieval = config.get("memory.retrieval", "true").lower() == "true"
+        self.memory_top_k = int(config.get("memory.retrieval_top_k", "8"))
+        self.memory_token_budget = int(config.get("memory.token_budget", "400"))
+        
+        # Chat models by name over one pooled HTTP transport; use_model() switches
+        self._api_key = os.environ.get("ZHIPUAI_API_KEY")
+        self.temperature = temperature
+        self.streaming = streaming
+        self.router = ModelRouter(self._create_chat, model)
+        self.router.get()
+        
+        # Calls go to the primary model while it is healthy, otherwise to the
+        # fastest healthy model of the chain (per-model circuit breakers)
+        if model_chain is None:
+            model_chain = config.get("glm.model_chain") or config.get("glm.fallback_model", "")
+            model_chain = [name.strip() for name in model_chain.split(",") if name.strip()]
+        health_path = health_path if health_path is not None else config.get("glm.health_path", ".cache/model_health.json")
+        self.chain = ModelChain(
+            [model, *model_chain],
+            path=Path(__file__).parent / health_path if health_path else None,
+            failure_threshold=int(config.get("glm.failure_threshold", "3")),
+            cooldown=float(config.get("glm.cooldown", "30")),
+            max_cooldown=float(config.get("glm.max_cooldown", "600")),
         )
         
+        # Opt-in cache of responses to identical prompts (off by default)
+        if response_cache is None:
+            response_cache = config.get("cache.enabled", "false").lower() == "true"
+        self.response_cache: Optional[ResponseCache] = None
+        if isinstance(response_cache, ResponseCache):
+            self.response_cache = response_cache
+        elif response_cache:
+            self.response_cache = ResponseCache(
+                Path(__file__).parent / config.get("cache.path", ".cache/responses.db"),
+                max_entries=int(config.get("cache.max_entries", "1000")),
+                ttl=float(config.get("cache.ttl", "86400")) or None,
+            )
+        
+        # Every prompt is fitted into the model's context window before sending
+        truncation = truncation or config.get("chat.truncation", "keep_tool_results")
+        if truncation == KeepToolResults.name:
+            truncation = KeepToolResults(keep=int(config.get("chat.keep_tool_results", "2")))
+        elif isinstance(truncation, str):
+            truncation = create_policy(truncation)
+        self._truncation = truncation
+        self._reserve_tokens = int(config.get("chat.reserve_tokens", "4096"))
+        # Explicit window size for every model; 0 uses each model's known size
+        self._window_size = context_window or int(config.get("glm.context_window") or 0)
+        self._context_windows: Dict[str, ContextWindow] = {}
+        # Estimated tokens of the prompt sent by the most recent call
+        self.last_prompt_tokens = 0
+        # Model that answered the most recent call (the chain may fail over)
+        self.last_model = model
+        
+        # MemoryManager settings from config, reused for per-user namespaces
+        self.memory_options = self.memory_options_from_config(config, memory_backend)
+        
         # Initialize memory manager
         self.memory: Optional[MemoryManager] = None
         if enable_memory:
-            self.memory = MemoryManager(memory_dir=memory_dir)
+            self.memory = MemoryManager(memory_dir=memory_dir, **self.memory_options)
+            # Condense old history into day/week/month rollups in the background
+            rollup_interval = float(config.get("memory.rollup_interval", "600"))
+            if rollup_interval > 0:
+                self.memory.start_rollup_job(rollup_interval)
+        
+        # Messages already written to long-term history, by identity.
+        # Callers keep appending to the same list across turns, so only
+        # messages not seen before need to be recorded.
+        self._recorded_messages: Dict[int, weakref.ref] = {}
         
         # Load skills
         self.skills_context = self._load_skills(skills_dir)
+        self.composer = PromptComposer(self.skills_context)
     
     def _load_skills(self, skills_dir: Optional[str]) -> str:
         """Load all SKILL.md files from skills directory."""
@@ -87,49 +255,266 @@ class GLMClient:
         
         return "\n\n---\n\n".join(skills) if skills else ""
     
-    def invoke(self, messages: List[BaseMessage]) -> str:
+    def invoke(
+        self,
+        messages: List[BaseMessage],
+        memory: Optional[MemoryManager] = None,
+        use_cache: bool = True,
+    ) -> str:
         """Send messages and get response.
         
         Args:
-            messages: List of message objects (SystemMessage, HumanMessage, AIMessage)
+            messages: List of message objects (SystemMessage, HumanMessage, AIMessage);
+                not modified, so the same transcript can be reused across turns
+            memory: Memory to use for this call instead of self.memory, e.g. a
+                per-user namespace from MemoryNamespaces
+            use_cache: Whether the response cache may answer and store this
+                call (False for calls that should be sampled afresh)
             
         Returns:
             Response content as string
         """
-        # Inject skills into system message if available
-        if self.skills_context and messages:
-            for i, msg in enumerate(messages):
-                if isinstance(msg, SystemMessage):
-                    messages[i] = SystemMessage(content=f"{msg.content}\n\n# Available Skills\n\n{self.skills_context}")
-                    break
-            else:
-                # No system message found, prepend one
-                messages.insert(0, SystemMessage(content=f"# Available Skills\n\n{self.skills_context}"))
+        memory = memory if memory is not None else self.memory
+        # Skills and long-term memory go into a copy of the system prompt;
+        # the caller's list is left as it was
+        memory_block = self._memory_block(memory, messages) if memory and messages else ""
+        error = None
+        for model in self.chain.route():
+            prompt = self._prompt(messages, memory_block, model)
+            cache_key, text = self._cache_lookup(model, prompt, use_cache)
+            if text is not None:
+                self.chain.release(model)
+                break
+            started = time.monotonic()
+            try:
+                text = self.router.get(model).invoke(prompt).content
+            except Exception as e:
+                if not self.chain.record_failure(model, e):
+                    raise
+                error = e
+                continue
+            self.chain.record_success(model, time.monotonic() - started)
+            self._cache_store(cache_key, text)
+            break
+        else:
+            raise error
+        self.last_model = model
+        
+        # Save to long-term memory if enabled
+        if memory and messages:
+            memory.add_history_entries(self._history_entries(messages, text))
         
-        # Inject long-term memory into system message if enabled
-        if self.memory and messages:
-            memory_summary = self.memory.get_memory_summary()
-            if memory_summary.strip():
-                for i, msg in enumerate(messages):
-                    if isinstance(msg, SystemMessage):
-                        messages[i] = SystemMessage(content=f"{msg.content}\n\n{memory_summary}")
-                        break
+        return text
+    
+    def stream(
+        self,
+        messages: List[BaseMessage],
+        memory: Optional[MemoryManager] = None,
+        use_cache: bool = True,
+    ) -> Iterator[str]:
+        """Send messages and yield the response text as it arrives.
         
-        response = self.chat.invoke(messages)
+        History is recorded once the stream completes; a stream abandoned
+        part-way is not recorded. A model that fails before its first chunk
+        is failed over like in invoke; a failure mid-stream is raised.
         
-        # Save to long-term memory if enabled
-        if self.memory and messages:
-            for msg in messages:
-                if isinstance(msg, HumanMessage):
-                    self.memory.add_to_history("user", msg.content)
-            self.memory.add_to_history("assistant", response.content)
-        
-        return response.content
-    
-    async def ainvoke(self, messages: List[BaseMessage]) -> str:
-        """Async version of invoke."""
-        response = await self.chat.agenerate([messages])
-        return response.generations[0][0].text
+        Args:
+            messages: List of message objects; not modified
+            memory: Memory to use for this call instead of self.memory
+            use_cache: Whether the response cache may answer and store this call
+            
+        Yields:
+            Response text chunks (a cached response arrives as one chunk)
+        """
+        memory = memory if memory is not None else self.memory
+        memory_block = self._memory_block(memory, messages) if memory and messages else ""
+        chunks, error = [], None
+        for model in self.chain.route():
+            prompt = self._prompt(messages, memory_block, model)
+            cache_key, cached = self._cache_lookup(model, prompt, use_cache)
+            if cached is not None:
+                self.chain.release(model)
+                self.last_model = model
+                chunks.append(cached)
+                yield cached
+                break
+            started = time.monotonic()
+            try:
+                for chunk in self.router.get(model).stream(prompt):
+                    text = self._chunk_text(chunk)
+                    if text:
+                        if not chunks:
+                            self.last_model = model
+                        chunks.append(text)
+                        yield text
+            except Exception as e:
+                if not self.chain.record_failure(model, e) or chunks:
+                    raise
+                error = e
+                continue
+            self.chain.record_success(model, time.monotonic() - started)
+            self._cache_store(cache_key, "".join(chunks))
+            break
+        else:
+            raise error
+        
+        if memory and messages:
+            memory.add_history_entries(self._history_entries(messages, "".join(chunks)))
+    
+    @staticmethod
+    def _chunk_text(chunk: BaseMessage) -> str:
+        return chunk.content if isinstance(chunk.content, str) else str(chunk.content)
+    
+    def _cache_lookup(self, model: str, prompt: List[BaseMessage], use_cache: bool) -> tuple:
+        """Return (cache key, cached response); (None, None) when the cache is off or bypassed."""
+        if not (use_cache and self.response_cache):
+            return None, None
+        key = ResponseCache.key(model, self.temperature, prompt)
+        return key, self.response_cache.get(key)
+    
+    def _cache_store(self, cache_key: Optional[str], response: str) -> None:
+        if cache_key and response:
+            self.response_cache.put(cache_key, response)
+    
+    def _prompt(self, messages: List[BaseMessage], memory_block: str, model: str) -> List[BaseMessage]:
+        """Compose skills and memory into the prompt and fit it to the model's context window."""
+        prompt = self._window(model).fit(self.composer.compose(messages, memory_block), self.composer.message_tokens)
+        self.last_prompt_tokens = sum(map(self.composer.message_tokens, prompt))
+        return prompt
+    
+    def _memory_query(self, messages: List[BaseMessage]) -> Optional[str]:
+        """Return the latest user turn to retrieve memory for (None for the full summary)."""
+        query = next(
+            (msg.content for msg in reversed(messages) if isinstance(msg, HumanMessage)),
+            None,
+        )
+        if not self.memory_retrieval or not isinstance(query, str):
+            return None
+        return query
+    
+    def _memory_block(self, memory: MemoryManager, messages: List[BaseMessage]) -> str:
+        """Render the memory items relevant to the latest user turn."""
+        query = self._memory_query(messages)
+        if query is None:
+            return memory.get_memory_summary()
+        return memory.get_relevant_memory(
+            query,
+            top_k=self.memory_top_k,
+            token_budget=self.memory_token_budget,
+        )
+    
+    async def _amemory_block(self, memory: MemoryManager, messages: List[BaseMessage]) -> str:
+        """Async version of _memory_block."""
+        query = self._memory_query(messages)
+        if query is None:
+            return await memory.aget_memory_summary()
+        return await memory.aget_relevant_memory(
+            query,
+            top_k=self.memory_top_k,
+            token_budget=self.memory_token_budget,
+        )
+    
+    def _history_entries(self, messages: List[BaseMessage], response: str) -> List[Dict[str, str]]:
+        """Return user messages not yet recorded plus the response, for one history write."""
+        entries = []
+        for msg in messages:
+            if isinstance(msg, HumanMessage) and not self._is_recorded(msg):
+                entries.append({"role": "user", "content": msg.content})
+                self._mark_recorded(msg)
+        entries.append({"role": "assistant", "content": response})
+        return entries
+    
+    def _is_recorded(self, msg: BaseMessage) -> bool:
+        ref = self._recorded_messages.get(id(msg))
+        return ref is not None and ref() is msg
+    
+    def _mark_recorded(self, msg: BaseMessage) -> None:
+        key = id(msg)
+        self._recorded_messages[key] = weakref.ref(
+            msg, lambda _, key=key: self._recorded_messages.pop(key, None)
+        )
+    
+    async def ainvoke(
+        self,
+        messages: List[BaseMessage],
+        memory: Optional[MemoryManager] = None,
+        use_cache: bool = True,
+    ) -> str:
+        """Async version of invoke.
+        
+        Memory is read and written through the MemoryManager async methods,
+        so the event loop never blocks on memory I/O.
+        """
+        memory = memory if memory is not None else self.memory
+        memory_block = await self._amemory_block(memory, messages) if memory and messages else ""
+        error = None
+        for model in self.chain.route():
+            prompt = self._prompt(messages, memory_block, model)
+            cache_key, text = await asyncio.to_thread(self._cache_lookup, model, prompt, use_cache)
+            if text is not None:
+                self.chain.release(model)
+                break
+            started = time.monotonic()
+            try:
+                response = await self.router.get(model).agenerate([prompt])
+            except Exception as e:
+                if not await asyncio.to_thread(self.chain.record_failure, model, e):
+                    raise
+                error = e
+                continue
+            text = response.generations[0][0].text
+            await asyncio.to_thread(self.chain.record_success, model, time.monotonic() - started)
+            await asyncio.to_thread(self._cache_store, cache_key, text)
+            break
+        else:
+            raise error
+        self.last_model = model
+        
+        if memory and messages:
+            await memory.aadd_history_entries(self._history_entries(messages, text))
+        return text
+    
+    async def astream(
+        self,
+        messages: List[BaseMessage],
+        memory: Optional[MemoryManager] = None,
+        use_cache: bool = True,
+    ) -> AsyncIterator[str]:
+        """Async version of stream."""
+        memory = memory if memory is not None else self.memory
+        memory_block = await self._amemory_block(memory, messages) if memory and messages else ""
+        chunks, error = [], None
+        for model in self.chain.route():
+            prompt = self._prompt(messages, memory_block, model)
+            cache_key, cached = await asyncio.to_thread(self._cache_lookup, model, prompt, use_cache)
+            if cached is not None:
+                self.chain.release(model)
+                self.last_model = model
+                chunks.append(cached)
+                yield cached
+                break
+            started = time.monotonic()
+            try:
+                async for chunk in self.router.get(model).astream(prompt):
+                    text = self._chunk_text(chunk)
+                    if text:
+                        if not chunks:
+                            self.last_model = model
+                        chunks.append(text)
+                        yield text
+            except Exception as e:
+                if not await asyncio.to_thread(self.chain.record_failure, model, e) or chunks:
+                    raise
+                error = e
+                continue
+            await asyncio.to_thread(self.chain.record_success, model, time.monotonic() - started)
+            await asyncio.to_thread(self._cache_store, cache_key, "".join(chunks))
+            break
+        else:
+            raise error
+        
+        if memory and messages:
+            await memory.aadd_history_entries(self._history_entries(messages, "".join(chunks)))
 
 
 # Example usage
@@ -9,6 +9,7 @@ import readline  # Enable better line editing (backspace, arrow keys, etc.)
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.tools import tool
 from glm_langchain_client import GLMClient
+from short_term_memory import trim_messages
 
 warnings.filterwarnings("ignore", message=".*HMAC key.*")
 
@@ -43,6 +44,21 @@ def execute_command(cmd):
         return f"Error: {e}"
 
 
+def stream_reply(client, messages):
+    """Print the assistant reply as it streams in and return the full text."""
+    chunks = []
+    for text in client.stream(messages):
+        if not chunks:
+            # Name the model when the chain has failed over from the primary
+            label = "Assistant" if client.last_model == client.chain.primary else f"Assistant [{client.last_model}]"
+            print(f"\n{label}: ", end="", flush=True)
+        chunks.append(text)
+        print(text, end="", flush=True)
+    if chunks:
+        print("\n")
+    return "".join(chunks)
+
+
 def create_memory_tool(client):
     """Create tool for AI to save user preferences and context."""
     @tool
@@ -64,13 +80,14 @@ def create_memory_tool(client):
             return "Memory not enabled"
         
         saved = []
-        if preference_key and preference_value:
-            client.memory.save_preference(preference_key, preference_value)
-            saved.append(f"preference: {preference_key}={preference_value}")
-        
-        if context_key and context_value:
-            client.memory.save_context(context_key, context_value)
-            saved.append(f"context: {context_key}={context_value}")
+        with client.memory.transaction():
+            if preference_key and preference_value:
+                client.memory.save_preference(preference_key, preference_value)
+                saved.append(f"preference: {preference_key}={preference_value}")
+            
+            if context_key and context_value:
+                client.memory.save_context(context_key, context_value)
+                saved.append(f"context: {context_key}={context_value}")
         
         return f"✓ Saved to memory: {'; '.join(saved)}" if saved else "No data to save"
     
@@ -88,10 +105,11 @@ def main():
                 config[key.strip()] = value.strip()
     
     primary_model = config.get("glm.model", "glm-4.6v")
-    fallback_model = config.get("glm.fallback_model", "glm-4.7")
+    # Keep the transcript bounded so day-long sessions use constant memory
+    max_messages = int(config.get("chat.max_messages", "40"))
+    max_tokens = int(config.get("chat.max_tokens", "8000"))
     
     client = GLMClient(api_key=os.getenv("ZHIPUAI_API_KEY"), model=primary_model)
-    current_model = primary_model
     
     system_prompt = """You are a helpful AI assistant with access to various tools.
 
@@ -117,8 +135,9 @@ IMPORTANT:
 Do NOT make up information. Always execute the command first to get real data."""
     
     messages = [SystemMessage(content=system_prompt)]
+    turns = 0
     
-    print(f"GLM Chat (using {current_model})")
+    print(f"GLM Chat (using {' -> '.join(client.chain.models)})")
     print("Type 'exit' or 'quit' to end, 'clear' to reset, 'save-pref key value' to save preference\n")
     
     while True:
@@ -133,7 +152,7 @@ Do NOT make up information. Always execute the command first to get real data.""
                 if SAVE_PROFILE_AVAILABLE:
                     print("\n💾 Saving user profile before exit...")
                     try:
-                        save_analyzed_user_profile()
+                        save_analyzed_user_profile(client.memory)
                         print("✅ User profile saved successfully!\n")
                     except Exception as e:
                         print(f"⚠️ Could not save profile: {e}\n")
@@ -165,83 +184,79 @@ Do NOT make up information. Always execute the command first to get real data.""
                 continue
             
             messages.append(HumanMessage(content=user_input))
+            trim_messages(messages, max_messages, max_tokens)
+            turns += 1
             
-            try:
-                response = client.invoke(messages)
-                
-                # Check if AI wants to save memory
-                if "SAVE_MEMORY:" in response:
-                    lines = response.split("\n")
-                    for line in lines:
-                        if line.startswith("SAVE_MEMORY:"):
-                            mem_data = line.replace("SAVE_MEMORY:", "").strip()
-                            if "=" in mem_data:
-                                key, value = mem_data.split("=", 1)
-                                key = key.strip()
-                                value = value.strip()
-                                # Determine if preference or context based on key
-                                if key in ["language", "content_type", "region_preference", "preferred_style"]:
-                                    client.memory.save_preference(key, value)
-                                    print(f"[Saved preference: {key}={value}]")
-                                else:
-                                    client.memory.save_context(key, value)
-                                    print(f"[Saved context: {key}={value}]")
-                
-                # Check if response contains command to execute
-                executed_command = False
-                if "EXECUTE:" in response:
-                    lines = response.split("\n")
-                    for line in lines:
-                        if line.startswith("EXECUTE:"):
-                            cmd = line.replace("EXECUTE:", "").strip()
-                            print(f"\n[Executing: {cmd}]\n")
-                            output = execute_command(cmd)
-                            # Debug: check if output is empty
-                            if not output or not output.strip():
-                                print("[Warning: Command produced no output]")
-                                output = "Command executed but produced no output."
-                            # Print the actual output to user
-                            print(output)
-                            print()  # Extra newline for readability
-                            # Add command result to context and ask AI to summarize
-                            messages.append(AIMessage(content=f"Command executed: {cmd}\nResult: {output}"))
-                            messages.append(HumanMessage(content="请用中文总结上面的搜索结果，提取关键信息。"))
-                            # Get AI's summary
-                            summary = client.invoke(messages)
-                            print(f"\nAssistant: {summary}\n")
-                            messages.append(AIMessage(content=summary))
-                            executed_command = True
-                            break
-                
-                # Print normal AI responses (only if we didn't execute a command)
-                if not executed_command:
-                    print(f"\nAssistant: {response}\n")
-                    messages.append(AIMessage(content=response))
-                
-                # Periodically update user profile (every 5 exchanges = 10 messages)
-                if SAVE_PROFILE_AVAILABLE and len(messages) % 10 == 0:
-                    try:
-                        save_analyzed_user_profile()
-                    except Exception as e:
-                        # Silently fail - don't disrupt user experience
-                        pass
-            except Exception as e:
-                if "429" in str(e) and current_model == primary_model:
-                    print(f"\n{primary_model} error, switching to {fallback_model}...\n")
-                    client = GLMClient(api_key=os.getenv("ZHIPUAI_API_KEY"), model=fallback_model)
-                    current_model = fallback_model
-                    response = client.invoke(messages)
-                    print(f"\nAssistant: {response}\n")
-                    messages.append(AIMessage(content=response))
-                else:
-                    raise
+            # Tokens are shown as they arrive instead of after the full completion;
+            # the client fails over along its model chain on rate limits and outages
+            response = stream_reply(client, messages)
+            
+            # Check if AI wants to save memory
+            if "SAVE_MEMORY:" in response and client.memory:
+                lines = response.split("\n")
+                preferences, contexts = {}, {}
+                for line in lines:
+                    if line.startswith("SAVE_MEMORY:"):
+                        mem_data = line.replace("SAVE_MEMORY:", "").strip()
+                        if "=" in mem_data:
+                            key, value = mem_data.split("=", 1)
+                            key = key.strip()
+                            value = value.strip()
+                            # Determine if preference or context based on key
+                            if key in ["language", "content_type", "region_preference", "preferred_style"]:
+                                preferences[key] = value
+                                print(f"[Saved preference: {key}={value}]")
+                            else:
+                                contexts[key] = value
+                                print(f"[Saved context: {key}={value}]")
+                # One write for every SAVE_MEMORY line in the response
+                with client.memory.transaction():
+                    client.memory.save_preferences(preferences)
+                    client.memory.save_contexts(contexts)
+            
+            # Check if response contains command to execute
+            executed_command = False
+            if "EXECUTE:" in response:
+                lines = response.split("\n")
+                for line in lines:
+                    if line.startswith("EXECUTE:"):
+                        cmd = line.replace("EXECUTE:", "").strip()
+                        print(f"\n[Executing: {cmd}]\n")
+                        output = execute_command(cmd)
+                        # Debug: check if output is empty
+                        if not output or not output.strip():
+                            print("[Warning: Command produced no output]")
+                            output = "Command executed but produced no output."
+                        # Print the actual output to user
+                        print(output)
+                        print()  # Extra newline for readability
+                        # Add command result to context and ask AI to summarize
+                        messages.append(AIMessage(content=f"Command executed: {cmd}\nResult: {output}"))
+                        messages.append(HumanMessage(content="请用中文总结上面的搜索结果，提取关键信息。"))
+                        # Get AI's summary
+                        summary = stream_reply(client, messages)
+                        messages.append(AIMessage(content=summary))
+                        executed_command = True
+                        break
+            
+            # Keep normal AI responses (already printed while streaming)
+            if not executed_command:
+                messages.append(AIMessage(content=response))
+            
+            # Periodically update user profile (every 5 exchanges)
+            if SAVE_PROFILE_AVAILABLE and turns % 5 == 0:
+                try:
+                    save_analyzed_user_profile(client.memory, verbose=False)
+                except Exception as e:
+                    # Silently fail - don't disrupt user experience
+                    pass
             
         except KeyboardInterrupt:
             # Save user profile before exiting on Ctrl+C
             if SAVE_PROFILE_AVAILABLE:
                 print("\n\n💾 Saving user profile...")
                 try:
-                    save_analyzed_user_profile()
+                    save_analyzed_user_profile(client.memory)
                     print("✅ User profile saved successfully!")
                 except Exception as e:
                     print(f"⚠️ Could not save profile: {e}")
@@ -1,18 +1,39 @@
 #!/usr/bin/env python3
 """Web interface for GLM terminal - accessible from WeChat browser."""
 import os
-from flask import Flask, request, jsonify, render_template_string
+import secrets
+from pathlib import Path
+from flask import Flask, request, jsonify, render_template_string, session
 from glm_langchain_client import GLMClient
+from memory_namespaces import MemoryNamespaces
+from short_term_memory import trim_messages
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 import subprocess
 
+_config = GLMClient._load_config()
+
 app = Flask(__name__)
+# Signs the session cookie that carries each user's memory namespace. Set
+# web.secret_key (or FLASK_SECRET_KEY) so users keep their memory across restarts.
+app.secret_key = _config.get("web.secret_key") or os.getenv("FLASK_SECRET_KEY") or secrets.token_hex(32)
+app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+
+# Initialize GLM client; long-term memory is namespaced per user below
+client = GLMClient(api_key=os.getenv("ZHIPUAI_API_KEY"), enable_memory=False)
 
-# Initialize GLM client
-client = GLMClient(api_key=os.getenv("ZHIPUAI_API_KEY"))
+# One memory directory per user, so concurrent users never share (or wait
+# on) each other's memory files
+memories = MemoryNamespaces(
+    Path(__file__).parent / ".memories" / "sessions",
+    max_open=int(_config.get("web.max_open_memories", "64")),
+    **client.memory_options,
+)
 
-# Store conversation history per session (simple in-memory storage)
+# Store conversation history per user and browser tab (simple in-memory storage)
 conversations = {}
+# Per-session transcript caps; GLMClient also fits each prompt to the model's context window
+MAX_MESSAGES = int(_config.get("chat.max_messages", "40"))
+MAX_TOKENS = int(_config.get("chat.max_tokens", "8000"))
 
 SYSTEM_PROMPT = """You are a helpful AI assistant with access to various tools.
 
@@ -186,42 +207,56 @@ def index():
     """Serve the chat interface."""
     return render_template_string(HTML_TEMPLATE)
 
+def current_user_id():
+    """Return the caller's memory namespace from the signed session cookie.
+    
+    The id is issued by the server on first contact and never read from the
+    request body, so a client cannot name another user's namespace.
+    """
+    user_id = session.get('user_id')
+    if user_id is None:
+        user_id = session['user_id'] = secrets.token_urlsafe(16)
+        session.permanent = True
+    return user_id
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handle chat messages."""
     data = request.json
     message = data.get('message', '')
-    session_id = data.get('session_id', 'default')
+    user_id = current_user_id()
+    # The client-chosen session_id only separates one user's browser tabs
+    conversation_id = (user_id, str(data.get('session_id', 'default')))
     
     # Get or create conversation history
-    if session_id not in conversations:
-        conversations[session_id] = [SystemMessage(content=SYSTEM_PROMPT)]
+    if conversation_id not in conversations:
+        conversations[conversation_id] = [SystemMessage(content=SYSTEM_PROMPT)]
     
-    messages = conversations[session_id]
+    messages = conversations[conversation_id]
     messages.append(HumanMessage(content=message))
     
-    # Get AI response
-    response = client.invoke(messages)
-    
-    # Check if response contains EXECUTE command
-    if "EXECUTE:" in response:
-        for line in response.split("\n"):
-            if line.startswith("EXECUTE:"):
-                cmd = line.replace("EXECUTE:", "").strip()
-                output = execute_command(cmd)
-                
-                # Add result and ask for summary
-                messages.append(AIMessage(content=f"Command executed: {cmd}\nResult: {output}"))
-                messages.append(HumanMessage(content="请用中文总结上面的搜索结果，提取关键信息。"))
-                response = client.invoke(messages)
-                messages.append(AIMessage(content=response))
-                break
-    else:
-        messages.append(AIMessage(content=response))
+    with memories.session(user_id) as memory:
+        # Get AI response
+        response = client.invoke(messages, memory=memory)
+        
+        # Check if response contains EXECUTE command
+        if "EXECUTE:" in response:
+            for line in response.split("\n"):
+                if line.startswith("EXECUTE:"):
+                    cmd = line.replace("EXECUTE:", "").strip()
+                    output = execute_command(cmd)
+                    
+                    # Add result and ask for summary
+                    messages.append(AIMessage(content=f"Command executed: {cmd}\nResult: {output}"))
+                    messages.append(HumanMessage(content="请用中文总结上面的搜索结果，提取关键信息。"))
+                    response = client.invoke(messages, memory=memory)
+                    messages.append(AIMessage(content=response))
+                    break
+        else:
+            messages.append(AIMessage(content=response))
     
-    # Keep conversation history manageable (last 20 messages)
-    if len(messages) > 20:
-        conversations[session_id] = [messages[0]] + messages[-19:]
+    # Keep conversation history manageable (oldest whole turns go first)
+    trim_messages(messages, MAX_MESSAGES, MAX_TOKENS)
     
     return jsonify({'response': response})
 
@@ -0,0 +1,241 @@
+"""Inverted-index search over long-term conversation history."""
+import heapq
+import json
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from file_lock import atomic_write_json
+from memory_storage import MemoryStorage
+
+
+# CJK ideographs, kana and hangul are indexed as overlapping character bigrams
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(f"[{_CJK}]+|[^\\W_{_CJK}]+")
+_CJK_RE = re.compile(f"[{_CJK}]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into search terms.
+
+    Latin text is split into lowercase words; runs of CJK characters become
+    overlapping character bigrams ("三体小说" -> "三体", "体小", "小说"), and a
+    lone CJK character is kept as a unigram.
+
+    Args:
+        text: Text to tokenize
+
+    Returns:
+        List of terms in document order
+    """
+    terms = []
+    for run in _TOKEN_RE.findall(text.lower()):
+        if _CJK_RE.match(run):
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+class HistorySearchIndex:
+    """BM25-ranked inverted index over history entries.
+
+    Documents are identified by their position in the history. The index
+    remembers how many entries it has seen, so ``sync`` only tokenizes
+    entries appended since the previous call, and is persisted to
+    ``search_index.json`` so a new process does not start from scratch.
+    sync, search and save may be called from several threads.
+
+    Terms are scored rarest first. A term found in more than
+    ``COMMON_TERM_DOCS`` entries (e.g. "the", "我们") only adds to entries
+    that rarer query terms already matched, or, if it is the rarest term of
+    the query, is scored over its most recent ``COMMON_TERM_DOCS`` entries,
+    so one common word cannot make a search scan the whole history.
+    """
+
+    VERSION = 1
+    K1 = 1.5
+    B = 0.75
+    COMMON_TERM_DOCS = 5000
+
+    def __init__(self, index_file: Path, save_every: int = 1000):
+        """Initialize the index.
+
+        Args:
+            index_file: Where the index is persisted
+            save_every: Persist after this many newly indexed entries; a new
+                process re-indexes at most this many entries on its first sync
+        """
+        self.index_file = Path(index_file)
+        self.save_every = save_every
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._reset()
+        self._load()
+
+    def sync(self, storage: MemoryStorage) -> int:
+        """Index history entries added since the last sync.
+
+        The index is rebuilt if the history was replaced (for example by an
+        import) or shrank.
+
+        Args:
+            storage: Storage backend holding the history
+
+        Returns:
+            Number of newly indexed entries
+        """
+        with self._lock:
+            return self._sync(storage)
+
+    def _sync(self, storage: MemoryStorage) -> int:
+        count = storage.history_count()
+        generation = storage.history_generation()
+        indexed = len(self.doc_lengths)
+        if indexed and (
+            count < indexed
+            or generation != self.generation
+            or (generation is None and count > indexed and not self._checkpoint_matches(storage))
+        ):
+            self._reset()
+            indexed = 0
+        self.generation = generation
+        if count == indexed:
+            return 0
+
+        added = 0
+        for entry in storage.iter_history_from(indexed):
+            self._add(entry)
+            added += 1
+        self._unsaved += added
+        if self._unsaved >= self.save_every or added == len(self.doc_lengths):
+            self._save()
+        return added
+
+    def save(self) -> None:
+        """Persist the index to disk."""
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        data = {
+            "version": self.VERSION,
+            "generation": self.generation,
+            "doc_lengths": self.doc_lengths.tolist(),
+            "doc_timestamps": self.doc_timestamps,
+            "postings": {
+                term: [docs.tolist(), freqs.tolist()]
+                for term, (docs, freqs) in self.postings.items()
+            },
+        }
+        atomic_write_json(self.index_file, data, ensure_ascii=False, separators=(",", ":"))
+        self._unsaved = 0
+
+    def search(
+        self,
+        query: str,
+        limit: int = 10,
+        since: Optional[str] = None,
+    ) -> List[Tuple[int, float]]:
+        """Rank indexed entries against a query.
+
+        Args:
+            query: Free-text query
+            limit: Maximum number of results
+            since: Only consider entries at or after this ISO timestamp
+
+        Returns:
+            (position, score) pairs, best match first
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            return self._search(terms, limit, since)
+
+    def _search(self, terms: set, limit: int, since: Optional[str]) -> List[Tuple[int, float]]:
+        total = len(self.doc_lengths)
+        if not terms or not total:
+            return []
+
+        avg_length = (self.total_length / total) or 1.0
+        scores: Dict[int, float] = {}
+        postings = sorted(
+            (self.postings[term] for term in terms if term in self.postings),
+            key=lambda item: len(item[0]),
+        )
+        for docs, freqs in postings:
+            idf = math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in self._scored_postings(docs, freqs, scores):
+                if since and self.doc_timestamps[doc] < since:
+                    continue
+                norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[doc] / avg_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+
+    def _scored_postings(self, docs: array, freqs: array, scores: Dict[int, float]) -> Iterator[Tuple[int, int]]:
+        """Yield the (doc, tf) pairs of one term worth scoring."""
+        if len(docs) <= self.COMMON_TERM_DOCS:
+            yield from zip(docs, freqs)
+        elif scores:
+            for doc in list(scores):
+                i = bisect_left(docs, doc)
+                if i < len(docs) and docs[i] == doc:
+                    yield doc, freqs[i]
+        else:
+            start = len(docs) - self.COMMON_TERM_DOCS
+            yield from zip(docs[start:], freqs[start:])
+
+    def _add(self, entry: Dict) -> None:
+        doc = len(self.doc_lengths)
+        terms = tokenize(str(entry.get("content", "")))
+        freqs: Dict[str, int] = {}
+        for term in terms:
+            freqs[term] = freqs.get(term, 0) + 1
+        for term, tf in freqs.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array("I"), array("I"))
+            postings[0].append(doc)
+            postings[1].append(tf)
+        self.doc_lengths.append(len(terms))
+        self.doc_timestamps.append(entry.get("timestamp", ""))
+        self.total_length += len(terms)
+
+    def _checkpoint_matches(self, storage: MemoryStorage) -> bool:
+        """Check that the last indexed position still holds the same entry."""
+        last = len(self.doc_lengths) - 1
+        entry = storage.history_at([last]).get(last)
+        return entry is not None and entry.get("timestamp", "") == self.doc_timestamps[last]
+
+    def _reset(self) -> None:
+        self.generation: Optional[int] = None
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.doc_lengths = array("I")
+        self.doc_timestamps: List[str] = []
+        self.total_length = 0
+
+    def _load(self) -> None:
+        if not self.index_file.exists():
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+        if data.get("version") != self.VERSION:
+            return
+        self.postings = {
+            term: (array("I", docs), array("I", freqs))
+            for term, (docs, freqs) in data["postings"].items()
+        }
+        self.doc_lengths = array("I", data["doc_lengths"])
+        self.doc_timestamps = data["doc_timestamps"]
+        self.total_length = sum(self.doc_lengths)
+        self.generation = data.get("generation")
@@ -0,0 +1,189 @@
+"""Process-wide pooled HTTP transport for ZhipuAI chat models."""
+import asyncio
+import atexit
+import json
+import threading
+import time
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+from langchain_community.chat_models.zhipuai import (
+    API_TOKEN_TTL_SECONDS,
+    ChatZhipuAI,
+    _convert_delta_to_message_chunk,
+    _get_jwt_token,
+    _truncate_params,
+    aconnect_sse,
+    connect_sse,
+)
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+
+TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0)
+
+_lock = threading.Lock()
+_client: Optional[httpx.Client] = None
+# httpx.AsyncClient is bound to the event loop it first runs on
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_tokens: Dict[str, Tuple[str, float]] = {}
+
+
+def shared_client() -> httpx.Client:
+    """Return the process-wide keep-alive HTTP client."""
+    global _client
+    with _lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(timeout=TIMEOUT, limits=LIMITS)
+        return _client
+
+
+def shared_async_client() -> httpx.AsyncClient:
+    """Return the keep-alive async HTTP client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = _async_clients[loop] = httpx.AsyncClient(timeout=TIMEOUT, limits=LIMITS)
+        return client
+
+
+def close_clients() -> None:
+    """Close the shared sync client (async clients close with their loop)."""
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+atexit.register(close_clients)
+
+
+def auth_token(api_key: str) -> str:
+    """Return a ZhipuAI JWT, reused until shortly before it expires."""
+    now = time.monotonic()
+    with _lock:
+        cached = _tokens.get(api_key)
+        if cached and cached[1] > now:
+            return cached[0]
+    token = _get_jwt_token(api_key)
+    with _lock:
+        _tokens[api_key] = (token, now + API_TOKEN_TTL_SECONDS - 30)
+    return token
+
+
+class PooledChatZhipuAI(ChatZhipuAI):
+    """ChatZhipuAI that sends requests over the shared keep-alive clients.
+
+    The stock model opens (and closes) a new HTTP client and signs a new
+    token on every call; this one reuses pooled connections and tokens
+    across calls and across every model instance in the process.
+    """
+
+    def _headers(self) -> Dict[str, str]:
+        if self.zhipuai_api_key is None:
+            raise ValueError("Did not find zhipuai_api_key.")
+        return {"Authorization": auth_token(self.zhipuai_api_key), "Accept": "application/json"}
+
+    def _payload(self, messages: List[BaseMessage], stop: Optional[List[str]], stream: bool, **kwargs: Any) -> Dict:
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        payload = {**params, **kwargs, "messages": message_dicts, "stream": stream}
+        _truncate_params(payload)
+        return payload
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if stream if stream is not None else self.streaming:
+            return super()._generate(messages, stop=stop, run_manager=run_manager, stream=True, **kwargs)
+        response = shared_client().post(
+            self.zhipuai_api_base, json=self._payload(messages, stop, False, **kwargs), headers=self._headers()
+        )
+        response.raise_for_status()
+        return self._create_chat_result(response.json())
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        payload = self._payload(messages, stop, True, **kwargs)
+        with connect_sse(shared_client(), "POST", self.zhipuai_api_base, json=payload, headers=self._headers()) as events:
+            events.response.raise_for_status()
+            for sse in events.iter_sse():
+                chunk = self._chunk(sse.data, run_manager)
+                if chunk is None:
+                    continue
+                yield chunk
+                if chunk.generation_info:
+                    break
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        stream: Optional[bool] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if stream if stream is not None else self.streaming:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, stream=True, **kwargs)
+        response = await shared_async_client().post(
+            self.zhipuai_api_base, json=self._payload(messages, stop, False, **kwargs), headers=self._headers()
+        )
+        response.raise_for_status()
+        return self._create_chat_result(response.json())
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager=None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        payload = self._payload(messages, stop, True, **kwargs)
+        client = shared_async_client()
+        async with aconnect_sse(client, "POST", self.zhipuai_api_base, json=payload, headers=self._headers()) as events:
+            events.response.raise_for_status()
+            async for sse in events.aiter_sse():
+                chunk = self._chunk(sse.data, None)
+                if chunk is None:
+                    continue
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+                if chunk.generation_info:
+                    break
+
+    @staticmethod
+    def _chunk(data: str, run_manager) -> Optional[ChatGenerationChunk]:
+        """Convert one SSE event into a chunk (None for events without choices)."""
+        event = json.loads(data)
+        if not event["choices"]:
+            return None
+        choice = event["choices"][0]
+        finish_reason = choice.get("finish_reason")
+        generation_info = None
+        if finish_reason is not None:
+            generation_info = {
+                "finish_reason": finish_reason,
+                "token_usage": event.get("usage"),
+                "model_name": event.get("model", ""),
+            }
+        chunk = ChatGenerationChunk(
+            message=_convert_delta_to_message_chunk(choice["delta"], AIMessageChunk),
+            generation_info=generation_info,
+        )
+        if run_manager:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        return chunk
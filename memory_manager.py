@@ -1,38 +1,205 @@
 """Long-term and short-term memory management for GLM agents."""
+import asyncio
+import atexit
+import functools
+import gzip
 import json
+import math
 import os
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from datetime import datetime
-from typing import Optional, Dict, List, Any
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Any, Iterable, Iterator, Union
+from langchain_core.messages import BaseMessage
+from memory_storage import (
+    MemoryStorage,
+    WriteBehindStorage,
+    create_storage,
+    scan_context_expiry,
+    to_timestamp,
+)
+from history_search import HistorySearchIndex, tokenize
+from memory_rollup import MemoryRollups, RollupJob
+from profile_analytics import ProfileAnalytics
+from short_term_memory import ShortTermBuffer, ShortTermMessage
+from token_counter import estimate_tokens
+
+
+# Marker in the first line of a streaming (header + NDJSON history) export
+NDJSON_EXPORT_FORMAT = "mac-agent-memory-ndjson"
+
+CONTEXT_EVICTION_POLICIES = ("lru", "lfu")
+
+_MISSING = object()
+
+# Worker threads shared by the async methods of all managers
+IO_WORKERS = 8
+_io_executor: Optional[ThreadPoolExecutor] = None
+_io_executor_lock = threading.Lock()
+
+
+def _default_io_executor() -> ThreadPoolExecutor:
+    """Return the shared memory I/O executor, creating it on first use."""
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="memory-io")
+        return _io_executor
+
+
+# Managers whose buffered context access stats are written out at exit
+_live_managers: "weakref.WeakSet[MemoryManager]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_live_managers() -> None:
+    for manager in list(_live_managers):
+        try:
+            manager.flush()
+        except Exception:
+            pass
 
 
 class MemoryManager:
-    """Manages both short-term (session) and long-term (persistent) memory."""
+    """Manages both short-term (session) and long-term (persistent) memory.
     
-    def __init__(self, memory_dir: Optional[str] = None):
+    Long-term memory methods block on file or database I/O. Their async
+    counterparts (``aget_context``, ``asave_preferences``,
+    ``aget_memory_summary``, ...) run the same code on an I/O executor so an
+    event loop is never stalled. They run on executor threads and therefore
+    do not join a transaction() opened by the calling thread.
+    """
+    
+    def __init__(
+        self,
+        memory_dir: Optional[str] = None,
+        backend: Union[str, MemoryStorage, None] = None,
+        storage_options: Optional[Dict[str, Any]] = None,
+        write_delay: Optional[float] = None,
+        short_term_max_messages: Optional[int] = 200,
+        short_term_max_tokens: Optional[int] = None,
+        summary_token_budget: Optional[int] = 800,
+        context_max_keys: Optional[int] = None,
+        context_eviction: str = "lru",
+        io_executor: Optional[Executor] = None,
+    ):
         """Initialize memory manager.
         
         Args:
             memory_dir: Directory to store long-term memories (defaults to .memories/)
+            backend: Storage backend name ("json" or "sqlite") or instance (defaults to "json")
+            storage_options: Extra backend options, e.g. {"compress_segments": True} for json
+            write_delay: If set, buffer writes and flush them in the background
+                this many seconds later (see flush()); None writes synchronously
+            short_term_max_messages: Cap on session messages kept (None for no limit)
+            short_term_max_tokens: Cap on estimated session tokens kept (None for no limit)
+            summary_token_budget: Default token budget of get_memory_summary() (None for no limit)
+            context_max_keys: Maximum number of context keys kept (None for no limit)
+            context_eviction: Which keys to drop past context_max_keys: "lru"
+                (least recently accessed) or "lfu" (least often accessed)
+            io_executor: Executor running the async methods (defaults to a
+                thread pool shared by all managers)
         """
+        if context_eviction not in CONTEXT_EVICTION_POLICIES:
+            raise ValueError(f"Unknown context eviction policy: {context_eviction}")
         if memory_dir is None:
             memory_dir = Path(__file__).parent / ".memories"
         
         self.memory_dir = Path(memory_dir)
         self.memory_dir.mkdir(exist_ok=True)
         
-        # Short-term memory (current session)
+        # Short-term memory (current session), bounded so long sessions stay small
         self.short_term: Dict[str, Any] = {
-            "messages": [],
+            "messages": ShortTermBuffer(short_term_max_messages, short_term_max_tokens),
             "context": {},
             "created_at": datetime.now().isoformat(),
         }
         
-        # Long-term memory files paths
-        self.preferences_file = self.memory_dir / "preferences.json"
-        self.context_file = self.memory_dir / "context.json"
-        self.history_file = self.memory_dir / "history.json"
+        # Long-term memory storage
+        if isinstance(backend, MemoryStorage):
+            self.storage = backend
+        else:
+            self.storage = create_storage(self.memory_dir, backend, **(storage_options or {}))
+        if write_delay is not None:
+            self.storage = WriteBehindStorage(self.storage, write_delay)
+        
+        # Memoized get_memory_summary() result, keyed on storage.change_token()
+        # and valid until the next context TTL expiry
+        self._summary_cache: Optional[tuple] = None
+        
+        # Pre-tokenized preference/context items for get_relevant_memory(),
+        # keyed on storage.sections_token() so history appends keep it valid
+        self._items_cache: Optional[tuple] = None
+        
+        # Full-text index over history, loaded on first search
+        self._search_index: Optional[HistorySearchIndex] = None
+        self._search_index_lock = threading.Lock()
+        
+        # Day/week/month history rollups, refreshed by update_rollups() or a RollupJob
+        self.summary_token_budget = summary_token_budget
+        self.rollups = MemoryRollups(self.storage, self.memory_dir / f"rollups.{self.storage.name}.json")
+        self._rollup_job: Optional[RollupJob] = None
+        
+        # Checkpointed usage statistics, see get_profile_stats()
+        self.analytics = ProfileAnalytics(self.storage, self.memory_dir / f"analytics.{self.storage.name}.json")
+        
+        # Per-thread updates buffered by an open transaction()
+        self._transaction = threading.local()
+        
+        # Context bounds; per-key TTLs and access stats live in the context_meta section
+        self.context_max_keys = context_max_keys
+        self.context_eviction = context_eviction
+        # Context reads not yet written to context_meta: key -> (last_access, hits).
+        # Reads stay a dict lookup; the stats are persisted on flush(), by the
+        # background job, before eviction and with the next context save.
+        self._context_access: Dict[str, tuple] = {}
+        self._context_access_lock = threading.Lock()
+        # Memoized (expired keys, next expiry), keyed on storage.sections_token():
+        # expires_at is only written together with its context value
+        self._expiry_cache: Optional[tuple] = None
+        
+        self.io_executor = io_executor
+        _live_managers.add(self)
+    
+    def flush(self) -> None:
+        """Write any buffered long-term memory changes to disk now."""
+        self._persist_context_access()
+        self.storage.flush()
+    
+    def close(self) -> None:
+        """Flush buffered changes and release the storage backend."""
+        self.flush()
+        _live_managers.discard(self)
+        self.storage.close()
+    
+    @contextmanager
+    def transaction(self) -> Iterator["MemoryManager"]:
+        """Group preference and context saves into one atomic write.
+        
+        Saves made inside the block are buffered and written with a single
+        read and write per section when the block exits; if the block raises,
+        nothing is written. Nested transactions join the outermost one.
+        Reads inside the block still return the stored values.
+        
+        Example:
+            with memory.transaction():
+                memory.save_preference("language", "Chinese")
+                memory.save_context("project", "AI Assistant")
+        """
+        if getattr(self._transaction, "pending", None) is not None:
+            yield self
+            return
+        self._transaction.pending = {"preferences": {}, "context": {}, "context_meta": {}}
+        try:
+            yield self
+            pending = self._transaction.pending
+        finally:
+            self._transaction.pending = None
+        self._write_sections(pending)
     
     def save_preference(self, key: str, value: Any) -> None:
         """Save a user preference to long-term memory.
@@ -41,10 +208,15 @@ class MemoryManager:
             key: Preference key
             value: Preference value
         """
-        preferences = self._load_json(self.preferences_file)
-        preferences[key] = value
-        preferences["updated_at"] = datetime.now().isoformat()
-        self._save_json(self.preferences_file, preferences)
+        self.save_preferences({key: value})
+    
+    def save_preferences(self, items: Dict[str, Any]) -> None:
+        """Save several preferences with one read and one write.
+        
+        Args:
+            items: Preference keys and values
+        """
+        self._save_section("preferences", items)
     
     def get_preference(self, key: str, default: Any = None) -> Any:
         """Retrieve a preference from long-term memory.
@@ -56,20 +228,156 @@ class MemoryManager:
         Returns:
             Preference value or default
         """
-        preferences = self._load_json(self.preferences_file)
-        return preferences.get(key, default)
+        return self.storage.get("preferences", key, default)
     
-    def save_context(self, key: str, value: Any) -> None:
+    def save_context(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
         """Save context information to long-term memory.
         
         Args:
             key: Context key
             value: Context value
+            ttl: Seconds until the key expires (None keeps it until evicted)
+        """
+        self.save_contexts({key: value}, ttl=ttl)
+    
+    def save_contexts(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        """Save several context entries with one read and one write.
+        
+        Args:
+            items: Context keys and values
+            ttl: Seconds until these keys expire (None keeps them until evicted)
+        """
+        expires_at = (datetime.now() + timedelta(seconds=ttl)).isoformat() if ttl else None
+        self._save_section("context", items, meta={key: {"expires_at": expires_at} for key in items})
+    
+    def _save_section(self, section: str, items: Dict[str, Any], meta: Optional[Dict[str, Dict]] = None) -> None:
+        pending = getattr(self._transaction, "pending", None)
+        if pending is not None:
+            pending[section].update(items)
+            pending["context_meta"].update(meta or {})
+        else:
+            self._write_sections({section: dict(items), "context_meta": meta or {}})
+    
+    def _write_sections(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        """Stamp each non-empty section with updated_at and store them together."""
+        now = datetime.now().isoformat()
+        meta = updates.get("context_meta")
+        stamped = {
+            section: {**items, "updated_at": now}
+            for section, items in updates.items() if items and section != "context_meta"
+        }
+        if meta:
+            existing = self.storage.get_all("context_meta")
+            accessed = self._drain_context_access(existing)
+            # A save counts as an access
+            stamped["context_meta"] = {
+                **accessed,
+                **{
+                    key: {
+                        **accessed.get(key, existing.get(key, {})),
+                        **entry,
+                        "last_access": now,
+                        "hits": accessed.get(key, existing.get(key, {})).get("hits", 0) + 1,
+                    }
+                    for key, entry in meta.items()
+                },
+            }
+        if stamped:
+            self.storage.set_sections(stamped)
+        if "context" in stamped and self.context_max_keys is not None:
+            self.evict_context(keep=stamped["context"])
+    
+    def evict_context(self, keep: Iterable[str] = ()) -> List[str]:
+        """Drop expired context keys, then the least used past context_max_keys.
+        
+        Runs automatically after context saves when context_max_keys is set,
+        and with the background rollup job.
+        
+        Args:
+            keep: Keys never chosen for capacity eviction (e.g. ones just saved)
+        
+        Returns:
+            Evicted keys
+        """
+        self._persist_context_access()
+        context = self.storage.get_all("context")
+        meta = self.storage.get_all("context_meta")
+        keys = [key for key in context if key != "updated_at"]
+        evicted = set(self._expired_context_keys(meta)) & set(keys)
+        
+        remaining = [key for key in keys if key not in evicted]
+        if self.context_max_keys is not None and len(remaining) > self.context_max_keys:
+            def usage(key: str) -> tuple:
+                entry = meta.get(key, {})
+                last_access = entry.get("last_access", "")
+                if self.context_eviction == "lfu":
+                    return (entry.get("hits", 0), last_access)
+                return (last_access,)
+            excess = len(remaining) - self.context_max_keys
+            candidates = sorted((key for key in remaining if key not in keep), key=usage)
+            evicted.update(candidates[:excess])
+        
+        if evicted:
+            self.storage.delete("context", evicted)
+        orphaned = evicted | (set(meta) - set(keys))
+        if orphaned:
+            self.storage.delete("context_meta", orphaned)
+        return sorted(evicted)
+    
+    def _expired_context_keys(self, meta: Optional[Dict[str, Dict]] = None) -> frozenset:
+        """Return context keys whose TTL has passed."""
+        return self._context_expiry(meta)[0]
+    
+    def _context_expiry(self, meta: Optional[Dict[str, Dict]] = None) -> tuple:
+        """Return (expired context keys, earliest future expiry or None).
+        
+        Without meta the result is memoized until the context changes or the
+        next expiry passes.
         """
-        context = self._load_json(self.context_file)
-        context[key] = value
-        context["updated_at"] = datetime.now().isoformat()
-        self._save_json(self.context_file, context)
+        now = datetime.now().isoformat()
+        if meta is not None:
+            return scan_context_expiry(meta, now)
+        cache_key = (self.storage.sections_token(),)
+        cache = self._expiry_cache
+        if self._cache_valid(cache, cache_key):
+            return cache[1]
+        expiry = self.storage.context_expiry(now)
+        self._expiry_cache = (cache_key, expiry, expiry[1])
+        return expiry
+    
+    def _context_key_expired(self, key: str) -> bool:
+        """Check one context key's TTL without loading the others."""
+        entry = self.storage.get("context_meta", key) or {}
+        expires_at = entry.get("expires_at")
+        return bool(expires_at) and expires_at <= datetime.now().isoformat()
+    
+    def _touch_context(self, keys: Iterable[str]) -> None:
+        """Record an access to context keys (for LRU/LFU eviction), in memory only."""
+        keys = list(keys)
+        if not keys:
+            return
+        now = datetime.now().isoformat()
+        with self._context_access_lock:
+            for key in keys:
+                hits = self._context_access.get(key, (None, 0))[1]
+                self._context_access[key] = (now, hits + 1)
+    
+    def _drain_context_access(self, meta: Dict[str, Dict]) -> Dict[str, Dict]:
+        """Take the buffered context accesses, merged into their context_meta entries."""
+        with self._context_access_lock:
+            accessed, self._context_access = self._context_access, {}
+        return {
+            key: {**meta.get(key, {}), "last_access": last_access, "hits": meta.get(key, {}).get("hits", 0) + hits}
+            for key, (last_access, hits) in accessed.items()
+        }
+    
+    def _persist_context_access(self) -> None:
+        """Write buffered context access stats to context_meta."""
+        if not self._context_access:
+            return
+        accessed = self._drain_context_access(self.storage.get_all("context_meta"))
+        if accessed:
+            self.storage.set_many("context_meta", accessed)
     
     def get_context(self, key: str, default: Any = None) -> Any:
         """Retrieve context from long-term memory.
@@ -79,14 +387,20 @@ class MemoryManager:
             default: Default value if not found
             
         Returns:
-            Context value or default
+            Context value or default (also for expired keys)
         """
-        context = self._load_json(self.context_file)
-        return context.get(key, default)
+        if self._context_key_expired(key):
+            return default
+        value = self.storage.get("context", key, _MISSING)
+        if value is _MISSING:
+            return default
+        self._touch_context([key])
+        return value
     
     def get_all_context(self) -> Dict[str, Any]:
-        """Get all context information."""
-        return self._load_json(self.context_file)
+        """Get all unexpired context information (does not count as an access)."""
+        expired = self._expired_context_keys()
+        return {k: v for k, v in self.storage.get_all("context").items() if k not in expired}
     
     def add_to_history(self, role: str, content: str, metadata: Optional[Dict] = None) -> None:
         """Add message to long-term conversation history.
@@ -96,12 +410,6 @@ class MemoryManager:
             content: Message content
             metadata: Optional metadata
         """
-        if self.history_file.exists():
-            with open(self.history_file, "r") as f:
-                history = json.load(f)
-        else:
-            history = []
-        
         entry = {
             "timestamp": datetime.now().isoformat(),
             "role": role,
@@ -110,120 +418,505 @@ class MemoryManager:
         if metadata:
             entry["metadata"] = metadata
         
-        history.append(entry)
-        with open(self.history_file, "w") as f:
-            json.dump(history, f, indent=2)
+        self.storage.append_history([entry])
     
-    def get_history(self, limit: Optional[int] = None) -> List[Dict]:
+    def add_history_entries(self, entries: List[Dict]) -> None:
+        """Add several messages to long-term history in one write.
+        
+        Args:
+            entries: Dicts with "role", "content" and optional "metadata"
+        """
+        timestamp = datetime.now().isoformat()
+        batch = []
+        for item in entries:
+            entry = {
+                "timestamp": item.get("timestamp", timestamp),
+                "role": item["role"],
+                "content": item["content"],
+            }
+            if item.get("metadata"):
+                entry["metadata"] = item["metadata"]
+            batch.append(entry)
+        self.storage.append_history(batch)
+    
+    def get_history(
+        self,
+        limit: Optional[int] = None,
+        since: Union[str, datetime, None] = None,
+        until: Union[str, datetime, None] = None,
+    ) -> List[Dict]:
         """Retrieve conversation history.
         
         Args:
-            limit: Maximum number of entries to return
+            limit: Maximum number of entries to return (the most recent ones)
+            since: Only return entries at or after this time
+            until: Only return entries at or before this time
             
         Returns:
             List of history entries
         """
-        if self.history_file.exists():
-            with open(self.history_file, "r") as f:
-                history = json.load(f)
-        else:
-            history = []
-        
+        if since or until:
+            entries = self.storage.history_between(to_timestamp(since), to_timestamp(until))
+            if limit:
+                return list(deque(entries, maxlen=limit))
+            return list(entries)
         if limit:
-            return history[-limit:]
-        return history
+            return self.storage.tail_history(limit)
+        return list(self.storage.iter_history())
+    
+    def search_history(
+        self,
+        query: str,
+        limit: int = 10,
+        since: Union[str, datetime, None] = None,
+    ) -> List[Dict]:
+        """Full-text search over long-term history, ranked with BM25.
+        
+        Latin text is matched by word and Chinese/Japanese/Korean text by
+        character bigrams. The index is updated incrementally with entries
+        added since the previous search.
+        
+        Args:
+            query: Search text, e.g. "三体"
+            limit: Maximum number of results
+            since: Only return entries at or after this time
+            
+        Returns:
+            Matching history entries, best first, each with a "score" key
+        """
+        with self._search_index_lock:
+            if self._search_index is None:
+                index_file = self.memory_dir / f"search_index.{self.storage.name}.json"
+                self._search_index = HistorySearchIndex(index_file)
+        self._search_index.sync(self.storage)
+        
+        ranked = self._search_index.search(query, limit=limit, since=to_timestamp(since))
+        entries = self.storage.history_at(position for position, _ in ranked)
+        return [
+            dict(entries[position], score=round(score, 4))
+            for position, score in ranked
+            if position in entries
+        ]
     
     def clear_short_term_memory(self) -> None:
         """Clear short-term memory (messages for current session)."""
-        self.short_term["messages"] = []
+        self.short_term["messages"].clear()
         self.short_term["context"] = {}
     
     def add_short_term_message(self, message: BaseMessage) -> None:
-        """Add message to short-term memory.
+        """Add message to short-term memory, evicting the oldest past the cap.
         
         Args:
             message: LangChain message object
         """
-        msg_dict = {
-            "role": "user" if isinstance(message, HumanMessage) else "assistant",
-            "content": message.content,
-            "type": type(message).__name__,
-        }
-        self.short_term["messages"].append(msg_dict)
+        self.short_term["messages"].append(ShortTermMessage.from_message(message))
     
     def get_short_term_messages(self) -> List[Dict]:
-        """Get all short-term messages."""
-        return self.short_term["messages"]
+        """Get the retained short-term messages as dicts, oldest first."""
+        return self.short_term["messages"].to_dicts()
+    
+    def get_short_term_rollup(self) -> str:
+        """Get a one-line digest of session turns evicted from short-term memory."""
+        return self.short_term["messages"].rollup()
+    
+    def update_rollups(self) -> int:
+        """Fold new history into the day/week/month rollups now.
+        
+        Returns:
+            Number of newly processed history entries
+        """
+        return self.rollups.update()
+    
+    def start_rollup_job(self, interval: float = 600.0) -> None:
+        """Refresh rollups and analytics and evict context on a background thread."""
+        if self._rollup_job is None:
+            self._rollup_job = RollupJob(self._maintain, interval)
+        self._rollup_job.start()
+    
+    def _maintain(self) -> None:
+        self.update_rollups()
+        self.analytics.update()
+        self.evict_context()
+    
+    def get_profile_stats(self, top_k: int = 3) -> Dict[str, Any]:
+        """Get usage statistics derived from the conversation history.
+        
+        Only history added since the previous call is read; see
+        ProfileAnalytics for the available fields.
+        
+        Args:
+            top_k: Number of most repeated user messages to include
+            
+        Returns:
+            Dict of statistics (message counts, top messages, searches, sessions)
+        """
+        self.analytics.update()
+        return self.analytics.profile(top_k=top_k)
     
-    def get_memory_summary(self) -> str:
+    def stop_rollup_job(self) -> None:
+        """Stop the background rollup thread, if running."""
+        if self._rollup_job is not None:
+            self._rollup_job.stop()
+    
+    def get_memory_summary(self, token_budget: Optional[int] = None) -> str:
         """Get a summary of long-term memory for system prompt injection.
         
+        Items are added in priority order (preferences, current context,
+        history rollups newest first, then the names of stale context keys)
+        until the token budget is used, so the summary stays the same size
+        however much memory accumulates. The rendered summary is memoized and
+        only rebuilt when the storage or the rollups change.
+        
+        Args:
+            token_budget: Maximum estimated tokens (defaults to summary_token_budget)
+        
         Returns:
             Formatted string with memory information
         """
-        preferences = self._load_json(self.preferences_file)
-        context = self._load_json(self.context_file)
-        history_len = len(self._load_json(self.history_file))
+        token_budget = token_budget if token_budget is not None else self.summary_token_budget
+        token = self.storage.change_token()
+        cache_key = (token, self.rollups.version(), token_budget)
+        if self._cache_valid(self._summary_cache, cache_key):
+            return self._summary_cache[1]
         
-        summary = "## Your Long-Term Memory\n\n"
+        expired, next_expiry = self._context_expiry()
+        preferences = self.storage.get_all("preferences")
+        context = {k: v for k, v in self.storage.get_all("context").items() if k not in expired}
+        stale = set(self.rollups.stale_context_keys())
         
-        if preferences:
-            summary += "### User Preferences\n"
-            for key, value in preferences.items():
-                if key != "updated_at":
-                    summary += f"- {key}: {value}\n"
-            summary += "\n"
+        header = "## Your Long-Term Memory\n\n"
+        total = f"- Total messages: {self.storage.history_count()}\n"
+        headings = {
+            "preferences": "### User Preferences\n",
+            "context": "### Context Information\n",
+            "history": "### Conversation History\n",
+            "stale": "### Older Context\n",
+        }
+        candidates = [
+            ("preferences", f"- {key}: {value}\n")
+            for key, value in preferences.items() if key != "updated_at"
+        ]
+        candidates += [
+            ("context", f"- {key}: {value}\n")
+            for key, value in context.items() if key != "updated_at" and key not in stale
+        ]
+        candidates += [("history", MemoryRollups.render(bucket)) for bucket in self.rollups.rollups()]
+        stale_keys = [key for key in context if key in stale]
+        if stale_keys:
+            candidates.append(("stale", f"- {', '.join(stale_keys)}\n"))
         
-        if context:
-            summary += "### Context Information\n"
-            for key, value in context.items():
-                if key != "updated_at":
-                    summary += f"- {key}: {value}\n"
-            summary += "\n"
+        # The header and message count are always shown
+        selected: Dict[str, List[str]] = {section: [] for section in headings}
+        selected["history"].append(total)
+        used = estimate_tokens(header + headings["history"] + total)
+        for section, line in candidates:
+            cost = estimate_tokens(line)
+            if not selected[section]:
+                cost += estimate_tokens(headings[section] + "\n")
+            if token_budget is not None and used + cost > token_budget:
+                continue
+            selected[section].append(line)
+            used += cost
         
-        summary += f"### Conversation History\n- Total messages: {history_len}\n"
+        summary = header
+        for section in ("preferences", "context", "stale", "history"):
+            if selected[section]:
+                summary += headings[section] + "".join(selected[section])
+                if section != "history":
+                    summary += "\n"
         
+        self._summary_cache = (cache_key, summary, next_expiry)
         return summary
     
-    def export_long_term_memory(self, filepath: str) -> None:
-        """Export long-term memory to JSON file.
+    def get_relevant_memory(
+        self,
+        query: str,
+        top_k: int = 8,
+        token_budget: int = 400,
+    ) -> str:
+        """Get only the memory items relevant to a query for prompt injection.
+        
+        Preference and context items, plus history rollups, are scored
+        against the query with BM25 over their text. The best items are
+        rendered until either top_k items or token_budget estimated tokens
+        are used. Preferences stay eligible even without a match, since they
+        usually apply to every answer (e.g. language).
         
         Args:
-            filepath: Path to export file
+            query: Current user turn
+            top_k: Maximum number of memory items to include
+            token_budget: Maximum estimated tokens for the rendered block
+            
+        Returns:
+            Formatted string with the selected memory items
         """
-        export_data = {
-            "preferences": self._load_json(self.preferences_file),
-            "context": self._load_json(self.context_file),
-            "history": self._load_json(self.history_file),
-            "exported_at": datetime.now().isoformat(),
+        items = self._memory_items()
+        query_terms = set(tokenize(query))
+        
+        total = len(items) or 1
+        avg_length = sum(len(item["terms"]) for item in items) / total or 1.0
+        doc_freq: Dict[str, int] = {}
+        for item in items:
+            for term in query_terms & item["term_set"]:
+                doc_freq[term] = doc_freq.get(term, 0) + 1
+        
+        scored = []
+        for item in items:
+            score = 0.0
+            length_norm = 1.5 * (0.25 + 0.75 * len(item["terms"]) / avg_length)
+            for term in query_terms & item["term_set"]:
+                tf = item["terms"].count(term)
+                idf = math.log(1 + (total - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                score += idf * tf * 2.5 / (tf + length_norm)
+            if score > 0 or item["section"] == "preferences":
+                scored.append((score, item["section"] == "preferences", item))
+        scored.sort(key=lambda entry: (entry[0], entry[1]), reverse=True)
+        
+        header = "## Your Long-Term Memory\n\n"
+        footer = f"### Conversation History\n- Total messages: {self.storage.history_count()}\n"
+        used = estimate_tokens(header) + estimate_tokens(footer)
+        headings = {
+            "preferences": "### User Preferences\n",
+            "context": "### Relevant Context\n",
+            "history": "### Earlier Conversations\n",
         }
-        with open(filepath, "w") as f:
-            json.dump(export_data, f, indent=2)
+        selected: Dict[str, List[str]] = {section: [] for section in headings}
+        touched: List[str] = []
+        count = 0
+        for _, _, item in scored:
+            if count >= top_k:
+                break
+            cost = item["tokens"]
+            if not selected[item["section"]]:
+                cost += estimate_tokens(headings[item["section"]] + "\n")
+            if used + cost > token_budget:
+                continue
+            selected[item["section"]].append(item["line"])
+            if item["section"] == "context":
+                touched.append(item["key"])
+            used += cost
+            count += 1
+        self._touch_context(touched)
+        
+        summary = header
+        for section in headings:
+            if selected[section]:
+                summary += headings[section] + "".join(selected[section]) + "\n"
+        return summary + footer
+    
+    def _memory_items(self) -> List[Dict[str, Any]]:
+        """Return memory items with rendered lines and terms, cached."""
+        token = self.storage.sections_token()
+        cache_key = (token, self.rollups.version())
+        if self._cache_valid(self._items_cache, cache_key):
+            return self._items_cache[1]
+        
+        expired, next_expiry = self._context_expiry()
+        lines = []
+        for section in ("preferences", "context"):
+            for key, value in self.storage.get_all(section).items():
+                if key == "updated_at" or (section == "context" and key in expired):
+                    continue
+                text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+                lines.append((section, key, f"- {key}: {text}\n", f"{key.replace('_', ' ')} {text}"))
+        for bucket in self.rollups.rollups():
+            text = " ".join(list(bucket["terms"]) + list(bucket["snippets"]))
+            lines.append(("history", None, MemoryRollups.render(bucket), text))
+        
+        items = []
+        for section, key, line, text in lines:
+            terms = tokenize(text)
+            items.append({
+                "section": section,
+                "key": key,
+                "line": line,
+                "terms": terms,
+                "term_set": set(terms),
+                "tokens": estimate_tokens(line),
+            })
+        self._items_cache = (cache_key, items, next_expiry)
+        return items
+    
+    @staticmethod
+    def _cache_valid(cache: Optional[tuple], cache_key: tuple) -> bool:
+        """Check a (key, value, next_expiry) cache entry against the current key and clock."""
+        if cache_key[0] is None or not cache or cache[0] != cache_key:
+            return False
+        return cache[2] is None or datetime.now().isoformat() < cache[2]
+    
+    async def _run_io(self, func, *args, **kwargs) -> Any:
+        """Run a blocking memory call on the I/O executor."""
+        loop = asyncio.get_running_loop()
+        executor = self.io_executor or _default_io_executor()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    
+    async def aflush(self) -> None:
+        """Async version of flush."""
+        await self._run_io(self.flush)
+    
+    async def asave_preference(self, key: str, value: Any) -> None:
+        """Async version of save_preference."""
+        await self._run_io(self.save_preference, key, value)
+    
+    async def asave_preferences(self, items: Dict[str, Any]) -> None:
+        """Async version of save_preferences."""
+        await self._run_io(self.save_preferences, items)
+    
+    async def aget_preference(self, key: str, default: Any = None) -> Any:
+        """Async version of get_preference."""
+        return await self._run_io(self.get_preference, key, default)
+    
+    async def asave_context(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Async version of save_context."""
+        await self._run_io(self.save_context, key, value, ttl)
+    
+    async def asave_contexts(self, items: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        """Async version of save_contexts."""
+        await self._run_io(self.save_contexts, items, ttl)
+    
+    async def aget_context(self, key: str, default: Any = None) -> Any:
+        """Async version of get_context."""
+        return await self._run_io(self.get_context, key, default)
+    
+    async def aget_all_context(self) -> Dict[str, Any]:
+        """Async version of get_all_context."""
+        return await self._run_io(self.get_all_context)
+    
+    async def aadd_to_history(self, role: str, content: str, metadata: Optional[Dict] = None) -> None:
+        """Async version of add_to_history."""
+        await self._run_io(self.add_to_history, role, content, metadata)
+    
+    async def aadd_history_entries(self, entries: List[Dict]) -> None:
+        """Async version of add_history_entries."""
+        await self._run_io(self.add_history_entries, entries)
+    
+    async def aget_history(
+        self,
+        limit: Optional[int] = None,
+        since: Union[str, datetime, None] = None,
+        until: Union[str, datetime, None] = None,
+    ) -> List[Dict]:
+        """Async version of get_history."""
+        return await self._run_io(self.get_history, limit, since, until)
+    
+    async def asearch_history(
+        self,
+        query: str,
+        limit: int = 10,
+        since: Union[str, datetime, None] = None,
+    ) -> List[Dict]:
+        """Async version of search_history."""
+        return await self._run_io(self.search_history, query, limit, since)
+    
+    async def aget_memory_summary(self, token_budget: Optional[int] = None) -> str:
+        """Async version of get_memory_summary."""
+        return await self._run_io(self.get_memory_summary, token_budget)
+    
+    async def aget_relevant_memory(self, query: str, top_k: int = 8, token_budget: int = 400) -> str:
+        """Async version of get_relevant_memory."""
+        return await self._run_io(self.get_relevant_memory, query, top_k, token_budget)
+    
+    async def aget_profile_stats(self, top_k: int = 3) -> Dict[str, Any]:
+        """Async version of get_profile_stats."""
+        return await self._run_io(self.get_profile_stats, top_k)
+    
+    def export_long_term_memory(self, filepath: str, format: Optional[str] = None) -> None:
+        """Export long-term memory to a file.
+        
+        The "json" format writes one JSON document. The "ndjson" format
+        streams a header line (preferences, context and its TTL/access
+        bookkeeping) followed by one line per history entry, so memory use stays constant however large the
+        history is. Paths ending in .gz are gzip-compressed.
+        
+        Args:
+            filepath: Path to export file
+            format: "json" or "ndjson" (defaults to ndjson for .ndjson/.jsonl
+                paths, json otherwise)
+        """
+        format = format or self._export_format(filepath)
+        if format not in ("json", "ndjson"):
+            raise ValueError(f"Unknown export format: {format}")
+        self._persist_context_access()
+        
+        with self._open_export(filepath, "w") as f:
+            if format == "json":
+                export_data = {
+                    "preferences": self.storage.get_all("preferences"),
+                    "context": self.storage.get_all("context"),
+                    "context_meta": self.storage.get_all("context_meta"),
+                    "history": self.get_history(),
+                    "exported_at": datetime.now().isoformat(),
+                }
+                json.dump(export_data, f, indent=2)
+                return
+            
+            header = {
+                "format": NDJSON_EXPORT_FORMAT,
+                "version": 1,
+                "exported_at": datetime.now().isoformat(),
+                "preferences": self.storage.get_all("preferences"),
+                "context": self.storage.get_all("context"),
+                "context_meta": self.storage.get_all("context_meta"),
+            }
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for entry in self.storage.iter_history():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
     
     def import_long_term_memory(self, filepath: str) -> None:
-        """Import long-term memory from JSON file.
+        """Import long-term memory from a json or ndjson export.
+        
+        The format is detected from the file contents. ndjson history is
+        streamed into storage entry by entry. History is replaced first and
+        atomically, so a damaged export raises without touching the live
+        memory. Imported context takes the TTLs and access stats of the
+        export (none for exports made before they were included).
         
         Args:
             filepath: Path to import file
         """
-        with open(filepath, "r") as f:
-            data = json.load(f)
-        
-        if "preferences" in data:
-            self._save_json(self.preferences_file, data["preferences"])
-        if "context" in data:
-            self._save_json(self.context_file, data["context"])
-        if "history" in data:
-            self._save_json(self.history_file, data["history"])
-    
-    def _load_json(self, filepath: Path) -> Dict:
-        """Load JSON file, return empty dict if not exists."""
-        if filepath.exists():
-            with open(filepath, "r") as f:
-                return json.load(f)
-        return {}
-    
-    def _save_json(self, filepath: Path, data: Dict) -> None:
-        """Save JSON file."""
-        with open(filepath, "w") as f:
-            json.dump(data, f, indent=2)
+        with self._open_export(filepath, "r") as f:
+            first_line = f.readline()
+            try:
+                header = json.loads(first_line)
+            except json.JSONDecodeError:
+                header = None
+            
+            if not (isinstance(header, dict) and header.get("format") == NDJSON_EXPORT_FORMAT):
+                f.seek(0)
+                data = json.load(f)
+                if "preferences" in data:
+                    self.storage.replace("preferences", data["preferences"])
+                if "context" in data:
+                    self._replace_context(data["context"], data.get("context_meta", {}))
+                if "history" in data:
+                    self.storage.replace_history(data["history"])
+                return
+            
+            self.storage.replace_history(
+                json.loads(line) for line in f if line.strip()
+            )
+            self.storage.replace("preferences", header.get("preferences", {}))
+            self._replace_context(header.get("context", {}), header.get("context_meta", {}))
+    
+    def _replace_context(self, context: Dict[str, Any], meta: Dict[str, Dict]) -> None:
+        """Replace the context together with its TTLs and access stats."""
+        # Buffered accesses belong to the context being replaced
+        with self._context_access_lock:
+            self._context_access = {}
+        self.storage.replace("context_meta", meta)
+        self.storage.replace("context", context)
+    
+    @staticmethod
+    def _export_format(filepath: str) -> str:
+        """Pick the export format from the file name."""
+        name = str(filepath)
+        if name.endswith(".gz"):
+            name = name[:-3]
+        return "ndjson" if name.endswith((".ndjson", ".jsonl")) else "json"
+    
+    @staticmethod
+    def _open_export(filepath: str, mode: str):
+        """Open an export file as text, transparently handling .gz."""
+        if str(filepath).endswith(".gz"):
+            return gzip.open(filepath, mode + "t", encoding="utf-8")
+        return open(filepath, mode, encoding="utf-8")
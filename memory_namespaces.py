@@ -0,0 +1,123 @@
+"""Per-user / per-session long-term memory namespaces."""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from memory_manager import MemoryManager
+
+
+_SAFE_NAME_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
+
+
+class MemoryNamespaces:
+    """Lazily opened MemoryManagers, one directory per namespace.
+
+    Each namespace (a user or session id) gets its own memory directory under
+    ``root_dir``, so namespaces never share files or locks. At most
+    ``max_open`` managers are kept open; the least recently used idle one is
+    flushed and closed when another namespace is opened. Managers in use
+    inside ``session()`` are never closed.
+    """
+
+    def __init__(self, root_dir: Path, max_open: int = 64, **manager_options: Any):
+        """Initialize the namespace registry.
+
+        Args:
+            root_dir: Directory holding one subdirectory per namespace
+            max_open: Maximum number of idle managers kept open
+            **manager_options: Keyword arguments for each MemoryManager
+        """
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.max_open = max_open
+        self.manager_options = manager_options
+        self._lock = threading.Lock()
+        self._open: "OrderedDict[str, MemoryManager]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+
+    def get(self, namespace: str) -> MemoryManager:
+        """Return the manager for a namespace, opening it if needed.
+
+        The manager may be closed later to make room for other namespaces;
+        use session() to hold on to it across calls.
+        """
+        with self._lock:
+            memory, evicted = self._acquire(namespace)
+        self._close(evicted)
+        return memory
+
+    @contextmanager
+    def session(self, namespace: str) -> Iterator[MemoryManager]:
+        """Use a namespace's manager, keeping it open until the block exits.
+
+        Example:
+            with namespaces.session(user_id) as memory:
+                client.invoke(messages, memory=memory)
+        """
+        with self._lock:
+            memory, evicted = self._acquire(namespace)
+            self._pins[namespace] = self._pins.get(namespace, 0) + 1
+        self._close(evicted)
+        try:
+            yield memory
+        finally:
+            with self._lock:
+                self._pins[namespace] -= 1
+                if not self._pins[namespace]:
+                    del self._pins[namespace]
+                evicted = self._evict_idle()
+            self._close(evicted)
+
+    def open_namespaces(self) -> List[str]:
+        """Return the currently open namespaces, least recently used first."""
+        with self._lock:
+            return list(self._open)
+
+    def close(self) -> None:
+        """Flush and close every open manager."""
+        with self._lock:
+            evicted = list(self._open.values())
+            self._open.clear()
+        self._close(evicted)
+
+    def path_for(self, namespace: str) -> Path:
+        """Return the memory directory of a namespace.
+
+        Ids that are not plain file names (or are too long) are hashed, so
+        an id can never escape root_dir.
+        """
+        if not _SAFE_NAME_RE.match(namespace):
+            namespace = "ns-" + hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:32]
+        return self.root_dir / namespace
+
+    def _acquire(self, namespace: str) -> Tuple[MemoryManager, List[MemoryManager]]:
+        """Return an open manager plus the managers evicted for it (lock held)."""
+        memory = self._open.get(namespace)
+        if memory is None:
+            memory = MemoryManager(memory_dir=str(self.path_for(namespace)), **self.manager_options)
+            self._open[namespace] = memory
+        self._open.move_to_end(namespace)
+        return memory, self._evict_idle(keep=namespace)
+
+    def _evict_idle(self, keep: Optional[str] = None) -> List[MemoryManager]:
+        """Drop least recently used idle managers past max_open (lock held)."""
+        evicted = []
+        excess = len(self._open) - self.max_open
+        for name in list(self._open):
+            if excess <= 0:
+                break
+            if name in self._pins or name == keep:
+                continue
+            evicted.append(self._open.pop(name))
+            excess -= 1
+        return evicted
+
+    @staticmethod
+    def _close(managers: List[MemoryManager]) -> None:
+        """Flush and close managers outside the registry lock."""
+        for memory in managers:
+            memory.close()
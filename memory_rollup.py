@@ -0,0 +1,287 @@
+"""Hierarchical day/week/month rollups of long-term memory."""
+import copy
+import hashlib
+import json
+import os
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from file_lock import atomic_write_json
+from history_search import tokenize
+from memory_storage import MemoryStorage
+
+
+# Terms too common to describe what a period was about
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from how i in is it me my no not of ok on or "
+    "please so that the this to was what when where which who why with you your".split()
+)
+
+
+class MemoryRollups:
+    """Condenses history into day, week and month summaries.
+
+    ``update`` reads only history appended since the previous run. Each
+    entry is counted in a day bucket; days older than ``daily_days`` are
+    merged into ISO-week buckets and weeks older than ``weekly_weeks`` into
+    month buckets, so the rollup file stays small however long the history
+    grows. Context keys whose value has not changed for ``stale_days`` are
+    listed as stale so prompts can show them condensed.
+
+    Rollups are extractive (top terms and most repeated user messages), so
+    no model call is needed. They are persisted to a JSON file that readers
+    load through an mtime check.
+    """
+
+    VERSION = 1
+    MAX_TERMS = 30
+    MAX_SNIPPETS = 10
+    SNIPPET_CHARS = 40
+
+    def __init__(
+        self,
+        storage: MemoryStorage,
+        rollup_file: Path,
+        daily_days: int = 7,
+        weekly_weeks: int = 8,
+        stale_days: int = 30,
+    ):
+        """Initialize rollups.
+
+        Args:
+            storage: Storage backend holding the history and context
+            rollup_file: Where rollups are persisted
+            daily_days: Days kept at day granularity before merging into weeks
+            weekly_weeks: Weeks kept at week granularity before merging into months
+            stale_days: Days without change after which a context key is stale
+        """
+        self.storage = storage
+        self.rollup_file = Path(rollup_file)
+        self.daily_days = daily_days
+        self.weekly_weeks = weekly_weeks
+        self.stale_days = stale_days
+        self._update_lock = threading.Lock()
+        self._cache: Optional[tuple] = None
+
+    def update(self, today: Optional[date] = None) -> int:
+        """Fold new history into the rollups and re-level aged buckets.
+
+        Args:
+            today: Reference date for ageing (defaults to today)
+
+        Returns:
+            Number of newly processed history entries
+        """
+        today = today or date.today()
+        with self._update_lock:
+            state = copy.deepcopy(self._read())
+            generation = self.storage.history_generation()
+            count = self.storage.history_count()
+            if state["generation"] != generation or count < state["position"]:
+                state = self._empty_state()
+                state["generation"] = generation
+
+            buckets = {(b["level"], b["period"]): b for b in state["buckets"]}
+            added = 0
+            for entry in self.storage.iter_history_from(state["position"]):
+                self._add_entry(buckets, entry, today)
+                added += 1
+            state["position"] += added
+
+            for bucket in list(buckets.values()):
+                level, period = self._bucket_for(bucket["start"][:10], today)
+                if (level, period) != (bucket["level"], bucket["period"]):
+                    del buckets[(bucket["level"], bucket["period"])]
+                    self._merge(buckets, level, period, bucket)
+
+            for bucket in buckets.values():
+                bucket["terms"] = _top(bucket["terms"], self.MAX_TERMS)
+                bucket["snippets"] = _top(bucket["snippets"], self.MAX_SNIPPETS)
+            state["buckets"] = sorted(buckets.values(), key=lambda b: b["start"], reverse=True)
+            self._update_stale_context(state, today)
+            self._write(state)
+            return added
+
+    def rollups(self) -> List[Dict[str, Any]]:
+        """Return rollup buckets, most recent first."""
+        return self._read()["buckets"]
+
+    def stale_context_keys(self) -> List[str]:
+        """Return context keys that have not changed for stale_days."""
+        return self._read()["stale_context"]
+
+    def version(self) -> Any:
+        """Return a value that changes whenever the rollup file changes."""
+        try:
+            stat = os.stat(self.rollup_file)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def render(cls, bucket: Dict[str, Any]) -> str:
+        """Render one bucket as a single summary line."""
+        line = f"- {bucket['period']} ({bucket['level']}): {bucket['messages']} messages"
+        topics = list(bucket["terms"])[:5]
+        if topics:
+            line += "; topics: " + ", ".join(topics)
+        snippets = list(bucket["snippets"])[:2]
+        if snippets:
+            line += "; e.g. " + " / ".join(f"“{s}”" for s in snippets)
+        return line + "\n"
+
+    def _add_entry(self, buckets: Dict[tuple, Dict], entry: Dict, today: date) -> None:
+        timestamp = entry.get("timestamp", "")
+        level, period = self._bucket_for(timestamp[:10], today)
+        bucket = buckets.get((level, period))
+        if bucket is None:
+            bucket = buckets[(level, period)] = self._new_bucket(level, period, timestamp)
+        bucket["start"] = min(bucket["start"], timestamp)
+        bucket["end"] = max(bucket["end"], timestamp)
+        bucket["messages"] += 1
+        if entry.get("role") != "user":
+            return
+        bucket["user_messages"] += 1
+        content = str(entry.get("content", ""))
+        terms = [t for t in tokenize(content) if t not in _STOPWORDS]
+        for term in terms:
+            bucket["terms"][term] = bucket["terms"].get(term, 0) + 1
+        if len(terms) >= 2:
+            snippet = " ".join(content.split())[:self.SNIPPET_CHARS]
+            bucket["snippets"][snippet] = bucket["snippets"].get(snippet, 0) + 1
+
+    def _merge(self, buckets: Dict[tuple, Dict], level: str, period: str, source: Dict) -> None:
+        target = buckets.get((level, period))
+        if target is None:
+            buckets[(level, period)] = dict(source, level=level, period=period)
+            return
+        target["start"] = min(target["start"], source["start"])
+        target["end"] = max(target["end"], source["end"])
+        for field in ("messages", "user_messages"):
+            target[field] += source[field]
+        for field in ("terms", "snippets"):
+            merged = dict(target[field])
+            for key, value in source[field].items():
+                merged[key] = merged.get(key, 0) + value
+            target[field] = merged
+
+    def _bucket_for(self, day: str, today: date) -> tuple:
+        """Return the (level, period) a day belongs to at this age."""
+        try:
+            when = date.fromisoformat(day)
+        except ValueError:
+            return "month", "unknown"
+        age = (today - when).days
+        if age < self.daily_days:
+            return "day", day
+        if age < self.daily_days + self.weekly_weeks * 7:
+            year, week, _ = when.isocalendar()
+            return "week", f"{year}-W{week:02d}"
+        return "month", day[:7]
+
+    @staticmethod
+    def _new_bucket(level: str, period: str, timestamp: str) -> Dict[str, Any]:
+        return {
+            "level": level,
+            "period": period,
+            "start": timestamp,
+            "end": timestamp,
+            "messages": 0,
+            "user_messages": 0,
+            "terms": {},
+            "snippets": {},
+        }
+
+    def _update_stale_context(self, state: Dict, today: date) -> None:
+        """Track when each context value last changed and list stale keys."""
+        seen = {}
+        for key, value in self.storage.get_all("context").items():
+            if key == "updated_at":
+                continue
+            digest = hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+            previous = state["context_seen"].get(key)
+            if previous and previous[1] == digest:
+                seen[key] = previous
+            else:
+                seen[key] = [today.isoformat(), digest]
+        cutoff = (today - timedelta(days=self.stale_days)).isoformat()
+        state["context_seen"] = seen
+        state["stale_context"] = sorted(key for key, (changed, _) in seen.items() if changed <= cutoff)
+
+    def _empty_state(self) -> Dict[str, Any]:
+        return {
+            "version": self.VERSION,
+            "generation": None,
+            "position": 0,
+            "buckets": [],
+            "context_seen": {},
+            "stale_context": [],
+        }
+
+    def _read(self) -> Dict[str, Any]:
+        version = self.version()
+        if self._cache and self._cache[0] == version:
+            return self._cache[1]
+        state = self._empty_state()
+        if version is not None:
+            try:
+                with open(self.rollup_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == self.VERSION:
+                    state = data
+            except (OSError, json.JSONDecodeError):
+                pass
+        self._cache = (version, state)
+        return state
+
+    def _write(self, state: Dict[str, Any]) -> None:
+        atomic_write_json(self.rollup_file, state, ensure_ascii=False, indent=1)
+        self._cache = (self.version(), state)
+
+
+class RollupJob:
+    """Runs memory maintenance (e.g. MemoryRollups.update) on a daemon thread."""
+
+    def __init__(self, run: Callable[[], Any], interval: float = 600.0):
+        """Initialize the job.
+
+        Args:
+            run: Maintenance callable, invoked once per interval
+            interval: Seconds between runs
+        """
+        self.run = run
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start running; the first run happens one interval from now.
+
+        Rollups persist across processes, so a fresh process already has
+        the previous run's results and does not need to rebuild at startup.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="memory-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the job and wait for a run in progress to finish."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run()
+            except Exception:
+                pass  # Maintenance is advisory; retry on the next tick
+
+
+def _top(counts: Dict[str, int], limit: int) -> Dict[str, int]:
+    """Keep the ``limit`` highest counts, most frequent first."""
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit])
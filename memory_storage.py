@@ -0,0 +1,1335 @@
+"""Storage backends for MemoryManager long-term memory."""
+import atexit
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import ExitStack
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from file_lock import FileLock, write_temp_json
+
+
+# context_meta holds per-context-key bookkeeping (access times, hit counts, TTLs)
+SECTIONS = ("preferences", "context", "context_meta")
+
+# Size at which the active JSONL history segment is sealed
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+# Block size for reading history segments backwards from the end
+TAIL_BLOCK_BYTES = 64 * 1024
+
+CONCURRENCY_MODES = ("lock", "optimistic")
+
+
+class MemoryConflictError(RuntimeError):
+    """An optimistic write kept losing races with other writers."""
+
+
+class MemoryStorage:
+    """Interface for long-term memory persistence.
+
+    Preferences and context are flat key/value sections; history is an
+    append-only sequence of entries ordered by insertion.
+    """
+
+    name = "base"
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        """Return a single value from a section."""
+        return self.get_all(section).get(key, default)
+
+    def get_all(self, section: str) -> Dict[str, Any]:
+        """Return every key/value pair stored in a section."""
+        raise NotImplementedError
+
+    def set_many(self, section: str, items: Dict[str, Any]) -> None:
+        """Insert or update several keys in a section."""
+        raise NotImplementedError
+
+    def replace(self, section: str, data: Dict[str, Any]) -> None:
+        """Replace the full contents of a section."""
+        raise NotImplementedError
+
+    def set_sections(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        """Insert or update keys in several sections as one unit of work."""
+        for section, items in updates.items():
+            if items:
+                self.set_many(section, items)
+
+    def delete(self, section: str, keys: Iterable[str]) -> None:
+        """Remove keys from a section (missing keys are ignored)."""
+        keys = set(keys)
+        self.replace(section, {k: v for k, v in self.get_all(section).items() if k not in keys})
+
+    def append_history(self, entries: List[Dict]) -> None:
+        """Append entries to the end of the history."""
+        raise NotImplementedError
+
+    def iter_history(self) -> Iterator[Dict]:
+        """Yield all history entries, oldest first."""
+        raise NotImplementedError
+
+    def tail_history(self, limit: int) -> List[Dict]:
+        """Return the last ``limit`` history entries, oldest first."""
+        return list(deque(self.iter_history(), maxlen=limit))
+
+    def iter_history_from(self, position: int) -> Iterator[Dict]:
+        """Yield history entries starting at a zero-based position."""
+        return islice(self.iter_history(), position, None)
+
+    def history_at(self, positions: Iterable[int]) -> Dict[int, Dict]:
+        """Return the entries at the given zero-based positions."""
+        wanted = set(positions)
+        found = {}
+        for position, entry in enumerate(self.iter_history()):
+            if position in wanted:
+                found[position] = entry
+                if len(found) == len(wanted):
+                    break
+        return found
+
+    def history_between(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        """Yield history entries with start <= timestamp <= end (ISO strings)."""
+        return _filter_window(self.iter_history(), start, end)
+
+    def history_count(self) -> int:
+        """Return the number of history entries."""
+        return sum(1 for _ in self.iter_history())
+
+    def history_generation(self) -> Optional[int]:
+        """Return a counter bumped whenever the history is replaced wholesale.
+
+        Lets derived indexes tell "entries were appended" apart from "the
+        history was rewritten". None means the backend does not track it.
+        """
+        return None
+
+    def replace_history(self, entries: Iterable[Dict]) -> None:
+        """Replace the whole history with the given entries."""
+        raise NotImplementedError
+
+    def change_token(self) -> Any:
+        """Return a cheap value that changes whenever stored data changes.
+
+        Used to memoize derived views such as the memory summary. None means
+        the backend cannot tell, and callers should always recompute.
+        """
+        return None
+
+    def context_expiry(self, now: str) -> Tuple[frozenset, Optional[str]]:
+        """Return (context keys expired at now, earliest later expiry or None).
+
+        Args:
+            now: Current time as an ISO string
+        """
+        return scan_context_expiry(self.get_all("context_meta"), now)
+
+    def sections_token(self) -> Any:
+        """Return a cheap value that changes whenever preferences or context change.
+
+        Unlike change_token() it ignores history appends, so views derived
+        only from the key/value sections stay memoized while the
+        conversation grows. None means the backend cannot tell.
+        """
+        return self.change_token()
+
+    def is_empty(self) -> bool:
+        """Return True if nothing has been stored yet."""
+        return not any(self.get_all(s) for s in SECTIONS) and self.history_count() == 0
+
+    def flush(self) -> None:
+        """Write out any buffered changes."""
+
+    def close(self) -> None:
+        """Release any resources held by the backend."""
+
+
+class JSONStorage(MemoryStorage):
+    """File-based backend: one JSON map per section plus a segmented JSONL history.
+
+    Parsed preference and context maps are kept in a write-through cache
+    keyed on each file's (inode, mtime, size), so reads only re-parse a file
+    after another process has changed it.
+
+    Files are saved atomically (temp file + rename), so readers never take a
+    lock and never see a half-written file. Writers coordinate through
+    advisory flock() locks on ``.<name>.lock`` files; in "lock" mode a
+    writer holds the lock for its whole read-modify-write, in "optimistic"
+    mode it only takes the lock to check that the file is unchanged and
+    rename its new version in, retrying on conflict.
+
+    History lives in ``history/`` as size-bounded JSONL segments. Only the
+    newest (active) segment is appended to; once it reaches
+    ``segment_bytes`` it is sealed, optionally gzip-compressed, and recorded
+    in ``history/index.json`` with its entry count and timestamp range.
+    Tail and time-window reads therefore only open the segments they need.
+    """
+
+    name = "json"
+
+    def __init__(
+        self,
+        memory_dir: Path,
+        revalidate_interval: float = 0.0,
+        segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+        compress_segments: bool = False,
+        concurrency: str = "lock",
+        lock_timeout: Optional[float] = 10.0,
+        max_retries: int = 50,
+    ):
+        """Initialize JSON storage.
+
+        Args:
+            memory_dir: Directory holding preferences.json, context.json and history/
+            revalidate_interval: Seconds to trust a cached map before re-checking
+                the file's mtime and size (0 checks on every read)
+            segment_bytes: Size at which the active history segment is sealed
+            compress_segments: Gzip history segments once they are sealed
+            concurrency: "lock" or "optimistic" handling of preference/context writes
+            lock_timeout: Seconds to wait for a file lock (None waits forever)
+            max_retries: Optimistic attempts before raising MemoryConflictError
+        """
+        if concurrency not in CONCURRENCY_MODES:
+            raise ValueError(f"Unknown concurrency mode: {concurrency}")
+        self.memory_dir = Path(memory_dir)
+        self.revalidate_interval = revalidate_interval
+        self.segment_bytes = segment_bytes
+        self.compress_segments = compress_segments
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        # filepath -> (file signature, parsed data, last validation time)
+        self._cache: Dict[Path, Tuple[Optional[Tuple[int, int, int]], Dict, float]] = {}
+        self._locks = {
+            name: FileLock(self.memory_dir / f".{name}.lock", timeout=lock_timeout)
+            for name in SECTIONS + ("history",)
+        }
+        self.preferences_file = self.memory_dir / "preferences.json"
+        self.context_file = self.memory_dir / "context.json"
+        self.context_meta_file = self.memory_dir / "context_meta.json"
+        self.history_dir = self.memory_dir / "history"
+        self.history_index_file = self.history_dir / "index.json"
+        self.legacy_history_files = [
+            self.memory_dir / "history.jsonl",
+            self.memory_dir / "history.json",
+        ]
+        self.history_dir.mkdir(exist_ok=True)
+        self._migrate_legacy_history()
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        return self._load_json(self._section_file(section)).get(key, default)
+
+    def get_all(self, section: str) -> Dict[str, Any]:
+        return dict(self._load_json(self._section_file(section)))
+
+    def set_many(self, section: str, items: Dict[str, Any]) -> None:
+        self._update_json(section, lambda data: {**data, **items})
+
+    def set_sections(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        # Hold every section lock (in a fixed order) so other writers see
+        # either none or all of the updates land
+        sections = [s for s in SECTIONS if updates.get(s)]
+        with ExitStack() as stack:
+            for section in sections:
+                stack.enter_context(self._locks[section])
+            for section in sections:
+                self.set_many(section, updates[section])
+
+    def replace(self, section: str, data: Dict[str, Any]) -> None:
+        self._update_json(section, lambda _: dict(data))
+
+    def delete(self, section: str, keys: Iterable[str]) -> None:
+        keys = set(keys)
+        self._update_json(section, lambda data: {k: v for k, v in data.items() if k not in keys})
+
+    def append_history(self, entries: List[Dict]) -> None:
+        if entries:
+            self._write_entries(entries)
+
+    def iter_history(self) -> Iterator[Dict]:
+        index = self._refresh_index()
+        for segment in index["segments"]:
+            yield from self._read_segment(self.history_dir / segment["name"])
+        yield from self._read_segment(self.history_dir / index["active"]["name"])
+
+    def tail_history(self, limit: int) -> List[Dict]:
+        index = self._refresh_index()
+        names = [index["active"]["name"]] + [s["name"] for s in reversed(index["segments"])]
+        chunks = []
+        needed = limit
+        for name in names:
+            if needed <= 0:
+                break
+            chunk = self._read_segment_tail(self.history_dir / name, needed)
+            chunks.append(chunk)
+            needed -= len(chunk)
+        return [entry for chunk in reversed(chunks) for entry in chunk]
+
+    def iter_history_from(self, position: int) -> Iterator[Dict]:
+        index = self._refresh_index()
+        for segment in index["segments"]:
+            if position >= segment["count"]:
+                position -= segment["count"]
+                continue
+            yield from self._read_segment(self.history_dir / segment["name"], skip=position)
+            position = 0
+        yield from self._read_segment(self.history_dir / index["active"]["name"], skip=position)
+
+    def history_at(self, positions: Iterable[int]) -> Dict[int, Dict]:
+        index = self._refresh_index()
+        names = [s["name"] for s in index["segments"]] + [index["active"]["name"]]
+        counts = [s["count"] for s in index["segments"]] + [index["active"]["count"]]
+        wanted = set(positions)
+        found = {}
+        start = 0
+        for name, count in zip(names, counts):
+            offsets = {p - start for p in wanted if start <= p < start + count}
+            if offsets:
+                found.update(
+                    (start + offset, entry)
+                    for offset, entry in self._read_lines_at(self.history_dir / name, offsets)
+                )
+            start += count
+        return found
+
+    def history_between(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        index = self._refresh_index()
+        for segment in index["segments"]:
+            if start and segment.get("last_timestamp") and segment["last_timestamp"] < start:
+                continue
+            if end and segment.get("first_timestamp") and segment["first_timestamp"] > end:
+                break
+            yield from _filter_window(self._read_segment(self.history_dir / segment["name"]), start, end)
+        yield from _filter_window(
+            self._read_segment(self.history_dir / index["active"]["name"]), start, end
+        )
+
+    def history_count(self) -> int:
+        index = self._refresh_index()
+        return index["sealed_count"] + index["active"]["count"]
+
+    def history_generation(self) -> Optional[int]:
+        return self._refresh_index().get("generation", 0)
+
+    def replace_history(self, entries: Iterable[Dict]) -> None:
+        # The new history is written to fresh segments and swapped in with
+        # one index rename, so a failing entries iterable (e.g. a corrupt
+        # backup) leaves the live history untouched
+        with self._locks["history"]:
+            generation = self.history_generation() + 1
+            old_paths = self._segment_paths()
+            first = max((self._segment_number(path) for path in old_paths), default=0) + 1
+            try:
+                index = self._stage_segments(entries, first)
+            except BaseException:
+                for path in self._segment_paths():
+                    if path not in old_paths:
+                        path.unlink()
+                raise
+            self._save_json(self.history_index_file, dict(index, generation=generation))
+            for path in old_paths:
+                path.unlink()
+            if self.compress_segments and index["segments"]:
+                self.compress_cold_segments()
+
+    def change_token(self) -> Any:
+        return (
+            self._signature(self.preferences_file),
+            self._signature(self.context_file),
+            self.history_count(),
+        )
+
+    def sections_token(self) -> Any:
+        return (self._signature(self.preferences_file), self._signature(self.context_file))
+
+    def compress_cold_segments(self) -> None:
+        """Gzip every sealed history segment that is still plain JSONL."""
+        with self._locks["history"]:
+            index = self._refresh_index()
+            segments = []
+            compressed = []
+            for segment in index["segments"]:
+                path = self.history_dir / segment["name"]
+                if path.suffix != ".gz":
+                    gz_path = path.with_name(path.name + ".gz")
+                    with open(path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    segment = dict(segment, name=gz_path.name)
+                    compressed.append(path)
+                segments.append(segment)
+            if not compressed:
+                return
+            self._save_json(self.history_index_file, dict(index, segments=segments))
+            for path in compressed:
+                path.unlink()
+
+    def _write_entries(self, entries: Iterable[Dict]) -> None:
+        """Append entries to the active segment, sealing it when it fills up."""
+        with self._locks["history"]:
+            index = self._refresh_index()
+            active = self.history_dir / index["active"]["name"]
+            size = active.stat().st_size if active.exists() else 0
+            f = open(active, "a", encoding="utf-8")
+            try:
+                for entry in entries:
+                    line = json.dumps(entry, ensure_ascii=False) + "\n"
+                    f.write(line)
+                    size += len(line.encode("utf-8"))
+                    if size >= self.segment_bytes:
+                        f.close()
+                        active = self._seal_active_segment()
+                        size = 0
+                        f = open(active, "a", encoding="utf-8")
+            finally:
+                f.close()
+
+    def _stage_segments(self, entries: Iterable[Dict], number: int) -> Dict:
+        """Write entries to new segments numbered from ``number``, outside the index.
+
+        Returns:
+            History index describing the written segments
+        """
+        segments = []
+        sealed_count = 0
+        path = self.history_dir / f"segment-{number:06d}.jsonl"
+        f = open(path, "w", encoding="utf-8")
+        try:
+            count = size = 0
+            first_timestamp = last_timestamp = None
+            for entry in entries:
+                line = json.dumps(entry, ensure_ascii=False) + "\n"
+                f.write(line)
+                size += len(line.encode("utf-8"))
+                count += 1
+                first_timestamp = first_timestamp or entry.get("timestamp")
+                last_timestamp = entry.get("timestamp") or last_timestamp
+                if size >= self.segment_bytes:
+                    f.close()
+                    segments.append({
+                        "name": path.name,
+                        "count": count,
+                        "first_timestamp": first_timestamp,
+                        "last_timestamp": last_timestamp,
+                    })
+                    sealed_count += count
+                    count = size = 0
+                    first_timestamp = last_timestamp = None
+                    number += 1
+                    path = self.history_dir / f"segment-{number:06d}.jsonl"
+                    f = open(path, "w", encoding="utf-8")
+        finally:
+            f.close()
+        size, inode = self._active_stat(path.name)
+        return dict(
+            self._empty_index(),
+            segments=segments,
+            sealed_count=sealed_count,
+            active={"name": path.name, "count": count, "size": size, "inode": inode},
+        )
+
+    @staticmethod
+    def _segment_number(path: Path) -> int:
+        return int(path.name.split("-")[1].split(".")[0])
+
+    def _seal_active_segment(self) -> Path:
+        """Move the active segment into the sealed list and start a new one.
+
+        Must be called with the history lock held.
+
+        Returns:
+            Path of the new, empty active segment
+        """
+        index = self._refresh_index()
+        path = self.history_dir / index["active"]["name"]
+        count = 0
+        first_timestamp = last_timestamp = None
+        for entry in self._read_segment(path):
+            count += 1
+            first_timestamp = first_timestamp or entry.get("timestamp")
+            last_timestamp = entry.get("timestamp") or last_timestamp
+
+        segment = {
+            "name": path.name,
+            "count": count,
+            "first_timestamp": first_timestamp,
+            "last_timestamp": last_timestamp,
+        }
+        number = self._segment_number(path) + 1
+        active = self.history_dir / f"segment-{number:06d}.jsonl"
+        self._save_json(self.history_index_file, dict(
+            index,
+            segments=index["segments"] + [segment],
+            sealed_count=index["sealed_count"] + count,
+            active={"name": active.name, "count": 0, "size": 0, "inode": 0},
+        ))
+        if self.compress_segments:
+            self.compress_cold_segments()
+        return active
+
+    def _refresh_index(self) -> Dict:
+        """Return the history index with the active segment's count up to date.
+
+        The index records the active segment's line count together with the
+        file size and inode it was taken at. When the segment has only grown
+        since, just the new tail is scanned, so keeping the count current
+        costs O(new entries) rather than O(history).
+        """
+        index = self._load_json(self.history_index_file) or self._empty_index()
+        if self._active_unchanged(index):
+            return index
+
+        with self._locks["history"]:
+            index = self._load_json(self.history_index_file, fresh=True) or self._empty_index()
+            if self._active_unchanged(index):
+                return index
+            active = index["active"]
+            size, inode = self._active_stat(active["name"])
+            if active["inode"] == inode and active["size"] < size:
+                count = active["count"] + self._count_lines(active["name"], active["size"])
+            else:
+                count = self._count_lines(active["name"], 0)
+
+            index = dict(index, active={"name": active["name"], "count": count, "size": size, "inode": inode})
+            self._save_json(self.history_index_file, index)
+            return index
+
+    def _active_unchanged(self, index: Dict) -> bool:
+        """Check whether the active segment still matches its recorded size."""
+        size, inode = self._active_stat(index["active"]["name"])
+        return index["active"]["inode"] == inode and index["active"]["size"] == size
+
+    def _active_stat(self, name: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(self.history_dir / name)
+        except FileNotFoundError:
+            return 0, 0
+        return stat.st_size, stat.st_ino
+
+    @staticmethod
+    def _empty_index() -> Dict:
+        return {
+            "generation": 0,
+            "segments": [],
+            "sealed_count": 0,
+            "active": {"name": "segment-000001.jsonl", "count": 0, "size": 0, "inode": 0},
+        }
+
+    def _segment_paths(self) -> List[Path]:
+        return sorted(self.history_dir.glob("segment-*.jsonl*"))
+
+    def _count_lines(self, name: str, offset: int) -> int:
+        """Count complete lines in a plain segment from a byte offset."""
+        path = self.history_dir / name
+        if not path.exists():
+            return 0
+        count = 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                count += chunk.count(b"\n")
+        return count
+
+    @staticmethod
+    def _read_segment(path: Path, skip: int = 0) -> Iterator[Dict]:
+        """Yield entries from a plain or gzipped JSONL file, skipping torn lines.
+
+        Args:
+            path: Segment file
+            skip: Number of leading entries to pass over without decoding
+        """
+        if not path.exists():
+            return
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-append can leave a partial last line
+                    continue
+
+    @staticmethod
+    def _read_segment_tail(path: Path, limit: int) -> List[Dict]:
+        """Return the last ``limit`` entries of a segment, decoding only those lines.
+
+        Plain segments are read backwards from the end in blocks; gzipped
+        (sealed) segments cannot seek and are scanned from the start.
+        """
+        if limit <= 0 or not path.exists():
+            return []
+        if path.suffix == ".gz":
+            return list(deque(JSONStorage._read_segment(path), maxlen=limit))
+        entries = []
+        with open(path, "rb") as f:
+            position = f.seek(0, os.SEEK_END)
+            partial = b""
+            while len(entries) < limit:
+                if position == 0:
+                    lines, partial = [partial], b""
+                else:
+                    size = min(TAIL_BLOCK_BYTES, position)
+                    position -= size
+                    f.seek(position)
+                    lines = (f.read(size) + partial).split(b"\n")
+                    # The first piece may continue in the preceding block
+                    partial = lines.pop(0)
+                for line in reversed(lines):
+                    entry = _decode_line(line)
+                    if entry is not None:
+                        entries.append(entry)
+                        if len(entries) == limit:
+                            break
+                if position == 0 and not partial:
+                    break
+        entries.reverse()
+        return entries
+
+    @staticmethod
+    def _read_lines_at(path: Path, offsets: set) -> Iterator[Tuple[int, Dict]]:
+        """Yield (offset, entry) for selected lines, decoding only those lines."""
+        if not path.exists():
+            return
+        last = max(offsets)
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            position = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                if position in offsets:
+                    try:
+                        yield position, json.loads(line)
+                    except json.JSONDecodeError:
+                        pass
+                if position >= last:
+                    break
+                position += 1
+
+    def _signature(self, filepath: Path) -> Optional[Tuple[int, int, int]]:
+        """Return the validated cache signature of a JSON file."""
+        self._load_json(filepath)
+        return self._cache[filepath][0]
+
+    def _section_file(self, section: str) -> Path:
+        if section == "preferences":
+            return self.preferences_file
+        if section == "context":
+            return self.context_file
+        if section == "context_meta":
+            return self.context_meta_file
+        raise ValueError(f"Unknown memory section: {section}")
+
+    def _migrate_legacy_history(self) -> None:
+        """Move a history.jsonl log or history.json array into segments once."""
+        if self.history_index_file.exists():
+            return
+        if not any(legacy.exists() for legacy in self.legacy_history_files):
+            return
+        with self._locks["history"]:
+            if self.history_index_file.exists():
+                return  # Another process migrated first
+            for legacy in self.legacy_history_files:
+                if not legacy.exists():
+                    continue
+                if legacy.suffix == ".jsonl":
+                    self.replace_history(self._read_segment(legacy))
+                else:
+                    with open(legacy, "r") as f:
+                        history = json.load(f)
+                    self.replace_history(history if isinstance(history, list) else [])
+                legacy.rename(legacy.with_name(legacy.name + ".bak"))
+                break
+            stale_meta = self.memory_dir / "history.meta.json"
+            if stale_meta.exists():
+                stale_meta.unlink()
+
+    def _update_json(self, section: str, update: Callable[[Dict], Dict]) -> None:
+        """Apply update() to a section file as one read-modify-write.
+
+        Args:
+            section: "preferences" or "context"
+            update: Function mapping the current data to the new data
+        """
+        filepath = self._section_file(section)
+        lock = self._locks[section]
+        if self.concurrency == "lock":
+            with lock:
+                self._save_json(filepath, update(self._load_json(filepath, fresh=True)))
+            return
+
+        for _ in range(self.max_retries):
+            current = self._load_json(filepath, fresh=True)
+            signature = self._cache[filepath][0]
+            data = update(current)
+            tmp_file = self._write_temp(filepath, data)
+            with lock:
+                if self._file_signature(filepath) == signature:
+                    self._commit_temp(tmp_file, filepath, data)
+                    return
+            os.unlink(tmp_file)
+        raise MemoryConflictError(f"Gave up updating {filepath.name} after {self.max_retries} conflicts")
+
+    def _load_json(self, filepath: Path, fresh: bool = False) -> Dict:
+        """Load JSON file through the cache, return empty dict if not exists.
+
+        The returned dict is shared with the cache and must not be mutated.
+
+        Args:
+            filepath: File to load
+            fresh: Always re-check the file signature (ignore revalidate_interval)
+        """
+        now = time.monotonic()
+        cached = self._cache.get(filepath)
+        if cached and not fresh and now - cached[2] < self.revalidate_interval:
+            return cached[1]
+
+        signature = self._file_signature(filepath)
+        if cached and cached[0] == signature:
+            self._cache[filepath] = (signature, cached[1], now)
+            return cached[1]
+
+        data = {}
+        if signature is not None:
+            with open(filepath, "r") as f:
+                data = json.load(f)
+        self._cache[filepath] = (signature, data, now)
+        return data
+
+    def _save_json(self, filepath: Path, data: Dict) -> None:
+        """Atomically save JSON file and refresh its cache entry."""
+        self._commit_temp(self._write_temp(filepath, data), filepath, data)
+
+    def _write_temp(self, filepath: Path, data: Dict) -> str:
+        """Write data to a durable temp file next to filepath."""
+        return write_temp_json(filepath, data, fsync=True, indent=2)
+
+    def _commit_temp(self, tmp_file: str, filepath: Path, data: Dict) -> None:
+        """Rename a temp file holding data into place and cache data."""
+        try:
+            os.replace(tmp_file, filepath)
+        except BaseException:
+            os.unlink(tmp_file)
+            raise
+        self._cache[filepath] = (self._file_signature(filepath), data, time.monotonic())
+
+    @staticmethod
+    def _file_signature(filepath: Path) -> Optional[Tuple[int, int, int]]:
+        """Return (inode, mtime_ns, size) for a file, or None if it does not exist."""
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class SQLiteStorage(MemoryStorage):
+    """SQLite backend (WAL mode) with indexed key/value and history tables."""
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS preferences (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS context (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS context_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at TEXT
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            metadata TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+        CREATE INDEX IF NOT EXISTS idx_history_role ON history(role);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value)
+            SELECT 'history_count', COUNT(*) FROM history;
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('history_generation', 0);
+        CREATE TRIGGER IF NOT EXISTS history_count_insert AFTER INSERT ON history
+        BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'history_count';
+        END;
+        CREATE TRIGGER IF NOT EXISTS history_count_delete AFTER DELETE ON history
+        BEGIN
+            UPDATE meta SET value = value - 1 WHERE key = 'history_count';
+        END;
+    """
+
+    def __init__(self, memory_dir: Path, filename: str = "memory.db", lock_timeout: float = 10.0):
+        """Initialize SQLite storage.
+
+        Args:
+            memory_dir: Directory holding the database file
+            filename: Database file name inside memory_dir
+            lock_timeout: Seconds a write waits for another process's transaction
+        """
+        self.db_path = Path(memory_dir) / filename
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._section_writes = 0
+        self._conn = sqlite3.connect(str(self.db_path), timeout=lock_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+        self._migrate_context_meta()
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        table = self._table(section)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value FROM {table} WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_all(self, section: str) -> Dict[str, Any]:
+        table = self._table(section)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT key, value FROM {table}").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_many(self, section: str, items: Dict[str, Any]) -> None:
+        self.set_sections({section: items})
+
+    def set_sections(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock, self._conn:
+            for section, items in updates.items():
+                self._insert(self._table(section), items, upsert=True)
+            # Access bookkeeping alone does not invalidate derived views
+            if set(updates) - {"context_meta"}:
+                self._writes += 1
+                self._section_writes += 1
+
+    def replace(self, section: str, data: Dict[str, Any]) -> None:
+        table = self._table(section)
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {table}")
+            self._insert(table, data)
+            self._writes += 1
+            self._section_writes += 1
+
+    def delete(self, section: str, keys: Iterable[str]) -> None:
+        table = self._table(section)
+        with self._lock, self._conn:
+            self._conn.executemany(f"DELETE FROM {table} WHERE key = ?", [(key,) for key in keys])
+            self._writes += 1
+            self._section_writes += 1
+
+    def append_history(self, entries: List[Dict]) -> None:
+        if not entries:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO history (timestamp, role, content, metadata) VALUES (?, ?, ?, ?)",
+                [self._history_row(e) for e in entries],
+            )
+            self._writes += 1
+
+    def iter_history(self) -> Iterator[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, role, content, metadata FROM history ORDER BY id"
+            ).fetchall()
+        for row in rows:
+            yield self._history_entry(row)
+
+    def tail_history(self, limit: int) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, role, content, metadata FROM history "
+                "ORDER BY id DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [self._history_entry(row) for row in reversed(rows)]
+
+    def iter_history_from(self, position: int) -> Iterator[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, role, content, metadata FROM history "
+                "ORDER BY id LIMIT -1 OFFSET ?",
+                (position,),
+            ).fetchall()
+        for row in rows:
+            yield self._history_entry(row)
+
+    def history_at(self, positions: Iterable[int]) -> Dict[int, Dict]:
+        positions = sorted(set(positions))
+        if not positions:
+            return {}
+        with self._lock:
+            first, last, count = self._conn.execute(
+                "SELECT (SELECT MIN(id) FROM history), (SELECT MAX(id) FROM history), "
+                "(SELECT value FROM meta WHERE key = 'history_count')"
+            ).fetchone()
+            marks = ",".join("?" * len(positions))
+            if count and last - first + 1 == count:
+                # History is only ever appended or replaced whole, so ids
+                # are normally contiguous and a position maps to first + position
+                rows = self._conn.execute(
+                    f"SELECT id - ?, timestamp, role, content, metadata FROM history WHERE id IN ({marks})",
+                    [first] + [first + position for position in positions],
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT position, timestamp, role, content, metadata FROM ("
+                    "SELECT ROW_NUMBER() OVER (ORDER BY id) - 1 AS position, * FROM history"
+                    f") WHERE position IN ({marks})",
+                    positions,
+                ).fetchall()
+        return {row[0]: self._history_entry(row[1:]) for row in rows}
+
+    def history_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'history_count'"
+            ).fetchone()[0]
+
+    def history_generation(self) -> Optional[int]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'history_generation'"
+            ).fetchone()[0]
+
+    def change_token(self) -> Any:
+        # data_version only moves for commits made on other connections
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version, self._writes)
+
+    def context_expiry(self, now: str) -> Tuple[frozenset, Optional[str]]:
+        with self._lock:
+            expired = self._conn.execute(
+                "SELECT key FROM context_meta WHERE expires_at <= ?", (now,)
+            ).fetchall()
+            next_expiry = self._conn.execute(
+                "SELECT MIN(expires_at) FROM context_meta WHERE expires_at > ?", (now,)
+            ).fetchone()[0]
+        return frozenset(key for (key,) in expired), next_expiry
+
+    def sections_token(self) -> Any:
+        # Commits from other connections may be history appends; treating
+        # them as section changes only costs a recompute
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version, self._section_writes)
+
+    def history_between(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        query = "SELECT timestamp, role, content, metadata FROM history"
+        clauses, params = [], []
+        if start:
+            clauses.append("timestamp >= ?")
+            params.append(start)
+        if end:
+            clauses.append("timestamp <= ?")
+            params.append(end)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY id", params).fetchall()
+        for row in rows:
+            yield self._history_entry(row)
+
+    def replace_history(self, entries: Iterable[Dict]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM history")
+            self._conn.execute(
+                "UPDATE meta SET value = value + 1 WHERE key = 'history_generation'"
+            )
+            self._conn.executemany(
+                "INSERT INTO history (timestamp, role, content, metadata) VALUES (?, ?, ?, ?)",
+                (self._history_row(e) for e in entries),
+            )
+            self._writes += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _insert(self, table: str, items: Dict[str, Any], upsert: bool = False) -> None:
+        """Insert key/value rows (caller holds the lock and a transaction)."""
+        columns = ["key", "value"]
+        rows = [[key, json.dumps(value, ensure_ascii=False)] for key, value in items.items()]
+        if table == "context_meta":
+            # Expiry queries use the indexed column instead of decoding every value
+            columns.append("expires_at")
+            for row, value in zip(rows, items.values()):
+                row.append((value.get("expires_at") if isinstance(value, dict) else None) or None)
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        if upsert:
+            sql += " ON CONFLICT(key) DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+        self._conn.executemany(sql, rows)
+
+    def _migrate_context_meta(self) -> None:
+        """Add and backfill the expires_at column of databases created without it."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(context_meta)")}
+        if "expires_at" not in columns:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have migrated while we waited for the lock
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(context_meta)")}
+                if "expires_at" not in columns:
+                    self._conn.execute("ALTER TABLE context_meta ADD COLUMN expires_at TEXT")
+                    rows = self._conn.execute("SELECT key, value FROM context_meta").fetchall()
+                    self._conn.executemany(
+                        "UPDATE context_meta SET expires_at = ? WHERE key = ?",
+                        [(json.loads(value).get("expires_at") or None, key) for key, value in rows],
+                    )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_context_meta_expires ON context_meta(expires_at)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _table(section: str) -> str:
+        if section not in SECTIONS:
+            raise ValueError(f"Unknown memory section: {section}")
+        return section
+
+    @staticmethod
+    def _history_row(entry: Dict) -> tuple:
+        metadata = entry.get("metadata")
+        return (
+            entry.get("timestamp", ""),
+            entry.get("role", ""),
+            entry.get("content", ""),
+            json.dumps(metadata, ensure_ascii=False) if metadata else None,
+        )
+
+    @staticmethod
+    def _history_entry(row: tuple) -> Dict:
+        timestamp, role, content, metadata = row
+        entry = {"timestamp": timestamp, "role": role, "content": content}
+        if metadata:
+            entry["metadata"] = json.loads(metadata)
+        return entry
+
+
+class WriteBehindStorage(MemoryStorage):
+    """Wrapper that coalesces writes and flushes them in the background.
+
+    Key/value updates and history appends are buffered and written by a
+    timer thread ``delay`` seconds after the first buffered change, so
+    callers on the interactive path never wait for disk I/O. Key/value
+    reads, the history count and the change tokens are served from the
+    buffer laid over the backend; only reads of history entries flush
+    first. Pending writes are flushed at interpreter exit.
+
+    If a background flush fails the changes stay buffered and the next
+    flush (or history read) retries and raises.
+    """
+
+    def __init__(self, inner: MemoryStorage, delay: float = 0.2):
+        """Initialize the wrapper.
+
+        Args:
+            inner: Backend that receives the coalesced writes
+            delay: Seconds to wait for more changes before writing
+        """
+        self.inner = inner
+        self.delay = delay
+        self.name = inner.name
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._sections: Dict[str, Dict[str, Any]] = {}
+        self._history: List[Dict] = []
+        # Batch being written by flush(), still visible to readers
+        self._flushing_sections: Dict[str, Dict[str, Any]] = {}
+        self._flushing_history: List[Dict] = []
+        self._flushing_base: Optional[int] = None
+        # Bumped for every buffered preference/context change and history append
+        self._version = 0
+        self._appended = 0
+        self._timer: Optional[threading.Timer] = None
+        _pending_storages.add(self)
+
+    def __getattr__(self, name: str) -> Any:
+        # Backend-specific extras (e.g. JSONStorage.compress_cold_segments)
+        if name.startswith("_") or "inner" not in self.__dict__:
+            raise AttributeError(name)
+        self.flush()
+        return getattr(self.inner, name)
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            for buffered in (self._sections, self._flushing_sections):
+                if key in buffered.get(section, ()):
+                    return buffered[section][key]
+        return self.inner.get(section, key, default)
+
+    def get_all(self, section: str) -> Dict[str, Any]:
+        with self._lock:
+            flushing = dict(self._flushing_sections.get(section, {}))
+            pending = dict(self._sections.get(section, {}))
+        data = self.inner.get_all(section)
+        if flushing or pending:
+            data = {**data, **flushing, **pending}
+        return data
+
+    def set_many(self, section: str, items: Dict[str, Any]) -> None:
+        self.set_sections({section: items})
+
+    def set_sections(self, updates: Dict[str, Dict[str, Any]]) -> None:
+        with self._lock:
+            for section, items in updates.items():
+                self._sections.setdefault(section, {}).update(items)
+            if set(updates) - {"context_meta"}:
+                self._version += 1
+            self._schedule()
+
+    def replace(self, section: str, data: Dict[str, Any]) -> None:
+        self.flush()
+        self.inner.replace(section, data)
+
+    def delete(self, section: str, keys: Iterable[str]) -> None:
+        self.flush()
+        self.inner.delete(section, keys)
+
+    def append_history(self, entries: List[Dict]) -> None:
+        if not entries:
+            return
+        with self._lock:
+            self._history.extend(entries)
+            self._appended += len(entries)
+            self._schedule()
+
+    def iter_history(self) -> Iterator[Dict]:
+        self.flush()
+        return self.inner.iter_history()
+
+    def tail_history(self, limit: int) -> List[Dict]:
+        self.flush()
+        return self.inner.tail_history(limit)
+
+    def iter_history_from(self, position: int) -> Iterator[Dict]:
+        self.flush()
+        return self.inner.iter_history_from(position)
+
+    def history_at(self, positions: Iterable[int]) -> Dict[int, Dict]:
+        self.flush()
+        return self.inner.history_at(positions)
+
+    def history_between(self, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[Dict]:
+        self.flush()
+        return self.inner.history_between(start, end)
+
+    def history_count(self) -> int:
+        with self._lock:
+            if self._flushing_base is not None:
+                # The backend may or may not hold the batch being written yet
+                return self._flushing_base + len(self._flushing_history) + len(self._history)
+            return self.inner.history_count() + len(self._history)
+
+    def history_generation(self) -> Optional[int]:
+        # Appends never change the generation; replace_history flushes first
+        return self.inner.history_generation()
+
+    def replace_history(self, entries: Iterable[Dict]) -> None:
+        self.flush()
+        self.inner.replace_history(entries)
+
+    def change_token(self) -> Any:
+        inner = self.inner.change_token()
+        return None if inner is None else (self._version, self._appended, inner)
+
+    def context_expiry(self, now: str) -> Tuple[frozenset, Optional[str]]:
+        with self._lock:
+            buffered = "context_meta" in self._sections or "context_meta" in self._flushing_sections
+        if buffered:
+            return super().context_expiry(now)
+        return self.inner.context_expiry(now)
+
+    def sections_token(self) -> Any:
+        inner = self.inner.sections_token()
+        return None if inner is None else (self._version, inner)
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            buffered = list(self._sections.values()) + list(self._flushing_sections.values())
+            if any(buffered) or self._history or self._flushing_history:
+                return False
+        return self.inner.is_empty()
+
+    def flush(self) -> None:
+        # Serialize flushes so batches reach the backend in order
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                sections, history = self._sections, self._history
+                if not sections and not history:
+                    return
+                self._sections, self._history = {}, []
+                self._flushing_sections, self._flushing_history = sections, history
+                self._flushing_base = self.inner.history_count() if history else None
+            try:
+                if sections:
+                    self.inner.set_sections(sections)
+                    sections = {}
+                if history:
+                    self.inner.append_history(history)
+                    history = []
+            finally:
+                self._finish_flush(sections, history)
+
+    def close(self) -> None:
+        self.flush()
+        _pending_storages.discard(self)
+        self.inner.close()
+
+    def _schedule(self) -> None:
+        """Start the flush timer if none is pending (caller holds _lock)."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.delay, self._background_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_flush(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            pass  # Kept buffered; the next flush retries and raises
+
+    def _finish_flush(self, sections: Dict[str, Dict[str, Any]], history: List[Dict]) -> None:
+        """Retire the flushing batch, putting its unwritten part back in front
+        of anything buffered since."""
+        with self._lock:
+            for section, items in sections.items():
+                self._sections[section] = {**items, **self._sections.get(section, {})}
+            self._history[:0] = history
+            self._flushing_sections, self._flushing_history = {}, []
+            self._flushing_base = None
+
+
+# Write-behind wrappers that may hold unflushed changes at exit
+_pending_storages: "weakref.WeakSet[WriteBehindStorage]" = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_pending_storages() -> None:
+    for storage in list(_pending_storages):
+        try:
+            storage.flush()
+        except Exception:
+            pass
+
+
+def scan_context_expiry(meta: Dict[str, Dict], now: str) -> Tuple[frozenset, Optional[str]]:
+    """Return (expired keys, earliest later expiry or None) of context_meta entries.
+
+    Args:
+        meta: context_meta section (key -> entry with an optional "expires_at")
+        now: Current time as an ISO string
+    """
+    expired = set()
+    next_expiry = None
+    for key, entry in meta.items():
+        expires_at = entry.get("expires_at")
+        if not expires_at:
+            continue
+        if expires_at <= now:
+            expired.add(key)
+        elif next_expiry is None or expires_at < next_expiry:
+            next_expiry = expires_at
+    return frozenset(expired), next_expiry
+
+
+def _decode_line(line: bytes) -> Optional[Dict]:
+    """Decode one JSONL history line (None for blank or torn lines)."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+
+
+def _filter_window(entries: Iterable[Dict], start: Optional[str], end: Optional[str]) -> Iterator[Dict]:
+    """Yield entries whose ISO timestamp falls inside [start, end]."""
+    for entry in entries:
+        timestamp = entry.get("timestamp", "")
+        if start and timestamp < start:
+            continue
+        if end and timestamp > end:
+            continue
+        yield entry
+
+
+def to_timestamp(value: Union[str, datetime, None]) -> Optional[str]:
+    """Normalize a datetime or ISO string to the ISO format used in history."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+BACKENDS = {
+    JSONStorage.name: JSONStorage,
+    SQLiteStorage.name: SQLiteStorage,
+}
+
+
+def create_storage(memory_dir: Path, backend: Optional[str] = None, **options: Any) -> MemoryStorage:
+    """Create a storage backend by name.
+
+    When switching an existing JSON memory directory to SQLite for the first
+    time, the JSON data is copied into the new database.
+
+    Args:
+        memory_dir: Directory holding long-term memory
+        backend: Backend name ("json" or "sqlite", defaults to "json")
+        **options: Extra keyword arguments for the backend constructor
+
+    Returns:
+        Storage backend instance
+    """
+    backend = (backend or JSONStorage.name).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown memory backend: {backend} (choose from {', '.join(BACKENDS)})")
+
+    if backend == SQLiteStorage.name:
+        is_new = not (Path(memory_dir) / "memory.db").exists()
+        storage = SQLiteStorage(memory_dir, **options)
+        if is_new:
+            legacy = JSONStorage(memory_dir)
+            if not legacy.is_empty():
+                copy_storage(legacy, storage)
+        return storage
+
+    return JSONStorage(memory_dir, **options)
+
+
+def copy_storage(source: MemoryStorage, target: MemoryStorage) -> None:
+    """Copy every section and the full history from one backend to another."""
+    for section in SECTIONS:
+        target.replace(section, source.get_all(section))
+    target.replace_history(source.iter_history())
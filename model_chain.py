@@ -0,0 +1,287 @@
+"""Health-aware routing across a chain of models."""
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import httpx
+
+from file_lock import atomic_write_json
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_rate_limit(error: Exception) -> bool:
+    """Check whether an error is a rate limit (HTTP 429)."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429
+    return "429" in str(error)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Check whether another model may succeed where this one failed.
+
+    Rate limits, server errors and network failures are retryable; other
+    errors (e.g. a malformed request) would fail on every model.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError) or is_rate_limit(error)
+
+
+class ModelHealth:
+    """Running health figures and circuit breaker state of one model."""
+
+    FIELDS = ("error_rate", "latency", "requests", "failures", "trips", "open_until")
+
+    def __init__(
+        self,
+        error_rate: float = 0.0,
+        latency: Optional[float] = None,
+        requests: int = 0,
+        failures: int = 0,
+        trips: int = 0,
+        open_until: float = 0.0,
+    ):
+        """Initialize the record.
+
+        Args:
+            error_rate: EWMA of failures (0 = none, 1 = every request)
+            latency: EWMA of successful request seconds (None until measured)
+            requests: Requests sent to the model
+            failures: Consecutive failures since the last success
+            trips: Consecutive times the breaker opened (sets the cooldown)
+            open_until: Wall-clock time the open breaker allows a probe (0 = closed)
+        """
+        self.error_rate = error_rate
+        self.latency = latency
+        self.requests = requests
+        self.failures = failures
+        self.trips = trips
+        self.open_until = open_until
+        # Time the pending half-open probe was claimed (not persisted)
+        self.probing = 0.0
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return CLOSED
+        return OPEN if now < self.open_until else HALF_OPEN
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ModelHealth":
+        return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+
+
+class ModelChain:
+    """Orders a chain of models by health, with a circuit breaker per model.
+
+    Requests go to the primary (first) model while it is healthy, otherwise
+    to the fastest healthy fallback. A breaker opens after
+    ``failure_threshold`` consecutive failures, or at once on a rate limit,
+    for a cooldown that doubles with every consecutive trip up to
+    ``max_cooldown``. When the cooldown ends the breaker is half-open: one
+    request probes the model, closing the breaker on success (so traffic
+    returns to a recovered primary) or reopening it on failure.
+
+    Health is saved to ``path`` after every request, so a new process does
+    not retry a model that is still cooling down.
+    """
+
+    def __init__(
+        self,
+        models: Iterable[str],
+        path: Optional[Path] = None,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        max_cooldown: float = 600.0,
+        max_error_rate: float = 0.5,
+        alpha: float = 0.3,
+        probe_timeout: float = 120.0,
+    ):
+        """Initialize the chain.
+
+        Args:
+            models: Model names, primary first
+            path: JSON file health is persisted to (None keeps it in memory)
+            failure_threshold: Consecutive failures that open a breaker
+            cooldown: Seconds a breaker stays open after its first trip
+            max_cooldown: Upper bound of the doubling cooldown
+            max_error_rate: Error rate EWMA above which a closed fallback
+                is only used after the healthy ones
+            alpha: EWMA weight of the newest request
+            probe_timeout: Seconds after which an unfinished probe (e.g. an
+                abandoned stream) no longer blocks the next one
+        """
+        self.models: List[str] = list(dict.fromkeys(models))
+        if not self.models:
+            raise ValueError("Model chain is empty")
+        self.path = Path(path) if path else None
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_error_rate = max_error_rate
+        self.alpha = alpha
+        self.probe_timeout = probe_timeout
+        self._lock = threading.Lock()
+        self._health: Dict[str, ModelHealth] = self._load()
+
+    @property
+    def primary(self) -> str:
+        return self.models[0]
+
+    def prefer(self, model: str) -> None:
+        """Make a model the primary, keeping the rest of the chain as fallbacks."""
+        with self._lock:
+            self.models = [model] + [name for name in self.models if name != model]
+
+    def route(self) -> Iterator[str]:
+        """Yield the models to try for one request, best first.
+
+        Stop iterating once a model succeeds. Each yielded model must be
+        reported with record_success, record_failure or release. A half-open
+        model is yielded only to the request that claimed its probe; if
+        nothing could be claimed the primary is yielded anyway.
+        """
+        claimed = False
+        for name in self._ranked():
+            if self._claim(name):
+                claimed = True
+                yield name
+        if not claimed:
+            yield self.primary
+
+    def record_success(self, model: str, latency: float) -> None:
+        """Record a successful request and close the model's breaker."""
+        with self._lock:
+            health = self._get(model)
+            health.requests += 1
+            health.error_rate = self._ewma(health.error_rate, 0.0)
+            health.latency = latency if health.latency is None else self._ewma(health.latency, latency)
+            health.failures = health.trips = 0
+            health.open_until = health.probing = 0.0
+            self._save()
+
+    def record_failure(self, model: str, error: Exception) -> bool:
+        """Record a failed request, opening the model's breaker when due.
+
+        Errors that are not retryable say nothing about the model's health
+        and are not counted.
+
+        Returns:
+            Whether the request should be retried on the next model
+        """
+        if not is_retryable(error):
+            self.release(model)
+            return False
+        now = time.time()
+        with self._lock:
+            health = self._get(model)
+            health.requests += 1
+            health.failures += 1
+            health.error_rate = self._ewma(health.error_rate, 1.0)
+            # A failed probe reopens the breaker straight away
+            if health.open_until or health.failures >= self.failure_threshold or is_rate_limit(error):
+                health.trips += 1
+                health.open_until = now + min(self.max_cooldown, self.cooldown * 2 ** (health.trips - 1))
+                health.failures = 0
+            health.probing = 0.0
+            self._save()
+        return True
+
+    def release(self, model: str) -> None:
+        """Give up a yielded model without a result (e.g. a cache hit)."""
+        with self._lock:
+            self._get(model).probing = 0.0
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """Return the state and health figures of every model in the chain."""
+        now = time.time()
+        with self._lock:
+            result = {}
+            for name in self.models:
+                health = self._get(name)
+                result[name] = {
+                    "state": health.state(now),
+                    "error_rate": round(health.error_rate, 4),
+                    "latency": round(health.latency, 3) if health.latency is not None else None,
+                    "requests": health.requests,
+                    "retry_in": round(max(0.0, health.open_until - now), 1),
+                }
+            return result
+
+    def _ranked(self) -> List[str]:
+        """Return models worth trying, best first (open breakers excluded)."""
+        now = time.time()
+        with self._lock:
+            healthy, probes, degraded = [], [], []
+            for name in self.models:
+                health = self._get(name)
+                state = health.state(now)
+                if state == HALF_OPEN:
+                    probes.append(name)
+                elif state == CLOSED:
+                    (healthy if health.error_rate <= self.max_error_rate else degraded).append(name)
+            # The breaker alone gates the primary: it must get traffic for
+            # its error rate to recover
+            primary = [self.primary] if self.primary in healthy + probes + degraded else []
+            fastest = sorted(
+                (name for name in healthy if name != self.primary),
+                key=lambda name: (self._health[name].latency is None, self._health[name].latency or 0.0),
+            )
+            probes = [name for name in probes if name != self.primary]
+            degraded = sorted(
+                (name for name in degraded if name != self.primary),
+                key=lambda name: self._health[name].error_rate,
+            )
+            return primary + fastest + probes + degraded
+
+    def _claim(self, model: str) -> bool:
+        """Reserve a model for a request (only one probe per half-open breaker)."""
+        now = time.time()
+        with self._lock:
+            health = self._get(model)
+            if health.state(now) != HALF_OPEN:
+                return True
+            if health.probing and now - health.probing < self.probe_timeout:
+                return False
+            health.probing = now
+            return True
+
+    def _ewma(self, average: float, value: float) -> float:
+        return self.alpha * value + (1 - self.alpha) * average
+
+    def _get(self, model: str) -> ModelHealth:
+        """Return a model's health record (lock held)."""
+        health = self._health.get(model)
+        if health is None:
+            health = self._health[model] = ModelHealth()
+        return health
+
+    def _load(self) -> Dict[str, ModelHealth]:
+        if not self.path or not self.path.exists():
+            return {}
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            return {name: ModelHealth.from_dict(record) for name, record in data.items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            # A damaged health file only costs the learned history
+            return {}
+
+    def _save(self) -> None:
+        """Write every model's health atomically (lock held)."""
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = {name: health.to_dict() for name, health in self._health.items()}
+        try:
+            atomic_write_json(self.path, data, indent=2)
+        except OSError:
+            # Health is advisory; a failed save must not fail the request
+            pass
@@ -0,0 +1,51 @@
+"""Several chat models behind one client."""
+import threading
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+
+
+class ModelRouter:
+    """Chat models by name, created on first use and then reused.
+
+    Models share the process-wide HTTP transport, so switching the active
+    model (e.g. to a fallback after a rate limit) is a dictionary lookup:
+    no new connections, memory or skills are set up.
+    """
+
+    def __init__(self, factory: Callable[[str], BaseChatModel], default: str):
+        """Initialize the router.
+
+        Args:
+            factory: Builds the chat model for a model name
+            default: Model used until use() selects another
+        """
+        self.factory = factory
+        self.active = default
+        self._models: Dict[str, BaseChatModel] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: Optional[str] = None) -> BaseChatModel:
+        """Return the chat model for a name (default: the active model)."""
+        name = name or self.active
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._models[name] = self.factory(name)
+            return model
+
+    def set(self, name: str, model: BaseChatModel) -> None:
+        """Register a ready-made chat model under a name."""
+        with self._lock:
+            self._models[name] = model
+
+    def use(self, name: str) -> BaseChatModel:
+        """Make a model the active one and return it."""
+        model = self.get(name)
+        self.active = name
+        return model
+
+    def models(self) -> List[str]:
+        """Return the names of the models created so far."""
+        with self._lock:
+            return list(self._models)
@@ -0,0 +1,179 @@
+"""Incremental user-profile statistics over long-term history."""
+import heapq
+import json
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict
+
+from file_lock import atomic_write_json
+from memory_storage import MemoryStorage
+
+
+# Skill invocations in assistant replies, e.g. "EXECUTE: python skills/news-search/..."
+_SKILL_RE = re.compile(r"EXECUTE:\s*\S*python\S*\s+skills/([\w-]+)/")
+
+
+class ProfileAnalytics:
+    """Single-pass, checkpointed statistics about how the user interacts.
+
+    Every run reads only the history appended since the previous one and
+    folds it into counters: messages per role, repeated user messages
+    (pruned heavy-hitter counts, read out with a top-k heap), skill
+    searches per source, messages per day and per hour of day, and
+    sessions split on idle gaps. The counters are checkpointed to a JSON
+    file, so refreshing the profile costs O(new entries).
+    """
+
+    VERSION = 1
+    SESSION_GAP_SECONDS = 30 * 60
+    MESSAGE_CHARS = 200
+
+    def __init__(self, storage: MemoryStorage, state_file: Path, message_capacity: int = 2000):
+        """Initialize analytics.
+
+        Args:
+            storage: Storage backend holding the history
+            state_file: Where counters are checkpointed
+            message_capacity: Distinct user messages counted before the
+                rarest half is pruned (bounds memory for the top-k ranking)
+        """
+        self.storage = storage
+        self.state_file = Path(state_file)
+        self.message_capacity = message_capacity
+        self._lock = threading.Lock()
+
+    def update(self) -> int:
+        """Fold new history entries into the counters and checkpoint them.
+
+        Returns:
+            Number of newly processed entries
+        """
+        with self._lock:
+            state = self._load()
+            generation = self.storage.history_generation()
+            if state["generation"] != generation or self.storage.history_count() < state["position"]:
+                state = self._empty_state()
+                state["generation"] = generation
+
+            added = 0
+            for entry in self.storage.iter_history_from(state["position"]):
+                self._add(state, entry)
+                added += 1
+            if added:
+                state["position"] += added
+                self._save(state)
+            return added
+
+    def profile(self, top_k: int = 3) -> Dict[str, Any]:
+        """Return derived profile statistics (call update() first to refresh).
+
+        Args:
+            top_k: Number of most repeated user messages to include
+        """
+        state = self._load()
+        roles = state["roles"]
+        sessions = state["sessions"]
+        searches = sum(state["searches"].values())
+        top_messages = heapq.nlargest(top_k, state["messages"].items(), key=lambda item: (item[1], item[0]))
+        busiest_hours = heapq.nlargest(3, range(24), key=lambda hour: (state["hours"][hour], -hour))
+
+        last = sessions["last"]
+        last_duration = _seconds_between(last["start"], last["end"]) if last else 0
+        return {
+            "total_messages": state["position"],
+            "total_user_messages": roles.get("user", 0),
+            "total_assistant_responses": roles.get("assistant", 0),
+            "top_messages": [list(item) for item in top_messages],
+            "total_searches": searches,
+            "searches_by_source": dict(sorted(state["searches"].items(), key=lambda item: -item[1])),
+            "active_days": len(state["days"]),
+            "first_interaction": state["first"],
+            "last_interaction": state["last"],
+            "busiest_hours": [hour for hour in busiest_hours if state["hours"][hour]],
+            "sessions": sessions["count"],
+            "average_session_minutes": round(sessions["seconds"] / 60 / sessions["count"], 1) if sessions["count"] else 0,
+            "last_session": {
+                "date": last["start"][:10] if last else None,
+                "minutes": round(last_duration / 60, 1),
+                "messages": last["messages"] if last else 0,
+                "searches": last["searches"] if last else 0,
+            },
+        }
+
+    def _add(self, state: Dict[str, Any], entry: Dict) -> None:
+        role = entry.get("role", "")
+        content = str(entry.get("content", ""))
+        timestamp = entry.get("timestamp", "")
+        state["roles"][role] = state["roles"].get(role, 0) + 1
+
+        searches = 0
+        if role == "user":
+            text = " ".join(content.split())[:self.MESSAGE_CHARS]
+            if text:
+                state["messages"][text] = state["messages"].get(text, 0) + 1
+                if len(state["messages"]) > self.message_capacity:
+                    state["messages"] = dict(heapq.nlargest(
+                        self.message_capacity // 2, state["messages"].items(), key=lambda item: item[1]
+                    ))
+        elif role == "assistant":
+            for source in _SKILL_RE.findall(content):
+                state["searches"][source] = state["searches"].get(source, 0) + 1
+                searches += 1
+
+        if not timestamp:
+            return
+        state["first"] = min(state["first"] or timestamp, timestamp)
+        state["last"] = max(state["last"] or timestamp, timestamp)
+        day = timestamp[:10]
+        state["days"][day] = state["days"].get(day, 0) + 1
+        try:
+            state["hours"][int(timestamp[11:13])] += 1
+        except ValueError:
+            pass
+
+        sessions = state["sessions"]
+        last = sessions["last"]
+        if last and 0 <= _seconds_between(last["end"], timestamp) <= self.SESSION_GAP_SECONDS:
+            sessions["seconds"] += _seconds_between(last["end"], timestamp)
+            last["end"] = timestamp
+            last["messages"] += 1
+            last["searches"] += searches
+        else:
+            sessions["count"] += 1
+            sessions["last"] = {"start": timestamp, "end": timestamp, "messages": 1, "searches": searches}
+
+    def _empty_state(self) -> Dict[str, Any]:
+        return {
+            "version": self.VERSION,
+            "generation": None,
+            "position": 0,
+            "roles": {},
+            "messages": {},
+            "searches": {},
+            "days": {},
+            "hours": [0] * 24,
+            "first": None,
+            "last": None,
+            "sessions": {"count": 0, "seconds": 0.0, "last": None},
+        }
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return self._empty_state()
+        return state if state.get("version") == self.VERSION else self._empty_state()
+
+    def _save(self, state: Dict[str, Any]) -> None:
+        atomic_write_json(self.state_file, state, ensure_ascii=False)
+
+
+def _seconds_between(start: str, end: str) -> float:
+    """Return seconds from one ISO timestamp to another (0 if unparsable)."""
+    try:
+        return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,85 @@
+"""System-prompt assembly from cached segments."""
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage, SystemMessage
+
+from token_counter import estimate_tokens
+
+
+class PromptComposer:
+    """Builds the message list sent to the model without touching the caller's.
+
+    The system prompt is assembled from three segments: the caller's base
+    system message, the skills block (rendered once) and the memory block.
+    The assembled system message and its token count are reused while the
+    segments are unchanged, and message token counts are cached per
+    message, so composing the same transcript twice yields the same prompt
+    without re-tokenizing it.
+    """
+
+    def __init__(self, skills_context: str = ""):
+        """Initialize the composer.
+
+        Args:
+            skills_context: Concatenated SKILL.md texts ("" for none)
+        """
+        self.skills_block = f"# Available Skills\n\n{skills_context}" if skills_context else ""
+        # Token count of the most recently composed prompt
+        self.last_tokens = 0
+        self._system: Optional[Tuple[Tuple[str, str], SystemMessage, int]] = None
+        self._message_tokens: Dict[int, Tuple[weakref.ref, int]] = {}
+
+    def compose(self, messages: List[BaseMessage], memory_block: str = "") -> List[BaseMessage]:
+        """Return a new message list with skills and memory in the system prompt.
+
+        The first system message is replaced by base + skills + memory; if
+        there is none and a block is non-empty, one is prepended. Other
+        messages are passed through as the same objects.
+
+        Args:
+            messages: Caller's transcript (not modified)
+            memory_block: Rendered long-term memory ("" for none)
+
+        Returns:
+            Messages to send to the model
+        """
+        index = next((i for i, msg in enumerate(messages) if isinstance(msg, SystemMessage)), None)
+        base = messages[index].content if index is not None else ""
+        composed = list(messages)
+        system, system_tokens = self.system_message(base if isinstance(base, str) else str(base), memory_block)
+        if index is not None:
+            composed[index] = system
+        elif system.content:
+            composed.insert(0, system)
+        else:
+            system_tokens = 0
+
+        self.last_tokens = system_tokens + sum(
+            self.message_tokens(msg) for i, msg in enumerate(messages) if i != index
+        )
+        return composed
+
+    def system_message(self, base: str, memory_block: str = "") -> Tuple[SystemMessage, int]:
+        """Return the assembled system message and its token count (cached)."""
+        key = (base, memory_block)
+        if self._system and self._system[0] == key:
+            return self._system[1], self._system[2]
+        segments = [text for text in (base, self.skills_block, memory_block) if text.strip()]
+        system = SystemMessage(content="\n\n".join(segments))
+        tokens = estimate_tokens(system.content)
+        self._system = (key, system, tokens)
+        return system, tokens
+
+    def message_tokens(self, msg: BaseMessage) -> int:
+        """Return the estimated tokens of one message, cached per message object."""
+        key = id(msg)
+        cached = self._message_tokens.get(key)
+        if cached is not None and cached[0]() is msg:
+            return cached[1]
+        tokens = estimate_tokens(msg.content if isinstance(msg.content, str) else str(msg.content))
+        self._message_tokens[key] = (
+            weakref.ref(msg, lambda _, key=key: self._message_tokens.pop(key, None)),
+            tokens,
+        )
+        return tokens
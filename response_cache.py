@@ -0,0 +1,152 @@
+"""Disk-backed cache of model responses."""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+
+# Prompt parts that change every turn without changing the answer, e.g. the
+# history counter in the injected memory block
+VOLATILE_PATTERNS = (
+    re.compile(r"(Total messages: )\d+"),
+)
+
+
+class ResponseCache:
+    """SQLite cache of responses keyed on model, temperature and prompt.
+
+    Entries expire ``ttl`` seconds after they were stored; past
+    ``max_entries`` the least recently used ones are evicted. Hit, miss and
+    eviction counters are stored in the database, so statistics cover every
+    process sharing the cache file.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at);
+        CREATE TABLE IF NOT EXISTS stats (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO stats (key, value) VALUES ('hits', 0), ('misses', 0), ('evictions', 0);
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_entries: int = 1000,
+        ttl: Optional[float] = 24 * 3600,
+        lock_timeout: float = 10.0,
+    ):
+        """Initialize the cache.
+
+        Args:
+            path: SQLite database file
+            max_entries: Maximum number of cached responses
+            ttl: Seconds a response stays valid (None never expires)
+            lock_timeout: Seconds a write waits for another process's transaction
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=lock_timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, temperature: float, messages: List[BaseMessage]) -> str:
+        """Return the cache key of a request.
+
+        Message text is normalized (surrounding whitespace, line endings
+        and VOLATILE_PATTERNS) so trivially different prompts share a key.
+        """
+        normalized = []
+        for message in messages:
+            content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+            content = content.replace("\r\n", "\n").strip()
+            for pattern in VOLATILE_PATTERNS:
+                content = pattern.sub(r"\g<1>#", content)
+            normalized.append([message.type, content])
+        payload = json.dumps([model, round(float(temperature), 4), normalized], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached response and mark it used (None on a miss)."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self._expired(row[1], now):
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._bump("misses")
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._bump("hits")
+            return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Store a response, evicting expired and least recently used entries."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            evicted = 0
+            if self.ttl is not None:
+                evicted += self._conn.execute(
+                    "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+                ).rowcount
+            excess = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                evicted += self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (excess,),
+                ).rowcount
+            if evicted:
+                self._bump("evictions", evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters, the hit rate and the entry count."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT key, value FROM stats").fetchall())
+            counters["entries"] = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = round(counters["hits"] / lookups, 4) if lookups else 0.0
+        return counters
+
+    def clear(self) -> None:
+        """Drop every cached response and reset the counters."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("UPDATE stats SET value = 0")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and created_at + self.ttl < now
+
+    def _bump(self, counter: str, amount: int = 1) -> None:
+        """Increment a stats counter (lock and transaction held)."""
+        self._conn.execute("UPDATE stats SET value = value + ? WHERE key = ?", (amount, counter))
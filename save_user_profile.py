@@ -3,25 +3,58 @@
 根据内存分析结果保存用户偏好和背景信息
 
 这个脚本分析了 GLM Agent 的内存内容，并基于发现的用户特征
-主动保存用户偏好和上下文信息
+主动保存用户偏好和上下文信息。会话统计由 MemoryManager.get_profile_stats()
+从历史记录增量计算，每次只读取新增的记录，可以在对话中频繁调用。
 """
 
+from typing import Any, Dict, Optional
+
 from glm_langchain_client import GLMClient
-import json
-from datetime import datetime
+from memory_manager import MemoryManager
+
+
+# 会话统计在上下文中保留的秒数
+SESSION_STATS_TTL = 7 * 24 * 3600
+
+
+def _session_stats(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """把 get_profile_stats() 的结果转换为保存到上下文的会话统计"""
+    last_session = stats["last_session"]
+    hours = last_session["minutes"] / 60
+    return {
+        "search_frequency": f"{last_session['searches']} searches in {hours:.1f} hours "
+                            f"({stats['total_searches']} total)",
+        "total_messages": stats["total_messages"],
+        "total_user_messages": stats["total_user_messages"],
+        "total_assistant_responses": stats["total_assistant_responses"],
+        "interaction_date": last_session["date"],
+        "interaction_duration": f"{hours:.1f} hours",
+    }
+
+
+def _log(verbose: bool, *args) -> None:
+    """verbose 为 True 时打印"""
+    if verbose:
+        print(*args)
 
 
-def save_analyzed_user_profile():
-    """根据内存分析结果保存用户画像"""
+def save_analyzed_user_profile(memory: Optional[MemoryManager] = None, verbose: bool = True):
+    """根据内存分析结果保存用户画像
     
-    # 初始化客户端（启用内存）
-    client = GLMClient(enable_memory=True)
+    Args:
+        memory: 要更新的 MemoryManager（默认按 config.properties 打开 .memories/）
+        verbose: 是否打印保存过程
+    """
     
-    print("📊 基于内存分析保存用户偏好和背景信息\n")
+    # 只需要内存，不创建模型客户端
+    if memory is None:
+        memory = MemoryManager(**GLMClient.memory_options_from_config(GLMClient._load_config()))
+    
+    _log(verbose, "📊 基于内存分析保存用户偏好和背景信息\n")
     
     # 1. 保存用户偏好 (Preferences)
-    print("1️⃣ 保存用户偏好...")
-    print("-" * 60)
+    _log(verbose, "1️⃣ 保存用户偏好...")
+    _log(verbose, "-" * 60)
     
     preferences = {
         "content_type": "movies_and_tv",
@@ -31,56 +64,51 @@ def save_analyzed_user_profile():
     }
     
     for key, value in preferences.items():
-        client.memory.save_preference(key, value)
-        print(f"   ✓ {key} = {value}")
+        _log(verbose, f"   ✓ {key} = {value}")
     
-    print()
+    _log(verbose)
     
     # 2. 保存用户背景信息 (Context)
-    print("2️⃣ 保存用户背景信息...")
-    print("-" * 60)
+    _log(verbose, "2️⃣ 保存用户背景信息...")
+    _log(verbose, "-" * 60)
     
     context_data = {
         "primary_interest": "电影电视剧推荐",
         "interaction_style": "简短请求 + 验证类回应",
-        "search_frequency": "高频（2.5小时内24次搜索）",
-        "total_messages": 213,
-        "total_user_messages": 182,
-        "total_assistant_responses": 31,
-        "interaction_date": "2026-02-14",
-        "interaction_duration": "2.5 hours",
         "preferred_search_sources": ["news-search", "china-search"],
     }
     
-    for key, value in context_data.items():
-        client.memory.save_context(key, value)
-        print(f"   ✓ {key}")
+    # 会话统计来自历史记录的增量分析；很快过时，7 天后自动过期，不再注入提示
+    stats = memory.get_profile_stats(top_k=3)
+    session_stats = _session_stats(stats)
     
-    print()
+    for key in list(context_data) + list(session_stats):
+        _log(verbose, f"   ✓ {key}")
+    
+    _log(verbose)
     
     # 3. 保存用户行为分析 (Context)
-    print("3️⃣ 保存用户行为分析...")
-    print("-" * 60)
+    _log(verbose, "3️⃣ 保存用户行为分析...")
+    _log(verbose, "-" * 60)
     
     behavior_analysis = {
-        "top_message_1": ("Based on the actual result above, answer my question.", 90),
-        "top_message_2": ("ok", 43),
-        "top_message_3": ("推荐最近的好看的可以在大陆看的电影电视剧", 16),
+        f"top_message_{rank}": tuple(item) for rank, item in enumerate(stats["top_messages"], 1)
+    }
+    behavior_analysis.update({
         "user_trait_1": "喜欢电影电视剧推荐（主要需求）",
         "user_trait_2": "明确表达偏好'有性感美女的'内容",
         "user_trait_3": "对经济新闻有次要兴趣",
         "user_trait_4": "经常重复搜索已看过的内容",
         "interaction_pattern": "高频率、简短请求",
-    }
+    })
     
-    client.memory.save_context("user_behavior_analysis", behavior_analysis)
-    print("   ✓ 用户行为分析已保存")
+    _log(verbose, "   ✓ 用户行为分析")
     
-    print()
+    _log(verbose)
     
     # 4. 保存推荐优化建议
-    print("4️⃣ 保存推荐优化建议...")
-    print("-" * 60)
+    _log(verbose, "4️⃣ 保存推荐优化建议...")
+    _log(verbose, "-" * 60)
     
     recommendations = {
         "optimization_1": "实现去重机制，避免重复推荐已看过的内容",
@@ -91,9 +119,18 @@ def save_analyzed_user_profile():
     }
     
     for key, value in recommendations.items():
-        print(f"   ✓ {value}")
+        _log(verbose, f"   ✓ {value}")
+    
+    # 一次事务写入以上所有偏好和背景信息（每个文件只读写一次）
+    with memory.transaction():
+        memory.save_preferences(preferences)
+        memory.save_contexts(context_data)
+        memory.save_contexts(session_stats, ttl=SESSION_STATS_TTL)
+        memory.save_context("user_behavior_analysis", behavior_analysis)
+        memory.save_context("optimization_recommendations", recommendations)
     
-    client.memory.save_context("optimization_recommendations", recommendations)
+    if not verbose:
+        return
     
     print()
     
@@ -101,7 +138,7 @@ def save_analyzed_user_profile():
     print("5️⃣ 验证保存结果...")
     print("-" * 60)
     
-    summary = client.memory.get_memory_summary()
+    summary = memory.get_memory_summary()
     print(summary)
     
     print()
@@ -113,7 +150,7 @@ def save_analyzed_user_profile():
     print("-" * 60)
     print("   • .memories/preferences.json")
     print("   • .memories/context.json")
-    print("   • .memories/history.json")
+    print("   • .memories/history/")
     print()
     
     # 7. 显示如何使用这些信息
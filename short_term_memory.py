@@ -0,0 +1,156 @@
+"""Bounded short-term (session) memory."""
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Union
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from token_counter import estimate_tokens
+
+
+class ShortTermMessage:
+    """Compact record of one session message."""
+
+    __slots__ = ("role", "content", "type", "tokens")
+
+    def __init__(self, role: str, content: Union[str, list], type: str):
+        self.role = role
+        self.content = content
+        self.type = type
+        # Multimodal messages carry a list of content blocks
+        self.tokens = estimate_tokens(content if isinstance(content, str) else str(content))
+
+    @classmethod
+    def from_message(cls, message: BaseMessage) -> "ShortTermMessage":
+        """Build a record from a LangChain message."""
+        return cls(
+            role="user" if isinstance(message, HumanMessage) else "assistant",
+            content=message.content,
+            type=type(message).__name__,
+        )
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content, "type": self.type}
+
+
+class ShortTermBuffer:
+    """Ring buffer of session messages capped by count and/or tokens.
+
+    When a cap is exceeded the oldest messages are evicted. The first few
+    words of evicted user turns are kept in a small rollup, so a day-long
+    session uses constant memory but still remembers what was discussed.
+    """
+
+    def __init__(
+        self,
+        max_messages: Optional[int] = 200,
+        max_tokens: Optional[int] = None,
+        rollup_items: int = 10,
+        rollup_chars: int = 60,
+    ):
+        """Initialize the buffer.
+
+        Args:
+            max_messages: Maximum number of messages kept (None for no limit)
+            max_tokens: Maximum estimated tokens kept (None for no limit)
+            rollup_items: Number of evicted user turns remembered in the rollup
+            rollup_chars: Characters kept from each rolled-up turn
+        """
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.rollup_chars = rollup_chars
+        self._messages: Deque[ShortTermMessage] = deque()
+        self._rollup: Deque[str] = deque(maxlen=rollup_items)
+        self.tokens = 0
+        self.evicted = 0
+
+    def append(self, record: ShortTermMessage) -> None:
+        """Add a message, evicting the oldest ones past the caps."""
+        self._messages.append(record)
+        self.tokens += record.tokens
+        while self._messages and self._over_limit():
+            self._evict()
+
+    def clear(self) -> None:
+        """Drop every message and the rollup."""
+        self._messages.clear()
+        self._rollup.clear()
+        self.tokens = 0
+        self.evicted = 0
+
+    def rollup(self) -> str:
+        """Return a one-line digest of evicted user turns ("" if none)."""
+        if not self._rollup:
+            return ""
+        return f"Earlier in this session ({self.evicted} messages): " + " | ".join(self._rollup)
+
+    def to_dicts(self) -> List[Dict[str, str]]:
+        return [record.to_dict() for record in self._messages]
+
+    def __iter__(self) -> Iterator[ShortTermMessage]:
+        return iter(self._messages)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def _over_limit(self) -> bool:
+        if self.max_messages is not None and len(self._messages) > self.max_messages:
+            return True
+        return self.max_tokens is not None and self.tokens > self.max_tokens and len(self._messages) > 1
+
+    def _evict(self) -> None:
+        record = self._messages.popleft()
+        self.tokens -= record.tokens
+        self.evicted += 1
+        if record.role == "user":
+            text = record.content if isinstance(record.content, str) else str(record.content)
+            self._rollup.append(text[:self.rollup_chars])
+
+
+def trim_messages(
+    messages: List[BaseMessage],
+    max_messages: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    count: Optional[Callable[[BaseMessage], int]] = None,
+) -> int:
+    """Drop the oldest turns of a chat transcript in place.
+
+    Leading system messages and the latest user message are always kept,
+    and the kept tail starts at a user message so the model never sees an
+    orphaned reply.
+
+    Args:
+        messages: Transcript to trim (modified in place)
+        max_messages: Maximum number of non-system messages kept
+        max_tokens: Maximum estimated tokens of non-system messages kept
+        count: Token counter for one message (defaults to estimate_tokens
+            of its content)
+
+    Returns:
+        Number of messages removed
+    """
+    start = 0
+    while start < len(messages) and isinstance(messages[start], SystemMessage):
+        start += 1
+
+    cut = start
+    if max_messages is not None:
+        cut = max(cut, len(messages) - max_messages)
+    if max_tokens is not None:
+        total = 0
+        for i in range(len(messages) - 1, cut - 1, -1):
+            total += count(messages[i]) if count else estimate_tokens(str(messages[i].content))
+            if total > max_tokens:
+                cut = i + 1
+                break
+    # Never drop the latest user turn, however large it is
+    last_user = max(
+        (i for i in range(start, len(messages)) if isinstance(messages[i], HumanMessage)),
+        default=len(messages),
+    )
+    cut = min(cut, last_user)
+    if cut == start:
+        return 0
+    while cut < len(messages) and not isinstance(messages[cut], HumanMessage):
+        cut += 1
+    del messages[start:cut]
+    return cut - start
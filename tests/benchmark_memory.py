@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""MemoryManager benchmarks at realistic memory sizes.
+
+Seeds a temporary memory directory with N history entries plus large
+preference and context maps, times the operations every chat turn relies
+on and writes the results as JSON so runs can be compared across versions.
+
+Examples:
+    python tests/benchmark_memory.py
+    python tests/benchmark_memory.py --sizes 1000 10000 --backends json sqlite
+    python tests/benchmark_memory.py --output new.json --baseline old.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# Add parent directory to path
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from memory_manager import MemoryManager
+
+
+SEED_BATCH = 1000
+SAMPLE_MESSAGES = [
+    "推荐最近的好看的可以在大陆看的电影电视剧",
+    "Based on the actual result above, answer my question.",
+    "ok",
+    "latest NBA scores and news about the Lakers",
+    "今天的经济新闻有哪些？",
+]
+
+
+def seed_memory(memory: MemoryManager, entries: int, map_size: int) -> None:
+    """Fill memory with history entries and preference/context maps."""
+    start = datetime(2026, 1, 1)
+    for offset in range(0, entries, SEED_BATCH):
+        memory.add_history_entries([
+            {
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": f"{SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)]} #{i}",
+                "timestamp": (start + timedelta(minutes=i)).isoformat(),
+            }
+            for i in range(offset, min(offset + SEED_BATCH, entries))
+        ])
+    memory.save_preferences({f"preference_{i}": f"value {i}" for i in range(map_size)})
+    memory.save_contexts({f"context_{i}": {"note": f"context value {i}", "rank": i} for i in range(map_size)})
+
+
+def measure(func: Callable[[int], object], repeat: int) -> Dict[str, float]:
+    """Time repeated calls of func(i) and summarize them in milliseconds."""
+    samples = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "runs": repeat,
+        "mean_ms": round(statistics.fmean(samples), 4),
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "min_ms": round(samples[0], 4),
+        "max_ms": round(samples[-1], 4),
+    }
+
+
+def benchmark_size(backend: str, entries: int, map_size: int, repeat: int, workdir: Path) -> List[Dict]:
+    """Run every benchmark against one seeded memory directory."""
+    memory_dir = workdir / f"{backend}-{entries}"
+    options = {"backend": backend}
+    memory = MemoryManager(memory_dir=str(memory_dir), **options)
+
+    started = time.perf_counter()
+    seed_memory(memory, entries, map_size)
+    seed_ms = (time.perf_counter() - started) * 1000
+
+    # Heavy whole-memory operations run fewer times
+    bulk_repeat = max(1, min(repeat, 5))
+    export_file = workdir / f"{backend}-{entries}-export.ndjson"
+    import_dirs = iter(range(bulk_repeat))
+
+    def import_once(_):
+        target = MemoryManager(memory_dir=str(workdir / f"{backend}-{entries}-import-{next(import_dirs)}"), **options)
+        target.import_long_term_memory(str(export_file))
+
+    def summary_cold(_):
+        # A fresh manager has no memoized summary, as at process start
+        MemoryManager(memory_dir=str(memory_dir), **options).get_memory_summary()
+
+    operations = [
+        ("add_to_history", repeat, lambda i: memory.add_to_history("user", f"benchmark message {i}")),
+        ("get_history_limit_20", repeat, lambda i: memory.get_history(limit=20)),
+        ("get_history_limit_200", repeat, lambda i: memory.get_history(limit=200)),
+        ("get_memory_summary_cold", bulk_repeat, summary_cold),
+        ("get_memory_summary_warm", repeat, lambda i: memory.get_memory_summary()),
+        ("save_preference", repeat, lambda i: memory.save_preference(f"preference_{i}", f"updated {i}")),
+        ("get_preference", repeat, lambda i: memory.get_preference(f"preference_{i}")),
+        ("export_ndjson", bulk_repeat, lambda i: memory.export_long_term_memory(str(export_file))),
+        ("import_ndjson", bulk_repeat, import_once),
+    ]
+
+    results = [{"backend": backend, "entries": entries, "operation": "seed", "runs": 1, "mean_ms": round(seed_ms, 4)}]
+    for name, runs, func in operations:
+        stats = measure(func, runs)
+        results.append({"backend": backend, "entries": entries, "operation": name, **stats})
+        print(f"  {backend:6} {entries:>7} {name:25} median {stats['median_ms']:10.3f} ms  p95 {stats['p95_ms']:10.3f} ms")
+    memory.storage.close()
+    return results
+
+
+def git_revision() -> Optional[str]:
+    """Return the current commit of the repository, if available."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict], baseline_file: Path) -> None:
+    """Print the median-time ratio of each operation against a previous run."""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {
+        (r["backend"], r["entries"], r["operation"]): r
+        for r in baseline["results"]
+    }
+    print(f"\nCompared with {baseline_file} ({baseline['meta'].get('revision')}):")
+    for result in results:
+        old = previous.get((result["backend"], result["entries"], result["operation"]))
+        key = "median_ms" if "median_ms" in result else "mean_ms"
+        if not old or not old.get(key):
+            continue
+        ratio = result[key] / old[key]
+        print(f"  {result['backend']:6} {result['entries']:>7} {result['operation']:25} x{ratio:6.2f}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="History sizes to seed (default: 1000 10000 100000)")
+    parser.add_argument("--backends", nargs="+", default=["json", "sqlite"], choices=["json", "sqlite"])
+    parser.add_argument("--map-size", type=int, default=1000,
+                        help="Number of preference and of context keys to seed (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=50, help="Runs per fast operation (default: 50)")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="memory-bench-") as tmp:
+        for backend in args.backends:
+            for entries in args.sizes:
+                results.extend(benchmark_size(backend, entries, args.map_size, args.repeat, Path(tmp)))
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "sizes": args.sizes,
+            "map_size": args.map_size,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        compare(results, Path(args.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""Offline tests for GLMClient bookkeeping (the model call is faked)."""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import httpx
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+from context_window import ContextWindow, count_message_tokens
+from glm_langchain_client import GLMClient
+import http_transport
+from memory_namespaces import MemoryNamespaces
+from model_chain import ModelChain
+from response_cache import ResponseCache
+from token_counter import estimate_tokens
+
+
+class FakeChat:
+    """Stand-in for ChatZhipuAI that echoes the last user message."""
+
+    def __init__(self, name="echo", errors=()):
+        self.name = name
+        self.calls = []
+        self.errors = list(errors)  # raised by the first calls, in order
+
+    def invoke(self, messages):
+        self.calls.append(list(messages))
+        if self.errors:
+            raise self.errors.pop(0)
+        return AIMessage(content=f"{self.name}: {messages[-1].content}")
+
+    async def agenerate(self, batch):
+        message = self.invoke(batch[0])
+        return LLMResult(generations=[[ChatGeneration(message=message)]])
+
+    def stream(self, messages):
+        for word in self.invoke(messages).content.split(" "):
+            yield AIMessageChunk(content=word + " ")
+
+    async def astream(self, messages):
+        for chunk in self.stream(messages):
+            yield chunk
+
+
+def make_client(memory_dir, **options):
+    """Build a GLMClient with a fake model and an isolated memory directory."""
+    options.setdefault("health_path", "")
+    with mock.patch.dict(os.environ, {"ZHIPUAI_API_KEY": "test.secret"}):
+        client = GLMClient(memory_dir=memory_dir, **options)
+    client.chat = FakeChat()
+    return client
+
+
+def test_invoke_records_only_new_messages():
+    """A growing transcript is written to history once, not once per turn."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        messages = [SystemMessage(content="You are a helpful assistant.")]
+
+        for turn in ("你好", "推荐电影", "ok"):
+            messages.append(HumanMessage(content=turn))
+            messages.append(AIMessage(content=client.invoke(messages)))
+
+        history = client.memory.get_history()
+        assert [(h["role"], h["content"]) for h in history] == [
+            ("user", "你好"), ("assistant", "echo: 你好"),
+            ("user", "推荐电影"), ("assistant", "echo: 推荐电影"),
+            ("user", "ok"), ("assistant", "echo: ok"),
+        ]
+
+
+def test_invoke_batches_history_write_per_turn():
+    """Each turn persists its new entries with a single storage append."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        messages = [HumanMessage(content="first"), HumanMessage(content="second")]
+
+        with mock.patch.object(
+            client.memory.storage, "append_history", wraps=client.memory.storage.append_history
+        ) as append:
+            client.invoke(messages)
+            assert append.call_count == 1
+            assert [e["role"] for e in append.call_args[0][0]] == ["user", "user", "assistant"]
+
+
+def test_invoke_defers_disk_writes():
+    """History is buffered during the turn and written to disk on flush."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        inner = client.memory.storage.inner
+
+        with mock.patch.object(inner, "append_history", wraps=inner.append_history) as append:
+            client.invoke([HumanMessage(content="hello")])
+            assert append.call_count == 0
+            client.memory.flush()
+            assert append.call_count == 1
+
+
+def test_invoke_injects_only_relevant_memory():
+    """The system prompt carries memory items that match the user turn."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        client.memory.save_context("primary_interest", "电影电视剧推荐")
+        client.memory.save_context("favorite_team", "Lakers NBA")
+
+        client.invoke([SystemMessage(content="base"), HumanMessage(content="推荐电影")])
+        system = client.chat.calls[-1][0].content
+        assert "primary_interest" in system
+        assert "favorite_team" not in system
+
+
+def test_invoke_uses_per_call_memory():
+    """A namespace passed to invoke() receives the history instead of client.memory."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        namespaces = MemoryNamespaces(Path(tmp) / "sessions", **client.memory_options)
+
+        with namespaces.session("alice") as memory:
+            client.invoke([HumanMessage(content="hello")], memory=memory)
+            assert [h["content"] for h in memory.get_history()] == ["hello", "echo: hello"]
+        assert client.memory.get_history() == []
+        assert namespaces.get("bob").get_history() == []
+
+
+def test_invoke_leaves_caller_messages_untouched():
+    """Skills and memory are composed per call, so a reused transcript never grows."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        client.memory.save_context("primary_interest", "电影电视剧推荐")
+        base = SystemMessage(content="base")
+        messages = [base, HumanMessage(content="推荐电影")]
+
+        client.invoke(messages)
+        first_system = client.chat.calls[-1][0]
+        first_tokens = client.last_prompt_tokens
+        assert messages[0] is base and len(messages) == 2
+        assert first_system.content.startswith("base\n\n# Available Skills")
+        assert "primary_interest" in first_system.content
+
+        assert first_tokens == sum(estimate_tokens(msg.content) for msg in client.chat.calls[-1])
+
+        client.invoke(messages)
+        second_system = client.chat.calls[-1][0]
+        assert second_system.content.count("# Available Skills") == 1
+        assert abs(len(second_system.content) - len(first_system.content)) < 10
+
+        # Same segments give the same cached system message
+        again = client.composer.compose(messages, "memory")
+        assert client.composer.compose(messages, "memory")[0] is again[0]
+
+
+def _transcript(turns):
+    """Build a system prompt plus turns of (question, command output, summary)."""
+    messages = [SystemMessage(content="base")]
+    for i in range(turns):
+        messages.append(HumanMessage(content=f"question {i} " + "word " * 40))
+        messages.append(AIMessage(content=f"Command executed: search {i}\nResult: " + "data " * 200))
+        messages.append(HumanMessage(content="summarize"))
+        messages.append(AIMessage(content=f"summary {i}"))
+    messages.append(HumanMessage(content="latest question"))
+    return messages
+
+
+def test_truncation_policies_fit_the_budget():
+    """Each policy keeps the system prompt and latest turn within the token budget."""
+    messages = _transcript(6)
+    snapshot = list(messages)
+    total = sum(map(count_message_tokens, messages))
+
+    for policy in ("sliding_window", "keep_tool_results", "summarize_oldest"):
+        window = ContextWindow(max_tokens=900, reserve_tokens=100, policy=policy)
+        fitted = window.fit(messages)
+        assert sum(map(count_message_tokens, fitted)) <= 800 < total
+        assert fitted[0].content.startswith("base") and fitted[-1] is messages[-1]
+        assert isinstance(fitted[1], HumanMessage)
+    assert messages == snapshot
+
+    # Older command output is reduced to the command line, even when it fits
+    fitted = ContextWindow(max_tokens=100000, policy="keep_tool_results").fit(messages)
+    results = [m.content for m in fitted if m.content.startswith("Command executed:")]
+    assert results[:4] == [f"Command executed: search {i}\n[Result omitted]" for i in range(4)]
+    assert all(r.startswith("Command executed: search") and "data" in r for r in results[4:])
+
+    fitted = ContextWindow(max_tokens=900, reserve_tokens=100, policy="summarize_oldest").fit(messages)
+    assert "Earlier in this conversation" in fitted[0].content and "question 0" in fitted[0].content
+
+
+def test_invoke_fits_prompt_to_context_window():
+    """A transcript larger than the model window is cut before sending, not after failing."""
+    with tempfile.TemporaryDirectory() as tmp:
+        with mock.patch.dict(os.environ, {"ZHIPUAI_API_KEY": "test.secret"}):
+            client = GLMClient(memory_dir=tmp, skills_dir=tmp, context_window=6000, truncation="sliding_window",
+                               health_path="")
+        client.chat = FakeChat()
+        messages = _transcript(10)
+
+        assert client.invoke(messages) == "echo: latest question"
+        sent = client.chat.calls[-1]
+        assert 2 < len(sent) < len(messages)
+        assert client.last_prompt_tokens == sum(map(count_message_tokens, sent))
+        assert client.last_prompt_tokens <= client.context_window.budget
+
+
+def test_stream_yields_chunks_and_records_history_at_the_end():
+    """Chunks arrive one by one; history is written only for completed streams."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        messages = [HumanMessage(content="tell me a story")]
+
+        stream = client.stream(messages)
+        assert next(stream) == "echo: "
+        assert client.memory.get_history() == []
+        assert "".join(stream) == "tell me a story "
+        assert [h["content"] for h in client.memory.get_history()] == ["tell me a story", "echo: tell me a story "]
+
+        # An abandoned stream is not recorded
+        messages.append(HumanMessage(content="again"))
+        partial = client.stream(messages)
+        next(partial)
+        partial.close()
+        assert len(client.memory.get_history()) == 2
+
+        async def collect():
+            return [chunk async for chunk in client.astream(messages)]
+
+        assert "".join(asyncio.run(collect())) == "echo: again "
+        assert [h["content"] for h in client.memory.get_history()][2:] == ["again", "echo: again "]
+
+
+def test_response_cache_hits_bypasses_and_evicts():
+    """Repeated prompts are answered from disk; bypass, TTL and LRU bounds apply."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ResponseCache(Path(tmp) / "responses.db", max_entries=2)
+        with mock.patch.dict(os.environ, {"ZHIPUAI_API_KEY": "test.secret"}):
+            client = GLMClient(memory_dir=tmp, response_cache=cache, health_path="")
+        client.chat = FakeChat()
+
+        def ask(text, **kwargs):
+            return client.invoke([SystemMessage(content="base"), HumanMessage(content=text)], **kwargs)
+
+        assert ask("推荐电影") == ask("  推荐电影\n") == "echo: 推荐电影"
+        assert len(client.chat.calls) == 1
+        assert len(client.memory.get_history()) == 4  # bookkeeping still runs on hits
+        ask("推荐电影", use_cache=False)
+        assert len(client.chat.calls) == 2
+        assert "".join(client.stream([SystemMessage(content="base"), HumanMessage(content="推荐电影")])) == "echo: 推荐电影"
+        assert len(client.chat.calls) == 2
+
+        ask("b")
+        ask("推荐电影")
+        ask("c")  # evicts "b", the least recently used
+        assert cache.stats()["entries"] == 2
+        ask("b")
+        assert len(client.chat.calls) == 5
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 4, 2)
+
+        cache.ttl = 0.01
+        time.sleep(0.05)
+        ask("c")
+        assert len(client.chat.calls) == 6
+
+
+def test_use_model_switches_without_rebuilding():
+    """Switching models reuses the client's memory, skills and chat instances."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        memory, composer, primary = client.memory, client.composer, client.chat
+
+        client.use_model("glm-4.6v")
+        fallback = client.chat
+        assert client.model == "glm-4.6v" and fallback is not primary
+        assert fallback.model_name == "glm-4.6v" and isinstance(fallback, http_transport.PooledChatZhipuAI)
+        assert client.context_window.max_tokens == 128000
+
+        client.use_model("glm-4.7")
+        assert client.chat is primary and client.context_window.max_tokens == 200000
+        client.use_model("glm-4.6v")
+        assert client.chat is fallback
+        assert client.memory is memory and client.composer is composer
+        assert sorted(client.router.models()) == ["glm-4.6v", "glm-4.7"]
+
+
+def test_pooled_models_share_one_http_client():
+    """Every model sends over the same keep-alive client with a reused token."""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        payload = json.loads(request.content)
+        if payload["stream"]:
+            body = (
+                'data: {"choices": [{"delta": {"role": "assistant", "content": "he"}}]}\n\n'
+                'data: {"choices": [{"delta": {"content": "llo"}, "finish_reason": "stop"}]}\n\n'
+            )
+            return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={
+            "choices": [{"message": {"role": "assistant", "content": f"from {payload['model']}"}}],
+        })
+
+    pooled = httpx.Client(transport=httpx.MockTransport(handler))
+    with mock.patch.object(http_transport, "shared_client", return_value=pooled), \
+            mock.patch.dict(os.environ, {"ZHIPUAI_API_KEY": "test.secret"}):
+        first = http_transport.PooledChatZhipuAI(model="glm-4.7")
+        second = http_transport.PooledChatZhipuAI(model="glm-4.6v")
+        assert first.invoke([HumanMessage(content="hi")]).content == "from glm-4.7"
+        assert second.invoke([HumanMessage(content="hi")]).content == "from glm-4.6v"
+        assert "".join(chunk.content for chunk in first.stream([HumanMessage(content="hi")])) == "hello"
+
+    assert len(requests) == 3
+    assert len({r.headers["Authorization"] for r in requests}) == 1
+
+
+def _http_error(status):
+    request = httpx.Request("POST", "https://open.bigmodel.cn/api/paas/v4/chat/completions")
+    return httpx.HTTPStatusError(f"{status} error", request=request, response=httpx.Response(status, request=request))
+
+
+def test_chain_fails_over_and_returns_to_recovered_primary():
+    """A rate-limited primary is skipped while open, probed when half-open, then used again."""
+    with tempfile.TemporaryDirectory() as tmp:
+        health_path = Path(tmp) / "health.json"
+        client = make_client(tmp, model_chain=["glm-4.6v", "glm-4.5"], health_path=str(health_path))
+        primary = client.chat = FakeChat("primary", errors=[_http_error(429)])
+        client.router.set("glm-4.6v", FakeChat("slow"))
+        client.router.set("glm-4.5", FakeChat("fast"))
+        client.chain.record_success("glm-4.6v", 3.0)
+        client.chain.record_success("glm-4.5", 1.0)
+
+        assert client.invoke([HumanMessage(content="hi")]) == "fast: hi"
+        assert client.last_model == "glm-4.5" and client.model == "glm-4.7"
+        assert client.chain.status()["glm-4.7"]["state"] == "open"
+        assert "".join(client.stream([HumanMessage(content="again")])) == "fast: again "
+        assert len(primary.calls) == 1
+
+        # Health survives a restart, so a new client does not retry the primary yet
+        assert json.loads(health_path.read_text())["glm-4.7"]["trips"] == 1
+        restarted = make_client(tmp, model_chain=["glm-4.6v"], health_path=str(health_path))
+        assert restarted.chain.status()["glm-4.7"]["state"] == "open"
+
+        client.chain._health["glm-4.7"].open_until = time.time() - 1
+        assert client.chain.status()["glm-4.7"]["state"] == "half_open"
+        assert client.invoke([HumanMessage(content="back")]) == "primary: back"
+        assert client.last_model == "glm-4.7" and client.chain.status()["glm-4.7"]["state"] == "closed"
+
+        # Errors another model would hit too are raised, not failed over
+        primary.errors.append(_http_error(400))
+        try:
+            client.invoke([HumanMessage(content="bad")])
+            raise AssertionError("expected HTTPStatusError")
+        except httpx.HTTPStatusError:
+            pass
+        assert client.chain.status()["glm-4.7"]["state"] == "closed"
+
+
+def test_concurrent_calls_route_independently():
+    """Concurrent calls each use the model routed to them, not a client-wide switch."""
+
+    class SlowChat(FakeChat):
+        async def agenerate(self, batch):
+            await asyncio.sleep(0.01)
+            return await super().agenerate(batch)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp, model_chain=["glm-4.5"])
+        primary = client.chat = SlowChat("primary")
+        fallback = SlowChat("fallback")
+        client.router.set("glm-4.5", fallback)
+        client.chain.record_failure("glm-4.7", _http_error(429))
+        client.chain._health["glm-4.7"].open_until = time.time() - 1  # half-open: one probe
+
+        async def both():
+            return await asyncio.gather(
+                client.ainvoke([HumanMessage(content="a")]),
+                client.ainvoke([HumanMessage(content="b")]),
+            )
+
+        # Either call may claim the probe; the other goes to the fallback
+        replies = asyncio.run(both())
+        assert sorted(replies) in (["fallback: b", "primary: a"], ["fallback: a", "primary: b"])
+        assert len(primary.calls) == len(fallback.calls) == 1
+        assert client.model == "glm-4.7"
+        status = client.chain.status()
+        assert status["glm-4.7"]["state"] == "closed" and status["glm-4.7"]["requests"] == 2
+        assert status["glm-4.5"]["requests"] == 1
+
+
+def test_circuit_breaker_backoff_and_single_probe():
+    """Cooldowns double per trip up to the cap, and a half-open breaker admits one probe."""
+    chain = ModelChain(["a", "b"], failure_threshold=2, cooldown=10, max_cooldown=25)
+    now = 1000.0
+    with mock.patch("model_chain.time.time", side_effect=lambda: now):
+        server_error = _http_error(503)
+        assert chain.record_failure("a", server_error)
+        assert list(chain.route()) == ["a", "b"]
+        chain.record_failure("a", server_error)
+        assert chain.status()["a"]["retry_in"] == 10 and list(chain.route()) == ["b"]
+
+        for expected in (20, 25):
+            now += 30
+            probe = chain.route()
+            assert next(probe) == "a"
+            assert list(chain.route()) == ["b"]  # the probe is taken
+            chain.record_failure("a", server_error)
+            assert chain.status()["a"]["retry_in"] == expected
+
+        now += 30
+        assert next(chain.route()) == "a"
+        chain.record_success("a", 0.5)
+        assert chain.status()["a"] == {
+            "state": "closed", "error_rate": chain.status()["a"]["error_rate"], "latency": 0.5,
+            "requests": 5, "retry_in": 0.0,
+        }
+        assert not chain.record_failure("a", ValueError("bad prompt"))
+        assert list(chain.route()) == ["a", "b"]
+
+
+def test_ainvoke_does_memory_io_off_the_event_loop():
+    """ainvoke reads and writes memory on the I/O executor, not the loop thread."""
+    with tempfile.TemporaryDirectory() as tmp:
+        client = make_client(tmp)
+        client.memory.save_context("primary_interest", "电影电视剧推荐")
+        storage = client.memory.storage
+        threads = set()
+
+        def spy(method):
+            def wrapper(*args, **kwargs):
+                threads.add(threading.current_thread().name)
+                return method(*args, **kwargs)
+            return wrapper
+
+        async def chat():
+            messages = [SystemMessage(content="base"), HumanMessage(content="推荐电影")]
+            with mock.patch.object(storage, "get_all", spy(storage.get_all)), \
+                    mock.patch.object(storage, "append_history", spy(storage.append_history)):
+                return await client.ainvoke(messages), threading.current_thread().name
+
+        response, loop_thread = asyncio.run(chat())
+        assert response == "echo: 推荐电影"
+        assert "primary_interest" in client.chat.calls[-1][0].content
+        assert threads and loop_thread not in threads
+        assert [h["content"] for h in client.memory.get_history()] == ["推荐电影", "echo: 推荐电影"]
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_") and callable(func):
+            func()
+            print(f"✅ {name}")
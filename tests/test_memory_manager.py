@@ -0,0 +1,822 @@
+#!/usr/bin/env python3
+"""Offline tests for MemoryManager storage (no API key required)."""
+import asyncio
+import json
+import multiprocessing
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+from unittest import mock
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from file_lock import atomic_write_json
+from history_search import tokenize
+import memory_manager
+from memory_manager import MemoryManager
+from memory_namespaces import MemoryNamespaces
+import memory_storage
+from memory_storage import SQLiteStorage
+from short_term_memory import trim_messages
+from token_counter import estimate_tokens
+
+
+def test_history_is_append_only_jsonl():
+    """Each history entry is one line in the active JSONL segment."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.add_to_history("user", "你好")
+        memory.add_to_history("assistant", "Hello!", {"model": "glm-4.7"})
+
+        segment = Path(tmp) / "history" / "segment-000001.jsonl"
+        lines = segment.read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 2
+        assert json.loads(lines[0])["content"] == "你好"
+
+        history = memory.get_history()
+        assert [h["role"] for h in history] == ["user", "assistant"]
+        assert history[1]["metadata"] == {"model": "glm-4.7"}
+        assert memory.get_history(limit=1) == history[-1:]
+
+
+def test_legacy_history_is_migrated_once():
+    """An existing history.json array is converted to JSONL on startup."""
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = [
+            {"timestamp": "2026-02-14T10:00:00", "role": "user", "content": "ok"},
+            {"timestamp": "2026-02-14T10:00:01", "role": "assistant", "content": "好的"},
+        ]
+        (Path(tmp) / "history.json").write_text(json.dumps(legacy, indent=2))
+
+        memory = MemoryManager(memory_dir=tmp)
+        assert memory.get_history() == legacy
+        assert not (Path(tmp) / "history.json").exists()
+        assert (Path(tmp) / "history.json.bak").exists()
+
+        memory.add_to_history("user", "again")
+        assert len(MemoryManager(memory_dir=tmp).get_history()) == 3
+
+
+def test_jsonl_log_is_migrated_to_segments():
+    """A single history.jsonl log is split into segments on startup."""
+    with tempfile.TemporaryDirectory() as tmp:
+        entries = [
+            {"timestamp": f"2026-02-14T10:00:{i:02d}", "role": "user", "content": f"m{i}"}
+            for i in range(10)
+        ]
+        (Path(tmp) / "history.jsonl").write_text(
+            "".join(json.dumps(e) + "\n" for e in entries), encoding="utf-8"
+        )
+
+        memory = MemoryManager(memory_dir=tmp, storage_options={"segment_bytes": 200})
+        assert memory.get_history() == entries
+        assert (Path(tmp) / "history.jsonl.bak").exists()
+        assert len(memory.storage._refresh_index()["segments"]) > 1
+
+
+def test_segmented_history_tail_and_window_reads():
+    """Tail and time-window reads only open the segments they need."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(
+            memory_dir=tmp,
+            storage_options={"segment_bytes": 300, "compress_segments": True},
+        )
+        entries = [
+            {"timestamp": f"2026-02-{day:02d}T12:00:00", "role": "user", "content": f"day {day}"}
+            for day in range(1, 29)
+        ]
+        memory.add_history_entries(entries[:14])
+        for entry in entries[14:]:
+            memory.add_history_entries([entry])
+
+        storage = memory.storage
+        index = storage._refresh_index()
+        assert len(index["segments"]) >= 3
+        assert all(s["name"].endswith(".jsonl.gz") for s in index["segments"])
+        assert storage.history_count() == 28
+        assert memory.get_history() == entries
+
+        opened = []
+        read_segment = storage._read_segment
+        read_tail = storage._read_segment_tail
+        with mock.patch.object(
+            storage, "_read_segment", side_effect=lambda path: opened.append(path) or read_segment(path)
+        ), mock.patch.object(
+            storage, "_read_segment_tail",
+            side_effect=lambda path, limit: opened.append(path) or read_tail(path, limit),
+        ):
+            assert memory.get_history(limit=2) == entries[-2:]
+            assert len(opened) == 1
+
+            opened.clear()
+            window = memory.get_history(since="2026-02-03T00:00:00", until="2026-02-05T23:59:59")
+            assert [e["content"] for e in window] == ["day 3", "day 4", "day 5"]
+            assert len(opened) < len(index["segments"]) + 1
+
+
+def test_history_tail_decodes_only_the_last_lines():
+    """A short tail of a large active segment is read backwards from the end."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, write_delay=None)
+        memory.add_history_entries([
+            {"role": "user", "content": f"消息 {i} " + "x" * (i % 200)} for i in range(5000)
+        ])
+        with open(Path(tmp) / "history" / "segment-000001.jsonl", "a", encoding="utf-8") as f:
+            f.write('{"role": "user", "cont')  # torn by a crash mid-append
+
+        decoded = []
+        decode_line = memory_storage._decode_line
+        with mock.patch.object(
+            memory_storage, "_decode_line", side_effect=lambda line: decoded.append(line) or decode_line(line)
+        ):
+            tail = memory.get_history(limit=5)
+        assert [h["content"].split(" ")[1] for h in tail] == ["4995", "4996", "4997", "4998", "4999"]
+        assert len(decoded) == 6
+        assert memory.get_history(limit=5000) == memory.get_history()
+
+
+def test_export_import_roundtrip():
+    """Exported memory can be imported into a fresh directory."""
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+        memory = MemoryManager(memory_dir=src)
+        memory.save_preference("language", "Chinese")
+        memory.save_context("project", "AI Assistant")
+        memory.add_to_history("user", "What is LangChain?")
+        export_file = Path(src) / "export.json"
+        memory.export_long_term_memory(str(export_file))
+
+        restored = MemoryManager(memory_dir=dst)
+        restored.import_long_term_memory(str(export_file))
+        assert restored.get_preference("language") == "Chinese"
+        assert restored.get_context("project") == "AI Assistant"
+        assert restored.get_history() == memory.get_history()
+
+
+def test_json_cache_skips_reparse_and_sees_external_writes():
+    """Cached reads avoid json.load until another writer changes the file."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_preference("language", "Chinese")
+
+        with mock.patch("memory_storage.json.load", side_effect=AssertionError("re-parsed")):
+            for _ in range(3):
+                assert memory.get_preference("language") == "Chinese"
+
+        other = MemoryManager(memory_dir=tmp)
+        other.save_preference("language", "English (UK)")
+        assert memory.get_preference("language") == "English (UK)"
+
+        all_context = memory.get_all_context()
+        all_context["mutated"] = True
+        assert memory.get_context("mutated") is None
+
+
+def test_failed_atomic_write_keeps_file_and_removes_temp():
+    """A write that fails midway leaves the old file and no temp file behind."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "state.json"
+        atomic_write_json(path, {"ok": True})
+        try:
+            atomic_write_json(path, {"bad": object()})
+        except TypeError:
+            pass
+        else:
+            raise AssertionError("unserializable data was written")
+        assert json.loads(path.read_text(encoding="utf-8")) == {"ok": True}
+        assert [p.name for p in Path(tmp).iterdir()] == ["state.json"]
+
+
+def test_memory_summary_is_memoized_and_tracks_history_count():
+    """The summary is rebuilt only on change and never scans the history."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_preference("language", "Chinese")
+        for i in range(3):
+            memory.add_to_history("user", f"message {i}")
+
+        with mock.patch.object(memory.storage, "iter_history", side_effect=AssertionError("full scan")):
+            first = memory.get_memory_summary()
+            assert "Total messages: 3" in first
+            with mock.patch.object(memory.storage, "get_all", side_effect=AssertionError("rebuilt")):
+                assert memory.get_memory_summary() is first
+
+            # Appends from another process are counted from the new tail only
+            MemoryManager(memory_dir=tmp).add_to_history("assistant", "reply")
+            assert "Total messages: 4" in memory.get_memory_summary()
+
+            memory.save_context("project", "AI Assistant")
+            assert "- project: AI Assistant" in memory.get_memory_summary()
+
+        assert MemoryManager(memory_dir=tmp).storage.history_count() == 4
+
+
+def test_tokenize_mixes_cjk_bigrams_and_latin_words():
+    """CJK runs become character bigrams, Latin text becomes words."""
+    assert tokenize("推荐三体 NBA news!") == ["推荐", "荐三", "三体", "nba", "news"]
+    assert tokenize("好") == ["好"]
+
+
+def test_search_history_ranks_and_updates_incrementally():
+    """search_history finds CJK and Latin matches and indexes new entries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.add_history_entries([
+            {"role": "user", "content": "推荐最近的好看的电影", "timestamp": "2026-02-01T10:00:00"},
+            {"role": "user", "content": "三体电视剧好看吗？三体小说呢", "timestamp": "2026-02-02T10:00:00"},
+            {"role": "user", "content": "latest NBA news", "timestamp": "2026-02-03T10:00:00"},
+        ])
+
+        results = memory.search_history("三体")
+        assert [r["content"] for r in results] == ["三体电视剧好看吗？三体小说呢"]
+        assert results[0]["score"] > 0
+        assert memory.search_history("nba")[0]["content"] == "latest NBA news"
+        assert memory.search_history("unrelated") == []
+
+        memory.add_to_history("assistant", "《三体》是刘慈欣的科幻小说")
+        assert len(memory.search_history("三体")) == 2
+        assert len(memory.search_history("三体", since="2026-02-10")) == 1
+
+        # A second process reuses the persisted index
+        assert len(MemoryManager(memory_dir=tmp).search_history("三体")) == 2
+
+
+def test_search_caps_work_for_common_terms():
+    """Common terms only rescore rarer matches, or their most recent entries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, backend="sqlite")
+        memory.add_history_entries(
+            [{"role": "user", "content": f"the note {i}"} for i in range(20)]
+            + [{"role": "user", "content": "the rare note"}]
+            + [{"role": "user", "content": f"the note {i}"} for i in range(20, 40)]
+        )
+        with mock.patch("history_search.HistorySearchIndex.COMMON_TERM_DOCS", 5):
+            results = memory.search_history("the rare note", limit=3)
+            assert [r["content"] for r in results] == ["the rare note"]
+
+            recent = memory.search_history("the note", limit=50)
+            assert len(recent) == 5
+            assert all(r["content"] in {f"the note {i}" for i in range(35, 40)} for r in recent)
+
+
+def test_search_index_is_rebuilt_after_import():
+    """Replacing the history invalidates the search index."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.add_to_history("user", "三体")
+        assert len(memory.search_history("三体")) == 1
+
+        memory.storage.replace_history([
+            {"timestamp": "2026-02-14T10:00:00", "role": "user", "content": "NBA"},
+        ])
+        assert memory.search_history("三体") == []
+        assert len(memory.search_history("nba")) == 1
+
+
+def test_relevant_memory_selects_matching_items_within_budget():
+    """Only items matching the turn are injected, within the token budget."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_preference("language", "Chinese")
+        memory.save_context("primary_interest", "电影电视剧推荐")
+        memory.save_context("also_interested_in", "economic news")
+        memory.save_context("user_behavior_analysis", {
+            "top_message_1": ("Based on the actual result above, answer my question.", 90),
+            "user_trait_4": "经常重复搜索已看过的内容",
+        })
+
+        block = memory.get_relevant_memory("推荐几部电影", top_k=8, token_budget=400)
+        assert "- language: Chinese" in block
+        assert "primary_interest" in block
+        assert "economic news" not in block
+        assert "user_behavior_analysis" not in block
+
+        block = memory.get_relevant_memory("any economic news today?")
+        assert "also_interested_in" in block
+        assert "primary_interest" not in block
+
+        tight = memory.get_relevant_memory("推荐几部电影", token_budget=40)
+        assert estimate_tokens(tight) <= 40
+        assert "primary_interest" in tight and "language" not in tight
+
+        # History appends keep the tokenized items; a context write rebuilds them
+        items = memory._memory_items()
+        memory.add_to_history("user", "推荐几部电影")
+        assert memory._memory_items() is items
+        memory.save_context("also_interested_in", "sports")
+        assert memory._memory_items() is not items
+
+
+def test_streaming_ndjson_export_import():
+    """ndjson exports stream history line by line and round-trip exactly."""
+    with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+        memory = MemoryManager(memory_dir=src)
+        memory.save_preference("language", "Chinese")
+        memory.save_context("project", "AI Assistant")
+        memory.add_history_entries([
+            {"role": "user", "content": f"消息 {i}"} for i in range(50)
+        ])
+
+        for name in ("backup.ndjson", "backup.ndjson.gz"):
+            export_file = Path(src) / name
+            with mock.patch.object(memory, "get_history", side_effect=AssertionError("loaded all")):
+                memory.export_long_term_memory(str(export_file))
+
+            restored = MemoryManager(memory_dir=dst, backend="sqlite")
+            restored.import_long_term_memory(str(export_file))
+            assert restored.get_preference("language") == "Chinese"
+            assert restored.get_context("project") == "AI Assistant"
+            assert restored.get_history() == memory.get_history()
+            restored.storage.close()
+
+        lines = (Path(src) / "backup.ndjson").read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 51
+        assert json.loads(lines[0])["preferences"]["language"] == "Chinese"
+
+
+def test_import_of_damaged_backup_keeps_live_memory():
+    """A backup that fails to parse part-way leaves preferences, context and history intact."""
+    with tempfile.TemporaryDirectory() as src:
+        source = MemoryManager(memory_dir=src)
+        source.save_preference("language", "English")
+        source.add_history_entries([{"role": "user", "content": f"旧消息 {i}"} for i in range(10)])
+        backup = Path(src) / "backup.ndjson"
+        source.export_long_term_memory(str(backup))
+        damaged = Path(src) / "damaged.ndjson"
+        damaged.write_text(backup.read_text(encoding="utf-8")[:-20], encoding="utf-8")  # torn last line
+
+        for backend, options in (("json", {"segment_bytes": 512}), ("sqlite", {})):
+            with tempfile.TemporaryDirectory() as dst:
+                memory = MemoryManager(memory_dir=dst, backend=backend, storage_options=options)
+                memory.save_preference("language", "Chinese")
+                memory.save_context("project", "AI Assistant")
+                memory.add_history_entries([{"role": "user", "content": f"消息 {i}"} for i in range(100)])
+                live = memory.get_history()
+
+                try:
+                    memory.import_long_term_memory(str(damaged))
+                    raise AssertionError("expected JSONDecodeError")
+                except json.JSONDecodeError:
+                    pass
+                assert memory.get_preference("language") == "Chinese"
+                assert memory.get_context("project") == "AI Assistant"
+                assert memory.get_history() == live
+
+                memory.import_long_term_memory(str(backup))
+                assert memory.get_preference("language") == "English"
+                assert memory.get_history() == source.get_history()
+                if backend == "json":
+                    # Neither import leaves segments the index does not reference
+                    index = json.loads((Path(dst) / "history" / "index.json").read_text(encoding="utf-8"))
+                    referenced = [seg["name"] for seg in index["segments"]] + [index["active"]["name"]]
+                    assert sorted(p.name for p in (Path(dst) / "history").glob("segment-*")) == referenced
+                else:
+                    memory.storage.close()
+
+
+def test_sqlite_backend():
+    """The SQLite backend serves the same API from memory.db."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, backend="sqlite")
+        assert isinstance(memory.storage, SQLiteStorage)
+        memory.save_preference("language", "Chinese")
+        memory.save_context("interests", ["movies", "economic_news"])
+        for i in range(5):
+            memory.add_to_history("user" if i % 2 == 0 else "assistant", f"message {i}")
+
+        assert memory.get_preference("language") == "Chinese"
+        assert memory.get_context("interests") == ["movies", "economic_news"]
+        assert memory.get_context("missing", "default") == "default"
+        assert [h["content"] for h in memory.get_history(limit=2)] == ["message 3", "message 4"]
+        assert len(memory.get_history(since="2000-01-01", until="2999-01-01")) == 5
+        assert memory.get_history(until="2000-01-01") == []
+        assert memory.search_history("message 3")[0]["content"] == "message 3"
+        assert "Total messages: 5" in memory.get_memory_summary()
+        journal = memory.storage._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert journal == "wal"
+        memory.storage.close()
+
+
+def test_sqlite_context_meta_gains_indexed_expiry_column():
+    """Databases created before the expires_at column are migrated on open."""
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(str(Path(tmp) / "memory.db"))
+        conn.execute("CREATE TABLE context_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.executemany("INSERT INTO context_meta VALUES (?, ?)", [
+            ("news", json.dumps({"expires_at": "2000-01-01T00:00:00"})),
+            ("project", json.dumps({"expires_at": None})),
+        ])
+        conn.commit()
+        conn.close()
+
+        storage = SQLiteStorage(Path(tmp))
+        assert storage.context_expiry("2026-01-01T00:00:00") == (frozenset({"news"}), None)
+        storage.set_many("context_meta", {"project": {"expires_at": "2030-01-01T00:00:00"}})
+        assert storage.context_expiry("2026-01-01T00:00:00") == (frozenset({"news"}), "2030-01-01T00:00:00")
+        storage.close()
+
+
+def test_sqlite_backend_imports_existing_json_directory():
+    """Switching an existing .memories directory to SQLite keeps its data."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_preference("language", "Chinese")
+        memory.add_to_history("user", "你好")
+
+        migrated = MemoryManager(memory_dir=tmp, backend="sqlite")
+        assert migrated.get_preference("language") == "Chinese"
+        assert migrated.get_history() == memory.get_history()
+        migrated.storage.close()
+
+
+def test_transaction_writes_each_section_once():
+    """Bulk saves and transactions apply many updates in one write."""
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as tmp:
+            memory = MemoryManager(memory_dir=tmp, backend=backend)
+            with mock.patch.object(
+                memory.storage, "set_sections", wraps=memory.storage.set_sections
+            ) as write:
+                memory.save_preferences({"language": "Chinese", "content_type": "movies"})
+                with memory.transaction():
+                    memory.save_preference("region", "china")
+                    memory.save_contexts({"project": "AI Assistant", "team": "Lakers"})
+                    with memory.transaction():
+                        memory.save_context("nested", True)
+                    assert memory.get_context("project") is None
+                assert write.call_count == 2
+
+            assert memory.get_preference("language") == "Chinese"
+            assert memory.get_preference("region") == "china"
+            assert memory.get_context("nested") is True
+
+            try:
+                with memory.transaction():
+                    memory.save_context("project", "discarded")
+                    raise ValueError("abort")
+            except ValueError:
+                pass
+            assert memory.get_context("project") == "AI Assistant"
+            memory.storage.close()
+
+
+def test_write_behind_coalesces_and_flushes():
+    """Buffered writes reach disk in one batch: on history read, on timer, or on flush()."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, write_delay=60)
+        inner = memory.storage.inner
+        with mock.patch.object(inner, "set_sections", wraps=inner.set_sections) as write, \
+                mock.patch.object(inner, "append_history", wraps=inner.append_history) as append:
+            memory.save_preference("language", "Chinese")
+            memory.save_context("project", "AI Assistant")
+            memory.add_to_history("user", "你好")
+            memory.add_to_history("assistant", "你好！")
+            assert write.call_count == 0 and append.call_count == 0
+
+            # Key/value reads and counts come from the buffer without a flush
+            token = memory.storage.change_token()
+            assert memory.get_preference("language") == "Chinese"
+            assert memory.get_all_context()["project"] == "AI Assistant"
+            assert memory.storage.history_count() == 2
+            assert "AI Assistant" in memory.get_memory_summary()
+            assert memory.storage.change_token() == token
+            memory.add_to_history("user", "推荐电影")
+            assert memory.storage.change_token() != token
+            assert write.call_count == 0 and append.call_count == 0
+
+            assert len(memory.get_history()) == 3
+            assert write.call_count == 1 and append.call_count == 1
+            assert memory.storage.history_count() == 3
+
+            memory.save_context("team", "Lakers")
+            memory.flush()
+            assert write.call_count == 2
+
+        assert MemoryManager(memory_dir=tmp).get_context("team") == "Lakers"
+
+        memory = MemoryManager(memory_dir=tmp, write_delay=0.01)
+        memory.save_context("team", "Warriors")
+        reader = MemoryManager(memory_dir=tmp)
+        for _ in range(200):
+            if reader.get_context("team") == "Warriors":
+                break
+            time.sleep(0.01)
+        assert reader.get_context("team") == "Warriors"
+
+
+def test_short_term_memory_is_bounded():
+    """Session messages are capped by count and tokens, oldest turns rolled up."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, short_term_max_messages=4)
+        for i in range(10):
+            memory.add_short_term_message(HumanMessage(content=f"question {i}"))
+            memory.add_short_term_message(AIMessage(content=f"answer {i}"))
+        messages = memory.get_short_term_messages()
+        assert [m["content"] for m in messages] == ["question 8", "answer 8", "question 9", "answer 9"]
+        assert messages[0] == {"role": "user", "content": "question 8", "type": "HumanMessage"}
+        assert "question 7" in memory.get_short_term_rollup()
+        assert not hasattr(next(iter(memory.short_term["messages"])), "__dict__")
+
+        memory = MemoryManager(memory_dir=tmp, short_term_max_messages=None, short_term_max_tokens=10)
+        for i in range(10):
+            memory.add_short_term_message(HumanMessage(content="abcdefgh"))
+        assert memory.short_term["messages"].tokens <= 10
+        memory.clear_short_term_memory()
+        assert memory.get_short_term_messages() == [] and memory.get_short_term_rollup() == ""
+
+        # Multimodal messages carry a list of content blocks
+        memory = MemoryManager(memory_dir=tmp, short_term_max_messages=1)
+        blocks = [{"type": "text", "text": "这是什么？"}, {"type": "image_url", "image_url": {"url": "data:..."}}]
+        memory.add_short_term_message(HumanMessage(content=blocks))
+        memory.add_short_term_message(AIMessage(content="一只猫"))
+        assert memory.get_short_term_messages()[0]["content"] == "一只猫"
+        assert "这是什么" in memory.get_short_term_rollup()
+
+
+def test_trim_messages_keeps_system_prompt_and_whole_turns():
+    """The terminal transcript is trimmed in place from the oldest turn."""
+    messages = [SystemMessage(content="system")]
+    for i in range(5):
+        messages += [HumanMessage(content=f"q{i}"), AIMessage(content=f"a{i}")]
+    messages.append(HumanMessage(content="q5"))
+
+    assert trim_messages(messages, max_messages=4) == 8
+    assert [m.content for m in messages] == ["system", "q4", "a4", "q5"]
+
+    messages.append(HumanMessage(content="x" * 1000))
+    trim_messages(messages, max_tokens=10)
+    assert [m.content for m in messages] == ["system", "x" * 1000]
+
+
+def test_memory_namespaces_are_isolated_and_lru_bounded():
+    """Each namespace has its own files; idle namespaces are closed LRU-first."""
+    with tempfile.TemporaryDirectory() as tmp:
+        namespaces = MemoryNamespaces(Path(tmp), max_open=2)
+        namespaces.get("alice").save_preference("language", "Chinese")
+        namespaces.get("bob").save_preference("language", "English")
+        assert namespaces.get("alice").get_preference("language") == "Chinese"
+        assert namespaces.get("bob").get_preference("language") == "English"
+
+        with namespaces.session("alice"):
+            namespaces.get("carol")
+            namespaces.get("dave")
+            assert namespaces.open_namespaces() == ["alice", "dave"]
+        assert namespaces.get("alice").get_preference("language") == "Chinese"
+
+        escaped = namespaces.path_for("../etc")
+        assert escaped.parent == Path(tmp) and escaped.name.startswith("ns-")
+        namespaces.close()
+        assert namespaces.open_namespaces() == []
+
+
+def test_rollups_condense_history_by_age():
+    """Recent days stay daily, older ones merge into weeks and months."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_context("favorite_team", "Lakers")
+        memory.add_history_entries([
+            {"role": "user", "content": "推荐最近的电影", "timestamp": "2026-10-17T10:00:00"},
+            {"role": "assistant", "content": "好的", "timestamp": "2026-10-17T10:00:05"},
+            {"role": "user", "content": "推荐最近的电影", "timestamp": "2026-10-16T09:00:00"},
+            {"role": "user", "content": "latest NBA news", "timestamp": "2026-09-30T09:00:00"},
+            {"role": "user", "content": "latest NBA scores", "timestamp": "2026-10-01T09:00:00"},
+            {"role": "user", "content": "三体小说", "timestamp": "2026-03-03T09:00:00"},
+        ])
+
+        assert memory.rollups.update(today=date(2026, 10, 18)) == 6
+        periods = [(b["level"], b["period"]) for b in memory.rollups.rollups()]
+        assert periods == [("day", "2026-10-17"), ("day", "2026-10-16"), ("week", "2026-W40"), ("month", "2026-03")]
+        day = memory.rollups.rollups()[0]
+        assert day["messages"] == 2 and "推荐" in day["terms"]
+        assert "推荐最近的电影" in day["snippets"]
+
+        # Only new entries are read; aged buckets move up a level
+        memory.add_to_history("user", "hello again")
+        with mock.patch.object(memory.storage, "iter_history", side_effect=AssertionError("full scan")):
+            assert memory.rollups.update(today=date(2026, 10, 30)) == 1
+        levels = {b["period"]: b["level"] for b in memory.rollups.rollups()}
+        assert levels["2026-W42"] == "week"
+        assert memory.rollups.stale_context_keys() == []
+        memory.rollups.update(today=date(2026, 12, 30))
+        assert memory.rollups.stale_context_keys() == ["favorite_team"]
+
+
+def test_profile_stats_are_incremental():
+    """Profile stats come from one pass over history and only read new entries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.add_history_entries([
+            {"role": "user", "content": "推荐电影", "timestamp": "2026-10-17T10:00:00"},
+            {"role": "assistant", "content": "EXECUTE: python skills/news-search/search.py 电影", "timestamp": "2026-10-17T10:00:05"},
+            {"role": "user", "content": "ok", "timestamp": "2026-10-17T10:10:00"},
+            {"role": "user", "content": "推荐电影", "timestamp": "2026-10-17T10:20:00"},
+            {"role": "user", "content": "ok", "timestamp": "2026-10-18T08:00:00"},
+            {"role": "assistant", "content": "EXECUTE: python3 skills/china-search/search.py x", "timestamp": "2026-10-18T08:30:00"},
+        ])
+
+        stats = memory.get_profile_stats(top_k=2)
+        assert stats["total_messages"] == 6
+        assert (stats["total_user_messages"], stats["total_assistant_responses"]) == (4, 2)
+        assert stats["top_messages"] == [["推荐电影", 2], ["ok", 2]]
+        assert stats["searches_by_source"] == {"news-search": 1, "china-search": 1}
+        assert (stats["active_days"], stats["sessions"]) == (2, 2)
+        assert stats["last_session"] == {"date": "2026-10-18", "minutes": 30.0, "messages": 2, "searches": 1}
+
+        # A fresh manager resumes from the checkpoint instead of rescanning
+        memory.add_to_history("user", "ok")
+        reopened = MemoryManager(memory_dir=tmp)
+        with mock.patch.object(reopened.storage, "iter_history", side_effect=AssertionError("full scan")):
+            stats = reopened.get_profile_stats(top_k=1)
+        assert stats["total_messages"] == 7
+        assert stats["top_messages"] == [["ok", 3]]
+
+
+def test_memory_summary_stays_within_token_budget():
+    """However much memory accumulates, the summary fits its budget."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, summary_token_budget=120)
+        memory.save_preference("language", "Chinese")
+        memory.save_contexts({f"topic_{i}": f"long context value number {i} " * 5 for i in range(50)})
+        memory.add_history_entries([
+            {"role": "user", "content": f"question about topic {i}", "timestamp": f"2026-10-{i % 28 + 1:02d}T10:00:00"}
+            for i in range(200)
+        ])
+        memory.update_rollups()
+
+        summary = memory.get_memory_summary()
+        assert estimate_tokens(summary) <= 120
+        assert "- language: Chinese" in summary
+        assert "Total messages: 200" in summary
+        assert estimate_tokens(memory.get_memory_summary(token_budget=2000)) > 120
+
+
+def test_context_keys_expire_and_are_evicted_by_policy():
+    """TTL keys disappear; past the cap the least recently/often used key goes."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+        memory.save_context("project", "AI Assistant")
+        memory.save_context("search_frequency", "high", ttl=0.05)
+        assert "search_frequency" in memory.get_memory_summary()
+        time.sleep(0.1)
+        assert memory.get_context("search_frequency") is None
+        assert "search_frequency" not in memory.get_all_context()
+        assert "search_frequency" not in memory.get_memory_summary()
+        assert memory.evict_context() == ["search_frequency"]
+        assert set(memory.storage.get_all("context_meta")) == {"project"}
+
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as tmp:
+            memory = MemoryManager(memory_dir=tmp, backend=backend)
+            memory.save_context("project", "AI Assistant", ttl=60)
+            memory.save_context("news", "NBA", ttl=0.05)
+            time.sleep(0.1)
+            # The expired set is memoized until the context changes
+            assert set(memory.get_all_context()) == {"project", "updated_at"}
+            with mock.patch.object(memory.storage, "context_expiry", side_effect=AssertionError("rescanned")):
+                assert "news" not in memory.get_memory_summary()
+                assert memory.get_context("news") is None
+            memory.save_context("news", "Lakers")
+            assert memory.get_all_context()["news"] == "Lakers"
+
+            # Exports carry the TTLs; importing context replaces them
+            backup = Path(tmp) / "backup.ndjson"
+            memory.export_long_term_memory(str(backup))
+            memory.save_context("project", "Mac Agent", ttl=0.05)
+            time.sleep(0.1)
+            memory.import_long_term_memory(str(backup))
+            assert memory.get_context("project") == "AI Assistant"
+            assert memory.storage.get("context_meta", "project")["expires_at"]
+
+            memory.save_context("project", "Mac Agent", ttl=0.05)
+            time.sleep(0.1)
+            restore = Path(tmp) / "restore.json"
+            restore.write_text(json.dumps({"context": {"project": "restored"}}), encoding="utf-8")
+            memory.import_long_term_memory(str(restore))
+            assert memory.get_context("project") == "restored"
+            assert memory.get_all_context() == {"project": "restored"}
+
+    for policy, expected in (("lru", "b"), ("lfu", "a")):
+        with tempfile.TemporaryDirectory() as tmp:
+            memory = MemoryManager(memory_dir=tmp, context_max_keys=3, context_eviction=policy)
+            memory.save_contexts({"a": 1, "b": 2, "c": 3})
+            for key in ("b", "b", "a", "c"):
+                memory.get_context(key)
+            memory.save_context("d", 4)
+            assert set(memory.get_all_context()) - {"updated_at"} == {"a", "b", "c", "d"} - {expected}
+
+
+def test_context_reads_do_not_write_access_stats():
+    """get_context counts accesses in memory; context_meta is written on flush."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, write_delay=None)
+        memory.save_context("project", "AI Assistant")
+        meta_file = Path(tmp) / "context_meta.json"
+        written = meta_file.stat().st_mtime_ns
+        with mock.patch.object(memory.storage, "set_many", side_effect=AssertionError("wrote on read")):
+            for _ in range(3):
+                assert memory.get_context("project") == "AI Assistant"
+            assert "project" in memory.get_relevant_memory("project")
+        assert meta_file.stat().st_mtime_ns == written
+        assert memory.storage.get_all("context_meta")["project"]["hits"] == 1
+
+        memory.flush()
+        assert memory.storage.get_all("context_meta")["project"]["hits"] == 5
+        memory.save_context("project", "Mac Agent")
+        assert memory.storage.get_all("context_meta")["project"]["hits"] == 6
+
+        # Buffered stats are written at exit and when a namespace is closed
+        memory.get_context("project")
+        memory_manager._flush_live_managers()
+        assert memory.storage.get_all("context_meta")["project"]["hits"] == 7
+
+        namespaces = MemoryNamespaces(Path(tmp) / "users", max_open=1)
+        namespaces.get("alice").save_context("project", "AI Assistant")
+        namespaces.get("alice").get_context("project")
+        namespaces.get("bob")
+        assert MemoryManager(memory_dir=namespaces.path_for("alice")).storage.get_all(
+            "context_meta"
+        )["project"]["hits"] == 2
+
+
+def test_async_methods_run_on_io_executor():
+    """Async counterparts return the same data and run concurrently off the loop."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp)
+
+        async def session():
+            await memory.asave_preferences({"language": "Chinese"})
+            await asyncio.gather(*(memory.asave_context(f"k{i}", i) for i in range(20)))
+            await memory.aadd_history_entries([{"role": "user", "content": "推荐电影"}])
+            return await asyncio.gather(
+                memory.aget_preference("language"),
+                memory.aget_all_context(),
+                memory.aget_history(),
+                memory.aget_memory_summary(),
+                memory.asearch_history("电影"),
+            )
+
+        language, context, history, summary, hits = asyncio.run(session())
+        assert language == "Chinese"
+        assert {f"k{i}" for i in range(20)} <= set(context)
+        assert [h["content"] for h in history] == ["推荐电影"]
+        assert "- language: Chinese" in summary
+        assert hits and hits[0]["content"] == "推荐电影"
+
+
+def test_concurrent_async_searches_share_one_index():
+    """Parallel asearch_history calls build and persist a single consistent index."""
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = MemoryManager(memory_dir=tmp, write_delay=None)
+        memory.add_history_entries(
+            [{"role": "user", "content": f"第{i}部电影 movie {i}"} for i in range(2000)]
+        )
+
+        async def searches():
+            return await asyncio.gather(*(memory.asearch_history("电影", limit=3) for _ in range(8)))
+
+        results = asyncio.run(searches())
+        assert all(len(hits) == 3 for hits in results)
+        assert all(hits == results[0] for hits in results)
+        assert len(memory._search_index.doc_lengths) == 2000
+        index_files = [p.name for p in Path(tmp).iterdir() if "search_index" in p.name]
+        assert index_files == [f"search_index.{memory.storage.name}.json"]
+
+
+def _concurrent_writer(memory_dir, worker, concurrency):
+    memory = MemoryManager(memory_dir=memory_dir, storage_options={"concurrency": concurrency})
+    for i in range(25):
+        memory.save_context(f"w{worker}_k{i}", i)
+        memory.add_to_history("user", f"worker {worker} message {i}")
+
+
+def test_concurrent_processes_do_not_lose_writes():
+    """Parallel writers keep every context key and history entry."""
+    for concurrency in ("lock", "optimistic"):
+        with tempfile.TemporaryDirectory() as tmp:
+            workers = [
+                multiprocessing.Process(target=_concurrent_writer, args=(tmp, w, concurrency))
+                for w in range(4)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(60)
+                assert worker.exitcode == 0
+
+            memory = MemoryManager(memory_dir=tmp)
+            context = memory.get_all_context()
+            assert all(context[f"w{w}_k{i}"] == i for w in range(4) for i in range(25))
+            assert memory.storage.history_count() == 100
+            assert len(memory.get_history()) == 100
+            assert not list(Path(tmp).glob("*.tmp"))
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_") and callable(func):
+            func()
+            print(f"✅ {name}")
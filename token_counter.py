@@ -0,0 +1,24 @@
+"""Lightweight token estimates for prompt budgeting."""
+import re
+
+
+_CJK_RE = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate how many tokens a model will count for text.
+
+    GLM tokenizers spend roughly one token per CJK character and one per
+    four characters of other text. The estimate errs slightly high, which
+    is the safe direction for budgeting.
+
+    Args:
+        text: Text to measure
+
+    Returns:
+        Estimated token count
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4